@@ -0,0 +1,158 @@
+import asyncio
+import logging
+import time
+import config
+from background import BackgroundTask
+from database import get_users_connection, run_db
+from metrics import Histogram, timed
+from question_sampler import question_sampler
+from spaced_repetition import SCHEDULING_MODE, review_scheduler
+from user_stats import user_stats
+
+# Параметры отложенной записи ответов можно переопределить в config.py
+ANSWER_FLUSH_INTERVAL_MS = getattr(config, 'ANSWER_FLUSH_INTERVAL_MS', 200)
+ANSWER_FLUSH_BATCH_SIZE = getattr(config, 'ANSWER_FLUSH_BATCH_SIZE', 100)
+
+RECORD_ANSWER_SECONDS = Histogram('bot_record_answer_seconds', 'Время учёта ответа до постановки в очередь записи')
+ANSWER_FLUSH_SECONDS = Histogram('bot_answer_flush_seconds', 'Время записи пачки ответов')
+ANSWER_FLUSH_BATCH = Histogram('bot_answer_flush_batch_size', 'Число ответов в записанной пачке',
+                               buckets=(1, 5, 10, 25, 50, 100, 250, 500, 1000))
+
+
+# Запись пачки ответов одной транзакцией: один fsync на пачку вместо одного на ответ
+@timed(ANSWER_FLUSH_SECONDS)
+def write_answers(events):
+    user_deltas = {}
+    category_deltas = {}
+    schedule_rows = []
+    for telegram_id, question_id, correct, category, schedule_row in events:
+        total, correct_count = user_deltas.get(telegram_id, (0, 0))
+        user_deltas[telegram_id] = (total + 1, correct_count + int(correct))
+        total, correct_count = category_deltas.get((telegram_id, category), (0, 0))
+        category_deltas[(telegram_id, category)] = (total + 1, correct_count + int(correct))
+        if schedule_row is not None:
+            schedule_rows.append(schedule_row)
+
+    answered_at = time.time()
+    with get_users_connection() as conn:
+        # Ответ может прийти без /start (например, на вопрос дня): такой пользователь регистрируется
+        # при первом ответе, иначе статистика в памяти разошлась бы с базой
+        conn.executemany('INSERT OR IGNORE INTO users (telegram_id, correct_answers, total_answers) VALUES (?, 0, 0)',
+                         [(telegram_id,) for telegram_id in user_deltas])
+        conn.executemany('INSERT INTO answered_questions (telegram_id, question_id, correct, answered_at) '
+                         'VALUES (?, ?, ?, ?)',
+                         [(telegram_id, question_id, int(correct), answered_at)
+                          for telegram_id, question_id, correct, _, _ in events])
+        # События идут в порядке ответов, поэтому last_correct остаётся у последней попытки
+        conn.executemany('''INSERT INTO question_history
+                            (telegram_id, question_id, attempts, correct_attempts, last_correct, last_answered_at)
+                            VALUES (?, ?, 1, ?, ?, ?)
+                            ON CONFLICT (telegram_id, question_id) DO UPDATE SET
+                                attempts = attempts + 1,
+                                correct_attempts = correct_attempts + excluded.correct_attempts,
+                                last_correct = excluded.last_correct,
+                                last_answered_at = excluded.last_answered_at''',
+                         [(telegram_id, question_id, int(correct), int(correct), answered_at)
+                          for telegram_id, question_id, correct, _, _ in events])
+        conn.executemany('UPDATE users SET correct_answers = correct_answers + ?, total_answers = total_answers + ? '
+                         'WHERE telegram_id = ?',
+                         [(correct_count, total, telegram_id)
+                          for telegram_id, (total, correct_count) in user_deltas.items()])
+        conn.executemany('''INSERT INTO user_category_stats (telegram_id, category, correct_answers, total_answers)
+                            VALUES (?, ?, ?, ?)
+                            ON CONFLICT (telegram_id, category) DO UPDATE SET
+                                correct_answers = correct_answers + excluded.correct_answers,
+                                total_answers = total_answers + excluded.total_answers''',
+                         [(telegram_id, category, correct_count, total)
+                          for (telegram_id, category), (total, correct_count) in category_deltas.items()])
+        if schedule_rows:
+            conn.executemany('INSERT OR REPLACE INTO review_schedule (telegram_id, question_id, box, due_at) '
+                             'VALUES (?, ?, ?, ?)', schedule_rows)
+
+
+class AnswerWriter(BackgroundTask):
+    """Отложенная запись ответов пачками.
+
+    Состояние в памяти (выборка вопросов, расписание повторений, статистика пользователя)
+    обновляется сразу, а запись в users.db идёт раз в ANSWER_FLUSH_INTERVAL_MS
+    или после ANSWER_FLUSH_BATCH_SIZE ответов. Методы с суффиксом _sync выполняются
+    только в потоке базы данных, поэтому очередь не нуждается в блокировках.
+    После записи пачки вызывается on_flush(telegram_ids) с пользователями из неё.
+    """
+
+    task_name = "answer_writer"
+
+    def __init__(self, flush_interval_ms=ANSWER_FLUSH_INTERVAL_MS, batch_size=ANSWER_FLUSH_BATCH_SIZE, on_flush=None):
+        self.flush_interval = flush_interval_ms / 1000
+        self.batch_size = batch_size
+        self.on_flush = on_flush
+        self._events = []
+        self._wakeup = None
+
+    def _apply_sync(self, telegram_id, question_id, correct):
+        question_sampler.record_answer(telegram_id, question_id, correct)
+        schedule_row = None
+        if SCHEDULING_MODE == 'spaced':
+            schedule_row = review_scheduler.record_answer(telegram_id, question_id, correct)
+        category = user_stats.record_answer(telegram_id, question_id, correct)
+        return telegram_id, question_id, correct, category, schedule_row
+
+    def record_sync(self, telegram_id, question_id, correct):
+        self._events.append(self._apply_sync(telegram_id, question_id, correct))
+        return len(self._events)
+
+    # Возвращает записанные события; при ошибке они остаются в очереди
+    def flush_sync(self):
+        if not self._events:
+            return []
+        events, self._events = self._events, []
+        try:
+            write_answers(events)
+        except Exception as e:
+            # Возвращаем пачку в очередь, чтобы повторить запись при следующем сбросе
+            self._events[:0] = events
+            logging.error("Ошибка при записи пачки из %s ответов: %s", len(events), e)
+            return []
+        ANSWER_FLUSH_BATCH.observe(len(events))
+        logging.debug("Записано ответов: %s", len(events))
+        return events
+
+    @timed(RECORD_ANSWER_SECONDS)
+    async def record(self, telegram_id, question_id, correct):
+        queued = await run_db(self.record_sync, telegram_id, question_id, correct)
+        if queued >= self.batch_size and self._wakeup is not None:
+            self._wakeup.set()
+
+    async def flush(self):
+        events = await run_db(self.flush_sync)
+        if events and self.on_flush is not None:
+            try:
+                await self.on_flush({event[0] for event in events})
+            except Exception as e:
+                logging.error("Ошибка при обработке записанной пачки ответов: %s", e)
+        return len(events)
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            await self.flush()
+
+    def _prepare(self):
+        self._wakeup = asyncio.Event()
+
+    async def start(self):
+        if await super().start():
+            logging.info("Запущена отложенная запись ответов")
+
+    # Остановка с финальным сбросом, чтобы не потерять ответы при завершении работы
+    async def stop(self):
+        await super().stop()
+        flushed = await self.flush()
+        logging.info("Отложенная запись ответов остановлена, при завершении записано: %s", flushed)
+
+
+answer_writer = AnswerWriter()
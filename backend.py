@@ -1,38 +1,40 @@
-import sqlite3
 import logging
-import random
 from openai import OpenAI
-from config import SYSTEM_PROMPT, OPENAI_API_KEY
+from config import OPENAI_API_KEY
+from database import get_users_connection, get_questions_connection, run_db
+from grading import GRADING_TIMEOUT, OPENAI_GRADING_SECONDS, build_grading_messages, chat_llm, \
+    count_grading_prompt, grading_model, parse_verdict
+from llm_client import OPENAI_BASE_URL
+from metrics import Histogram, timed
+from migrations import migrate
+from answer_writer import answer_writer
+from question_sampler import question_sampler
+from reference_answers import reference_answers
+from spaced_repetition import SCHEDULING_MODE, review_scheduler
+from user_stats import user_stats
 
 
+GET_RANDOM_QUESTION_SECONDS = Histogram('bot_get_random_question_seconds', 'Время выбора следующего вопроса')
+UPDATE_USER_STATS_SECONDS = Histogram('bot_update_user_stats_seconds', 'Время немедленной записи ответа')
+
+
+# Соединения долгоживущие и общие для процесса, закрывать их не нужно
 def connect_db():
-    return sqlite3.connect('users.db')
+    return get_users_connection()
 
 
 def connect_questions_db():
-    return sqlite3.connect('questions.db')
+    return get_questions_connection()
 
 
-def create_user_table():
-    conn = connect_db()
-    c = conn.cursor()
-    c.execute('''CREATE TABLE IF NOT EXISTS users (
-                id INTEGER PRIMARY KEY, 
-                telegram_id INTEGER UNIQUE, 
-                correct_answers INTEGER, 
-                total_answers INTEGER)
-            ''')
-    conn.commit()
-    conn.close()
+# Создание и обновление схемы users.db до последней версии (migrations.py)
+def migrate_users_db():
+    return migrate(connect_db())
 
 
-def create_answered_questions_table():
-    conn = connect_db()
-    c = conn.cursor()
-    c.execute('''CREATE TABLE IF NOT EXISTS answered_questions
-                 (id INTEGER PRIMARY KEY, telegram_id INTEGER, question_id INTEGER, correct BOOLEAN)''')
-    conn.commit()
-    conn.close()
+async def apply_users_migrations():
+    version = await run_db(migrate_users_db)
+    logging.info("Версия схемы users.db: %s", version)
 
 
 def register_user(telegram_id):
@@ -41,13 +43,18 @@ def register_user(telegram_id):
     c.execute('SELECT * FROM users WHERE telegram_id = ?', (telegram_id,))
     user = c.fetchone()
     if user:
-        logging.info(f"Пользователь с telegram_id {telegram_id} уже зарегистрирован.")
+        logging.info("Пользователь с telegram_id %s уже зарегистрирован.", telegram_id)
     else:
         c.execute('INSERT INTO users (telegram_id, correct_answers, total_answers) VALUES (?, ?, ?)',
                   (telegram_id, 0, 0))
         conn.commit()
-        logging.info(f"Пользователь с telegram_id {telegram_id} успешно зарегистрирован.")
-    conn.close()
+        logging.info("Пользователь с telegram_id %s успешно зарегистрирован.", telegram_id)
+
+
+# Пачка пользователей для рассылки: постраничный проход по первичному ключу без OFFSET
+def load_users_batch(after_id, limit):
+    return connect_db().execute('SELECT id, telegram_id FROM users WHERE id > ? ORDER BY id LIMIT ?',
+                                (after_id, limit)).fetchall()
 
 
 def check_questions_table():
@@ -55,133 +62,138 @@ def check_questions_table():
     c = conn.cursor()
     c.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='questions'")
     table_exists = c.fetchone()
-    conn.close()
     return table_exists is not None
 
 
+@timed(GET_RANDOM_QUESTION_SECONDS)
 def get_random_question(telegram_id):
-    with connect_db() as users_conn:
-        users_cursor = users_conn.cursor()
-
-        # Получение списка ID вопросов, на которые был дан неправильный ответ
-        users_cursor.execute('''SELECT question_id 
-                                FROM answered_questions
-                                WHERE telegram_id = ? AND correct = 0''', (telegram_id,))
-        wrong_answers = [row[0] for row in users_cursor.fetchall()]
-
-        # Получение списка ID вопросов, на которые был дан правильный ответ
-        users_cursor.execute('''SELECT question_id 
-                                FROM answered_questions
-                                WHERE telegram_id = ? AND correct = 1''', (telegram_id,))
-        correct_answers = [row[0] for row in users_cursor.fetchall()]
-
-    with connect_questions_db() as questions_conn:
-        questions_cursor = questions_conn.cursor()
-
-        # Проверяем наличие таблицы questions
-        if not check_questions_table():
-            logging.error("Таблица 'questions' не существует в базе данных.")
-            raise sqlite3.OperationalError("no such table: questions")
-
-        logging.info(f"Получаем случайный вопрос для пользователя с telegram_id: {telegram_id}")
-
-        # Вероятность выбора вопроса, на который был дан неправильный ответ
-        retry_probability = 0.3
-
-        if wrong_answers and random.random() < retry_probability:
-            logging.info("Попытка выбрать вопрос с неправильным ответом")
-            # Выбор вопроса, на который был дан неправильный ответ
-            questions_cursor.execute(f'''SELECT id, question, category 
-                                        FROM questions
-                                        WHERE id IN ({",".join("?" * len(wrong_answers))})
-                                        ORDER BY RANDOM() LIMIT 1''', wrong_answers)
-            question = questions_cursor.fetchone()
-            if question:
-                logging.info(f"Выбран вопрос с неправильным ответом: {question}")
-                return question
-
-        logging.info("Попытка выбрать новый вопрос")
-        # Если не выбрали вопрос с неправильным ответом или если таких вопросов нет
-        if correct_answers:
-            questions_cursor.execute(f'''SELECT * FROM questions
-                                        WHERE id NOT IN ({",".join("?" * len(correct_answers))})
-                                        ORDER BY RANDOM() LIMIT 1''', correct_answers)
-        else:
-            questions_cursor.execute('''SELECT * FROM questions
-                                        ORDER BY RANDOM() LIMIT 1''')
-        question = questions_cursor.fetchone()
-        if question:
-            logging.info(f"Выбран новый вопрос: {question}")
+    logging.info("Получаем случайный вопрос для пользователя с telegram_id: %s", telegram_id)
+    if SCHEDULING_MODE == 'spaced':
+        return review_scheduler.next_question(telegram_id)
+    return question_sampler.pick(telegram_id)
+
+
+# Выданные вопросы и их дедлайны хранятся в базе, чтобы пережить перезапуск бота
+def save_pending_question(telegram_id, question_id, question_text, token, deadline):
+    with connect_db() as conn:
+        conn.execute('INSERT OR REPLACE INTO pending_questions '
+                     '(telegram_id, question_id, question_text, token, deadline) VALUES (?, ?, ?, ?, ?)',
+                     (telegram_id, question_id, question_text, token, deadline))
+
+
+def delete_pending_question(telegram_id, token):
+    with connect_db() as conn:
+        conn.execute('DELETE FROM pending_questions WHERE telegram_id = ? AND token = ?', (telegram_id, token))
+
+
+def get_pending_question(telegram_id):
+    return connect_db().execute('SELECT question_id, question_text, token FROM pending_questions WHERE telegram_id = ?',
+                                (telegram_id,)).fetchone()
+
+
+# Атомарное изъятие вопроса: из нескольких процессов бота его получает только один
+def claim_pending_question(telegram_id, token=None):
+    with connect_db() as conn:
+        if token is None:
+            rows = conn.execute('DELETE FROM pending_questions WHERE telegram_id = ? '
+                                'RETURNING question_id, question_text, token, deadline', (telegram_id,)).fetchall()
         else:
-            logging.info("Не удалось выбрать новый вопрос")
-        return question
+            rows = conn.execute('DELETE FROM pending_questions WHERE telegram_id = ? AND token = ? '
+                                'RETURNING question_id, question_text, token, deadline',
+                                (telegram_id, token)).fetchall()
+    return rows[0] if rows else None
+
+
+def load_pending_questions():
+    return connect_db().execute(
+        'SELECT telegram_id, question_id, question_text, token, deadline FROM pending_questions').fetchall()
 
 
+def load_expired_pending_questions(now):
+    return connect_db().execute('SELECT telegram_id, token FROM pending_questions WHERE deadline <= ?',
+                                (now,)).fetchall()
+
+
+def get_shared_value(key):
+    row = connect_db().execute('SELECT value FROM shared_state WHERE key = ?', (key,)).fetchone()
+    return row[0] if row else None
+
+
+def set_shared_value(key, value):
+    with connect_db() as conn:
+        conn.execute('INSERT OR REPLACE INTO shared_state (key, value) VALUES (?, ?)', (key, value))
+
+
+def delete_shared_value(key):
+    with connect_db() as conn:
+        conn.execute('DELETE FROM shared_state WHERE key = ?', (key,))
+
+
+def increment_shared_value(key):
+    with connect_db() as conn:
+        rows = conn.execute('''INSERT INTO shared_state (key, value) VALUES (?, '1')
+                               ON CONFLICT (key) DO UPDATE SET value = CAST(value AS INTEGER) + 1
+                               RETURNING value''', (key,)).fetchall()
+    return int(rows[0][0])
+
+
+# Сброс закэшированного в памяти состояния пользователя: оно загрузится из базы заново
+def forget_user_state(telegram_id):
+    question_sampler.forget_user(telegram_id)
+    review_scheduler.forget_user(telegram_id)
+    user_stats.forget_user(telegram_id)
+
+
+# Немедленная запись одного ответа; обработчики бота используют отложенную запись answer_writer.record
+@timed(UPDATE_USER_STATS_SECONDS)
 def update_user_stats(telegram_id, question_id, correct):
-    logging.info(
-        f"Входящие данные в функции update_user_stats - "
-        f"telegram_id:{telegram_id}, question_id: {question_id}, correct: {correct}")
+    logging.debug("Входящие данные в функции update_user_stats - telegram_id:%s, question_id: %s, correct: %s",
+                  telegram_id, question_id, correct)
     try:
-        with connect_db() as conn:
-            c = conn.cursor()
-            c.execute('SELECT correct_answers, total_answers FROM users WHERE telegram_id = ?', (telegram_id,))
-            user = c.fetchone()
-            if user:
-                correct_answers, total_answers = user
-                if correct:
-                    correct_answers += 1
-                total_answers += 1
-                c.execute('UPDATE users SET correct_answers = ?, total_answers = ? WHERE telegram_id = ?',
-                          (correct_answers, total_answers, telegram_id))
-                c.execute('INSERT INTO answered_questions (telegram_id, question_id, correct) VALUES (?, ?, ?)',
-                          (telegram_id, question_id, int(correct)))
-                conn.commit()
-                logging.info(
-                    f"Статистика пользователя с telegram_id {telegram_id} обновлена: "
-                    f"{correct_answers}/{total_answers} правильных ответов.")
-            else:
-                logging.error(f"Пользователь с telegram_id {telegram_id} не найден в базе данных.")
+        answer_writer.record_sync(telegram_id, question_id, correct)
+        answer_writer.flush_sync()
+        logging.info("Статистика пользователя с telegram_id %s обновлена.", telegram_id)
     except Exception as e:
-        logging.error(f"Ошибка при обновлении статистики пользователя с telegram_id {telegram_id}: {e}")
-
-
-# Функция для проверки ответа с использованием OpenAI
-def check_answer_with_openai(question, user_answer):
+        logging.error("Ошибка при обновлении статистики пользователя с telegram_id %s: %s", telegram_id, e)
+
+
+# Синхронная проверка ответа; в обработчиках бота используется grading.check_answer_async.
+# С question_id и готовым эталоном ответ сравнивается с ним коротким промптом
+@timed(OPENAI_GRADING_SECONDS)
+def check_answer_with_openai(question, user_answer, question_id=None):
+    reference = None
+    if question_id is not None:
+        reference_answers.ensure_loaded()
+        reference = reference_answers.get(question_id)
+    messages = build_grading_messages(question, user_answer, reference)
     try:
-        client = OpenAI(api_key=OPENAI_API_KEY, base_url="https://api.proxyapi.ru/openai/v1", timeout=30)
-        completion = client.chat.completions.create(
-            model="gpt-4o",
-            messages=[
-                {"role": "system", "content": SYSTEM_PROMPT},
-                {"role": "user", "content": f"Вопрос: {question}"},
-                {"role": "user", "content": f"Ответ: {user_answer}. Это ответ правильный?"}
-            ]
-        )
-        gpt_answer_content = completion.choices[0].message.content.strip()
-
-        # Разделяем ответ на две части
-        parts = gpt_answer_content.split('.', 1)
-        correctness = parts[0].strip()
-        logging.info(f"OpenAI response: {correctness}")
-        explanation = parts[1].strip() if len(parts) > 1 else ""
+        client = OpenAI(api_key=OPENAI_API_KEY, base_url=OPENAI_BASE_URL, timeout=GRADING_TIMEOUT, max_retries=0)
+        count_grading_prompt(reference)
+        completion = chat_llm.call_sync(
+            lambda model, timeout: client.chat.completions.create(model=model, messages=messages, timeout=timeout),
+            grading_model(reference), GRADING_TIMEOUT)
+        correctness, explanation = parse_verdict(completion.choices[0].message.content)
+        logging.info("OpenAI response: %s", correctness)
 
         return correctness, explanation
     except Exception as e:
-        logging.error(f"Error checking answer with OpenAI: {e}")
+        logging.error("Error checking answer with OpenAI: %s", e)
         return "Ошибка", "Ошибка при обращении к API"
 
 
+# Статистика берётся из инкрементально обновляемых счётчиков, без подсчёта по answered_questions
 def calculate_user_stats(telegram_id):
-    conn = connect_db()
-    c = conn.cursor()
-    c.execute('''SELECT COUNT(*), SUM(correct) FROM answered_questions WHERE telegram_id = ?''', (telegram_id,))
-    total_answers, correct_answers = c.fetchone() or (0, 0)
-    conn.close()
+    total_answers, correct_answers = user_stats.get_totals(telegram_id)
     if total_answers > 0:
         correct_percentage = (correct_answers / total_answers) * 100
     else:
         correct_percentage = 0
-    logging.info(
-        f"Статистика пользователя с telegram_id {telegram_id}: {total_answers} ответов, "
-        f"{correct_percentage:.2f}% правильных.")
+    logging.info("Статистика пользователя с telegram_id %s: %s ответов, %.2f%% правильных.",
+                 telegram_id, total_answers, correct_percentage)
     return total_answers, correct_percentage
+
+
+# Общая статистика и слабые темы пользователя за одно обращение к потоку базы данных
+def get_user_stats_report(telegram_id):
+    total_answers, correct_percentage = calculate_user_stats(telegram_id)
+    return total_answers, correct_percentage, user_stats.get_weak_categories(telegram_id)
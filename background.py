@@ -0,0 +1,42 @@
+import asyncio
+
+
+class BackgroundTask:
+    """Фоновая задача процесса бота: start() запускает _run(), stop() отменяет её и дожидается завершения.
+
+    Наследники задают task_name и _run(); _enabled() может отключить запуск,
+    а _prepare() создаёт объекты, привязанные к циклу событий, перед запуском задачи.
+    """
+
+    task_name = 'background_task'
+    _task = None
+
+    def _enabled(self):
+        return True
+
+    def _prepare(self):
+        pass
+
+    async def _run(self):
+        raise NotImplementedError
+
+    @property
+    def running(self):
+        return self._task is not None
+
+    # Возвращает True, если задача запущена этим вызовом
+    async def start(self):
+        if self._task is not None or not self._enabled():
+            return False
+        self._prepare()
+        self._task = asyncio.create_task(self._run(), name=self.task_name)
+        return True
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
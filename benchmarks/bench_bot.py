@@ -0,0 +1,295 @@
+"""Нагрузочный тест обработчиков бота без сети.
+
+Синтетические обновления Telegram (нажатия "Получить вопрос" и "Статистика", текстовые
+и голосовые ответы) проходят через Dispatcher из main.py. Bot API и OpenAI заменены
+локальными заглушками, базы данных создаются во временном каталоге. Заглушки работают
+в том же цикле событий, поэтому задержка цикла включает и их собственную нагрузку.
+
+Пример:
+    python benchmarks/bench_bot.py --users 200 --rounds 5 --history-depth 1000
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import logging
+import os
+import random
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+import types
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from stubs import StubOpenAI, StubRedis, StubTelegramAPI  # noqa: E402
+
+BOT_TOKEN = "123456:BENCHMARKbenchmarkBENCHMARKbenchmark"
+WORDS = ("итератор", "генератор", "декоратор", "замыкание", "список", "кортеж", "словарь", "GIL", "поток",
+         "процесс", "корутина", "индекс", "транзакция", "класс", "метод", "наследование")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Нагрузочный тест обработчиков бота")
+    parser.add_argument('--users', type=int, default=100, help="число одновременных пользователей")
+    parser.add_argument('--rounds', type=int, default=5, help="сколько вопросов получает каждый пользователь")
+    parser.add_argument('--answer-words', type=int, default=30, help="длина текстового ответа в словах")
+    parser.add_argument('--repeat-ratio', type=float, default=0.2,
+                        help="доля повторяющихся ответов (попадания в кэш проверок)")
+    parser.add_argument('--voice-ratio', type=float, default=0.2, help="доля голосовых ответов")
+    parser.add_argument('--history-depth', type=int, default=0,
+                        help="строк answered_questions на пользователя до начала теста")
+    parser.add_argument('--openai-latency', type=float, default=0.5, help="средняя задержка заглушки OpenAI, с")
+    parser.add_argument('--openai-error-rate', type=float, default=0.0, help="доля ответов OpenAI с ошибкой 503")
+    parser.add_argument('--openai-slow-rate', type=float, default=0.0,
+                        help="доля запросов к OpenAI с дополнительной задержкой --openai-slow-latency")
+    parser.add_argument('--openai-slow-latency', type=float, default=10.0, help="задержка медленных запросов, с")
+    parser.add_argument('--broadcast-users', type=int, default=0,
+                        help="дополнительных пользователей, которым во время теста идёт рассылка")
+    parser.add_argument('--telegram-rate', type=int, default=0,
+                        help="ограничение заглушки Bot API, сообщений в секунду (0 - без ограничения); "
+                             "включает и ограничение в 3 сообщения в секунду на чат")
+    parser.add_argument('--state-backend', choices=('sqlite', 'redis'), default='sqlite',
+                        help="хранилище выданных вопросов; redis - локальная заглушка StubRedis")
+    parser.add_argument('--log-level', default='WARNING', help="уровень логирования бота во время теста")
+    parser.add_argument('--json', action='store_true', help="вывести отчёт в JSON")
+    return parser.parse_args()
+
+
+# Модуль config для бота: все внешние адреса указывают на локальные заглушки
+def install_config(workdir, openai_url, state_backend='sqlite', redis_url=None, telegram_rate=0):
+    config = types.ModuleType('config')
+    config.API_TOKEN = BOT_TOKEN
+    config.OPENAI_API_KEY = "sk-benchmark"
+    config.ANSWER_TIMEOUT = 120
+    config.SYSTEM_PROMPT = "Ответь 'Правильно' или 'Неправильно', затем объясни."
+    config.OPENAI_BASE_URL = f"{openai_url}/v1"
+    config.USERS_DB = os.path.join(workdir, 'users.db')
+    config.QUESTIONS_DB = os.path.join(workdir, 'questions.db')
+    config.GRADING_CACHE_DB = os.path.join(workdir, 'grading_cache.db')
+    config.STATE_BACKEND = state_backend
+    # Нагрузочный тест измеряет пропускную способность, личные лимиты ответов ему не нужны
+    config.OPENAI_USER_RATE_PER_MINUTE = 6000
+    config.OPENAI_USER_BURST = 100
+    config.OPENAI_GLOBAL_RATE_PER_MINUTE = 60000
+    config.OPENAI_GLOBAL_BURST = 1000
+    if not telegram_rate:
+        # Заглушка Bot API не ограничивает частоту запросов, темп отправки тоже не сдерживаем
+        config.SEND_GLOBAL_RATE = 10000
+        config.SEND_GLOBAL_BURST = 1000
+        config.SEND_CHAT_RATE = 1000
+        config.SEND_CHAT_BURST = 100
+    if redis_url:
+        config.REDIS_URL = redis_url
+    sys.modules['config'] = config
+
+
+def prepare_databases(backend, database, users, history_depth):
+    from migrations import rollup_answered_questions
+    backend.migrate_users_db()
+    question_ids = [row[0] for row in database.get_questions_connection().execute('SELECT id FROM questions')]
+    with database.get_users_connection() as conn:
+        conn.executemany('INSERT INTO users (telegram_id, correct_answers, total_answers) VALUES (?, ?, ?)',
+                         [(user_id, 0, 0) for user_id in users])
+        for user_id in users:
+            history = [(user_id, random.choice(question_ids), random.random() < 0.6) for _ in range(history_depth)]
+            conn.executemany('INSERT INTO answered_questions (telegram_id, question_id, correct, answered_at) '
+                             'VALUES (?, ?, ?, 0)', history)
+            correct_answers = sum(correct for _, _, correct in history)
+            conn.execute('UPDATE users SET correct_answers = ?, total_answers = ? WHERE telegram_id = ?',
+                         (correct_answers, history_depth, user_id))
+        rollup_answered_questions(conn)
+
+
+class UpdateFactory:
+    """Синтетические обновления Telegram в формате Bot API."""
+
+    def __init__(self):
+        self._update_ids = itertools.count(1)
+        self._message_ids = itertools.count(1)
+
+    def _user(self, user_id):
+        return {'id': user_id, 'is_bot': False, 'first_name': f"user{user_id}"}
+
+    def _message(self, user_id, **fields):
+        return {'message_id': next(self._message_ids), 'date': int(time.time()),
+                'chat': {'id': user_id, 'type': 'private'}, 'from': self._user(user_id), **fields}
+
+    def text(self, user_id, text):
+        return {'update_id': next(self._update_ids), 'message': self._message(user_id, text=text)}
+
+    def voice(self, user_id):
+        file_id = f"voice{next(self._message_ids)}"
+        return {'update_id': next(self._update_ids), 'message': self._message(
+            user_id, voice={'file_id': file_id, 'file_unique_id': file_id, 'duration': 5, 'mime_type': 'audio/ogg'})}
+
+    def callback(self, user_id, data):
+        bot_message = self._message(user_id, text="Выберите действие:")
+        bot_message['from'] = {'id': 1, 'is_bot': True, 'first_name': 'bot'}
+        return {'update_id': next(self._update_ids), 'callback_query': {
+            'id': str(next(self._update_ids)), 'from': self._user(user_id), 'chat_instance': str(user_id),
+            'message': bot_message, 'data': data}}
+
+
+class LoopLagMonitor:
+    """Задержка цикла событий: насколько позже запланированного просыпается короткий sleep."""
+
+    def __init__(self, interval=0.01):
+        self.interval = interval
+        self.samples = []
+        self._task = None
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            started = loop.time()
+            await asyncio.sleep(self.interval)
+            self.samples.append(max(0.0, loop.time() - started - self.interval))
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+
+
+def percentile(values, fraction):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def summarize(values):
+    return {
+        'count': len(values),
+        'mean_ms': statistics.fmean(values) * 1000 if values else 0.0,
+        'p50_ms': percentile(values, 0.50) * 1000,
+        'p95_ms': percentile(values, 0.95) * 1000,
+        'p99_ms': percentile(values, 0.99) * 1000,
+        'max_ms': max(values) * 1000 if values else 0.0,
+    }
+
+
+async def run_benchmark(args):
+    workdir = tempfile.mkdtemp(prefix='bot_bench_')
+    shutil.copy(os.path.join(REPO_DIR, 'questions.db'), os.path.join(workdir, 'questions.db'))
+    telegram = await StubTelegramAPI(rate_limit=args.telegram_rate or None,
+                                     chat_limit=3 if args.telegram_rate else None).start()
+    openai = await StubOpenAI(latency=args.openai_latency, error_rate=args.openai_error_rate,
+                              slow_rate=args.openai_slow_rate, slow_latency=args.openai_slow_latency).start()
+    redis = await StubRedis().start() if args.state_backend == 'redis' else None
+    install_config(workdir, openai.url, args.state_backend, redis.url if redis else None, args.telegram_rate)
+
+    from aiogram.client.session.aiohttp import AiohttpSession
+    from aiogram.client.telegram import TelegramAPIServer
+    from aiogram.types import Update
+    import backend
+    import database
+    import main
+
+    logging.getLogger().setLevel(args.log_level)
+    users = list(range(10_000, 10_000 + args.users))
+    await database.run_db(prepare_databases, backend, database, users, args.history_depth)
+    if args.broadcast_users:
+        await database.run_db(prepare_databases, backend, database,
+                              range(1_000_000, 1_000_000 + args.broadcast_users), 0)
+    await main.bot.session.close()
+    main.bot.session = AiohttpSession(api=TelegramAPIServer.from_base(telegram.url))
+    await main.dp.emit_startup(bot=main.bot)
+
+    factory = UpdateFactory()
+    latencies = {}
+    repeated_answer = "не знаю"
+
+    async def feed(kind, update):
+        started = time.perf_counter()
+        await main.dp.feed_update(main.bot, Update.model_validate(update, context={'bot': main.bot}))
+        latencies.setdefault(kind, []).append(time.perf_counter() - started)
+
+    async def simulate_user(user_id):
+        for _ in range(args.rounds):
+            await feed('get_question', factory.callback(user_id, 'get_question'))
+            if random.random() < args.voice_ratio:
+                await feed('voice_answer', factory.voice(user_id))
+            else:
+                if random.random() < args.repeat_ratio:
+                    answer = repeated_answer
+                else:
+                    answer = ' '.join(random.choices(WORDS, k=args.answer_words))
+                await feed('text_answer', factory.text(user_id, answer))
+            await feed('check_stats', factory.callback(user_id, 'check_stats'))
+
+    monitor = LoopLagMonitor()
+    monitor.start()
+    async def run_broadcast():
+        broadcast_started = time.perf_counter()
+        results = await main.broadcast(main.outbound, lambda telegram_id: main.SendMessage(
+            chat_id=telegram_id, text="Рассылка нагрузочного теста"))
+        return {**results, 'elapsed_s': time.perf_counter() - broadcast_started}
+
+    started = time.perf_counter()
+    broadcasting = asyncio.create_task(run_broadcast()) if args.broadcast_users else None
+    await asyncio.gather(*(simulate_user(user_id) for user_id in users))
+    elapsed = time.perf_counter() - started
+    broadcast_report = await broadcasting if broadcasting else None
+    await monitor.stop()
+
+    await main.dp.emit_shutdown(bot=main.bot)
+    await main.bot.session.close()
+    await telegram.stop()
+    await openai.stop()
+    if redis is not None:
+        await redis.stop()
+    shutil.rmtree(workdir, ignore_errors=True)
+
+    total_updates = sum(len(values) for values in latencies.values())
+    return {
+        'scenario': vars(args),
+        'elapsed_s': elapsed,
+        'updates': total_updates,
+        'throughput_updates_per_s': total_updates / elapsed if elapsed else 0.0,
+        'handlers': {kind: summarize(values) for kind, values in sorted(latencies.items())},
+        'loop_lag': summarize(monitor.samples),
+        'telegram_requests': telegram.requests,
+        'openai_requests': openai.requests,
+        'openai_faults': openai.faults,
+        'telegram_flood_errors': telegram.flood_errors,
+        'broadcast': broadcast_report,
+    }
+
+
+def print_report(report):
+    print(f"Обновлений: {report['updates']} за {report['elapsed_s']:.2f} с "
+          f"({report['throughput_updates_per_s']:.1f} в секунду)")
+    print(f"Запросов к Bot API: {report['telegram_requests']}, к OpenAI: {report['openai_requests']} "
+          f"(внедрённых сбоев: {report['openai_faults']})")
+    if report['telegram_flood_errors'] or report['broadcast']:
+        print(f"Ответов 429 от Bot API: {report['telegram_flood_errors']}")
+    if report['broadcast']:
+        broadcast_report = report['broadcast']
+        print(f"Рассылка: доставлено {broadcast_report['ok']}, ошибок {broadcast_report['error']} "
+              f"за {broadcast_report['elapsed_s']:.2f} с")
+    header = f"{'обработчик':<14}{'count':>8}{'mean':>10}{'p50':>10}{'p95':>10}{'p99':>10}{'max':>10}"
+    print(header)
+    rows = list(report['handlers'].items()) + [('loop_lag', report['loop_lag'])]
+    for kind, stats in rows:
+        print(f"{kind:<14}{stats['count']:>8}{stats['mean_ms']:>10.1f}{stats['p50_ms']:>10.1f}"
+              f"{stats['p95_ms']:>10.1f}{stats['p99_ms']:>10.1f}{stats['max_ms']:>10.1f}")
+
+
+if __name__ == '__main__':
+    arguments = parse_args()
+    result = asyncio.run(run_benchmark(arguments))
+    if arguments.json:
+        print(json.dumps(result, ensure_ascii=False, indent=2))
+    else:
+        print_report(result)
@@ -0,0 +1,336 @@
+import asyncio
+import collections
+import itertools
+import json
+import random
+import time
+from aiohttp import web
+
+
+class StubServer:
+    """Базовый локальный HTTP-сервер на свободном порту."""
+
+    def __init__(self):
+        self.app = web.Application(client_max_size=32 * 1024 * 1024)
+        self.runner = None
+        self.url = None
+        self.requests = 0
+
+    async def start(self, host='127.0.0.1', port=0):
+        self.runner = web.AppRunner(self.app, access_log=None)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, host, port)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        self.url = f"http://{host}:{port}"
+        return self
+
+    async def stop(self):
+        if self.runner is not None:
+            await self.runner.cleanup()
+            self.runner = None
+
+
+class StubTelegramAPI(StubServer):
+    """Заглушка Bot API: принимает любые методы и отвечает правдоподобными объектами.
+
+    С rate_limit (сообщений в секунду на бота) и chat_limit (на чат) отправка и правка сообщений
+    сверх лимита за последнюю секунду получают 429 с retry_after, как при flood control Telegram.
+    """
+
+    def __init__(self, voice_size=16 * 1024, rate_limit=None, chat_limit=None):
+        super().__init__()
+        self.voice_bytes = random.randbytes(voice_size)
+        self.methods = {}
+        self.rate_limit = rate_limit
+        self.chat_limit = chat_limit
+        self.flood_errors = 0
+        self._sent_at = []
+        self._chat_sent_at = {}
+        self._message_ids = itertools.count(1)
+        self.app.router.add_post('/bot{token}/{method}', self.handle_method)
+        self.app.router.add_get('/file/bot{token}/{path:.+}', self.handle_file)
+
+    async def _read_params(self, request):
+        if request.content_type == 'application/json':
+            return await request.json()
+        return dict(await request.post())
+
+    async def handle_method(self, request):
+        self.requests += 1
+        method = request.match_info['method'].lower()
+        self.methods[method] = self.methods.get(method, 0) + 1
+        params = await self._read_params(request)
+        if method in ('sendmessage', 'editmessagetext'):
+            chat_id = int(params.get('chat_id', 0))
+            if self._flooded(chat_id):
+                self.flood_errors += 1
+                return web.json_response({'ok': False, 'error_code': 429, 'parameters': {'retry_after': 1},
+                                          'description': "Too Many Requests: retry after 1"})
+            result = {
+                'message_id': int(params.get('message_id') or next(self._message_ids)),
+                'date': int(time.time()),
+                'chat': {'id': chat_id, 'type': 'private'},
+                'from': {'id': 1, 'is_bot': True, 'first_name': 'bot'},
+                'text': params.get('text', ''),
+            }
+        elif method == 'getfile':
+            file_id = params.get('file_id', 'voice')
+            result = {'file_id': file_id, 'file_unique_id': file_id, 'file_size': len(self.voice_bytes),
+                      'file_path': f"voice/{file_id}.oga"}
+        elif method == 'getme':
+            result = {'id': 1, 'is_bot': True, 'first_name': 'bot', 'username': 'stub_bot'}
+        else:
+            result = True
+        return web.json_response({'ok': True, 'result': result})
+
+    # Скользящее окно в одну секунду: общее и для чата
+    def _flooded(self, chat_id):
+        if self.rate_limit is None and self.chat_limit is None:
+            return False
+        now = time.monotonic()
+        self._sent_at = [sent_at for sent_at in self._sent_at if now - sent_at < 1]
+        chat_sent_at = [sent_at for sent_at in self._chat_sent_at.get(chat_id, ()) if now - sent_at < 1]
+        self._chat_sent_at[chat_id] = chat_sent_at
+        if (self.rate_limit is not None and len(self._sent_at) >= self.rate_limit
+                or self.chat_limit is not None and len(chat_sent_at) >= self.chat_limit):
+            return True
+        self._sent_at.append(now)
+        chat_sent_at.append(now)
+        return False
+
+    async def handle_file(self, request):
+        self.requests += 1
+        return web.Response(body=self.voice_bytes, content_type='audio/ogg')
+
+
+class StubOpenAI(StubServer):
+    """Заглушка OpenAI API: проверка ответов и распознавание речи с настраиваемой задержкой.
+
+    Внедрение сбоев: error_rate - доля ответов 503, slow_rate - доля запросов с дополнительной
+    задержкой slow_latency, outage=True - все запросы завершаются ошибкой, failing_models - модели,
+    запросы к которым завершаются ошибкой, slow_next - сколько следующих запросов задержать на slow_latency.
+    В models считаются запросы проверки по запрошенной модели.
+    """
+
+    def __init__(self, latency=0.5, jitter=0.2, transcription_latency=0.3, error_rate=0.0, slow_rate=0.0,
+                 slow_latency=10.0):
+        super().__init__()
+        self.latency = latency
+        self.jitter = jitter
+        self.transcription_latency = transcription_latency
+        self.error_rate = error_rate
+        self.slow_rate = slow_rate
+        self.slow_latency = slow_latency
+        self.outage = False
+        self.failing_models = set()
+        self.slow_next = 0
+        self.faults = 0
+        self.models = collections.Counter()
+        self.app.router.add_post('/v1/chat/completions', self.handle_completion)
+        self.app.router.add_post('/v1/audio/transcriptions', self.handle_transcription)
+
+    async def _delay(self, latency):
+        await asyncio.sleep(max(0.0, random.uniform(latency - self.jitter, latency + self.jitter)))
+
+    # Ответ с ошибкой или None; медленные запросы просто задерживаются
+    async def _inject_fault(self, model=None):
+        if self.outage or model in self.failing_models or random.random() < self.error_rate:
+            self.faults += 1
+            return web.json_response({'error': {'message': 'injected failure', 'type': 'server_error'}}, status=503)
+        if self.slow_next > 0:
+            self.slow_next -= 1
+            self.faults += 1
+            await asyncio.sleep(self.slow_latency)
+        elif random.random() < self.slow_rate:
+            self.faults += 1
+            await asyncio.sleep(self.slow_latency)
+        return None
+
+    def completion_text(self):
+        verdict = random.choice(("Правильно", "Неправильно"))
+        return f"{verdict}. Ответ сравнён с эталоном, ключевые моменты раскрыты частично."
+
+    # Эталонный ответ в JSON, как его запрашивает reference_answers.py
+    @staticmethod
+    def reference_text(body):
+        question = body['messages'][-1]['content']
+        return json.dumps({'answer': f"Эталонный ответ: {question}",
+                           'key_points': ["первый ключевой пункт", "второй ключевой пункт"]}, ensure_ascii=False)
+
+    async def handle_completion(self, request):
+        self.requests += 1
+        body = await request.json()
+        self.models[body.get('model')] += 1
+        fault = await self._inject_fault(body.get('model'))
+        if fault is not None:
+            return fault
+        if body.get('stream'):
+            return await self.stream_completion(request, body)
+        await self._delay(self.latency)
+        if body.get('response_format', {}).get('type') == 'json_object':
+            content = self.reference_text(body)
+        else:
+            content = self.completion_text()
+        return web.json_response({
+            'id': f"chatcmpl-{self.requests}",
+            'object': 'chat.completion',
+            'created': int(time.time()),
+            'model': body.get('model', 'gpt-4o'),
+            'choices': [{'index': 0, 'finish_reason': 'stop',
+                         'message': {'role': 'assistant', 'content': content}}],
+            'usage': {'prompt_tokens': 0, 'completion_tokens': 0, 'total_tokens': 0},
+        })
+
+    # Потоковый ответ в формате SSE: первый фрагмент через треть задержки, остальные равномерно
+    async def stream_completion(self, request, body):
+        response = web.StreamResponse(headers={'Content-Type': 'text/event-stream'})
+        await response.prepare(request)
+        words = self.completion_text().split(' ')
+        await self._delay(self.latency / 3)
+        pause = self.latency * 2 / 3 / len(words)
+        for index, word in enumerate(words):
+            chunk = {
+                'id': f"chatcmpl-{self.requests}",
+                'object': 'chat.completion.chunk',
+                'created': int(time.time()),
+                'model': body.get('model', 'gpt-4o'),
+                'choices': [{'index': 0, 'finish_reason': None,
+                             'delta': {'content': word if index == 0 else ' ' + word}}],
+            }
+            await response.write(f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n".encode('utf-8'))
+            await asyncio.sleep(pause)
+        await response.write(b"data: [DONE]\n\n")
+        await response.write_eof()
+        return response
+
+    async def handle_transcription(self, request):
+        self.requests += 1
+        await request.read()
+        fault = await self._inject_fault()
+        if fault is not None:
+            return fault
+        await self._delay(self.transcription_latency)
+        return web.Response(text=json.dumps({'text': 'Распознанный голосовой ответ'}),
+                            content_type='application/json')
+
+
+class StubRedis:
+    """Локальная замена Redis: подмножество команд RESP, которым пользуется shared_state."""
+
+    def __init__(self):
+        self.values = {}
+        self.expires = {}
+        self.sorted_sets = {}
+        self.server = None
+        self.url = None
+        self.requests = 0
+
+    async def start(self, host='127.0.0.1', port=0):
+        self.server = await asyncio.start_server(self.handle_client, host, port)
+        port = self.server.sockets[0].getsockname()[1]
+        self.url = f"redis://{host}:{port}/0"
+        return self
+
+    async def stop(self):
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+            self.server = None
+
+    @staticmethod
+    async def _read_command(reader):
+        line = await reader.readline()
+        if not line:
+            return None
+        count = int(line[1:-2])
+        args = []
+        for _ in range(count):
+            length = int((await reader.readline())[1:-2])
+            args.append((await reader.readexactly(length + 2))[:-2].decode('utf-8'))
+        return args
+
+    @staticmethod
+    def _encode(value):
+        if value is None:
+            return b'$-1\r\n'
+        if isinstance(value, bool):
+            return b'+OK\r\n'
+        if isinstance(value, int):
+            return b':%d\r\n' % value
+        if isinstance(value, list):
+            return b'*%d\r\n' % len(value) + b''.join(StubRedis._encode(item) for item in value)
+        data = str(value).encode('utf-8')
+        return b'$%d\r\n%s\r\n' % (len(data), data)
+
+    async def handle_client(self, reader, writer):
+        try:
+            while True:
+                args = await self._read_command(reader)
+                if args is None:
+                    break
+                self.requests += 1
+                try:
+                    reply = self._encode(self.execute(args[0].upper(), args[1:]))
+                except Exception as e:
+                    reply = f"-ERR {e}\r\n".encode('utf-8')
+                writer.write(reply)
+                await writer.drain()
+        finally:
+            writer.close()
+
+    def _get(self, key):
+        expires = self.expires.get(key)
+        if expires is not None and expires <= time.time():
+            self.values.pop(key, None)
+            del self.expires[key]
+        return self.values.get(key)
+
+    def execute(self, command, args):
+        if command in ('PING', 'AUTH', 'SELECT'):
+            return True
+        if command == 'GET':
+            return self._get(args[0])
+        if command == 'SET':
+            key, value, options = args[0], args[1], [option.upper() for option in args[2:]]
+            previous = self._get(key)
+            self.values[key] = value
+            self.expires.pop(key, None)
+            if 'EX' in options:
+                self.expires[key] = time.time() + int(args[2 + options.index('EX') + 1])
+            return previous if 'GET' in options else True
+        if command == 'GETDEL':
+            value = self._get(args[0])
+            self.values.pop(args[0], None)
+            self.expires.pop(args[0], None)
+            return value
+        if command == 'DEL':
+            removed = 0
+            for key in args:
+                removed += int(self._get(key) is not None or key in self.sorted_sets)
+                self.values.pop(key, None)
+                self.expires.pop(key, None)
+                self.sorted_sets.pop(key, None)
+            return removed
+        if command == 'MGET':
+            return [self._get(key) for key in args]
+        if command == 'INCR':
+            value = int(self._get(args[0]) or 0) + 1
+            self.values[args[0]] = str(value)
+            return value
+        if command == 'ZADD':
+            members = self.sorted_sets.setdefault(args[0], {})
+            added = 0
+            for score, member in zip(args[1::2], args[2::2]):
+                added += int(member not in members)
+                members[member] = float(score)
+            return added
+        if command == 'ZREM':
+            members = self.sorted_sets.get(args[0], {})
+            return sum(members.pop(member, None) is not None for member in args[1:])
+        if command == 'ZRANGEBYSCORE':
+            low, high = float(args[1]), float(args[2])
+            members = self.sorted_sets.get(args[0], {})
+            return [member for member, score in sorted(members.items(), key=lambda item: item[1])
+                    if low <= score <= high]
+        raise ValueError(f"unknown command '{command}'")
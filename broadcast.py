@@ -0,0 +1,91 @@
+import asyncio
+import datetime
+import logging
+from aiogram.exceptions import TelegramForbiddenError
+import config
+from background import BackgroundTask
+from backend import load_users_batch
+from database import run_db
+from metrics import Counter
+from outbound import PRIORITY_BULK
+
+# Сколько пользователей читается из users.db за один запрос
+BROADCAST_BATCH_SIZE = getattr(config, 'BROADCAST_BATCH_SIZE', 200)
+
+BROADCAST_MESSAGES = Counter('bot_broadcast_messages_total', 'Сообщения рассылок по результату', ('result',))
+
+
+# Рассылка всем пользователям из users: пачки читаются по мере того, как очередь отправки освобождается,
+# поэтому в памяти одновременно не больше SEND_BULK_QUEUE_LIMIT сообщений.
+# build_method(telegram_id) возвращает метод aiogram; результат - {'ok': ..., 'blocked': ..., 'error': ...}
+async def broadcast(outbound, build_method, batch_size=BROADCAST_BATCH_SIZE):
+    results = {'ok': 0, 'blocked': 0, 'error': 0}
+    in_flight = set()
+
+    def on_done(future):
+        in_flight.discard(future)
+        if future.cancelled():
+            result = 'error'
+        elif isinstance(future.exception(), TelegramForbiddenError):
+            # Пользователь заблокировал бота
+            result = 'blocked'
+        elif future.exception() is not None:
+            result = 'error'
+        else:
+            result = 'ok'
+        results[result] += 1
+        BROADCAST_MESSAGES.labels(result).inc()
+
+    after_id = 0
+    while True:
+        batch = await run_db(load_users_batch, after_id, batch_size)
+        if not batch:
+            break
+        for _, telegram_id in batch:
+            future = await outbound.submit(telegram_id, build_method(telegram_id), PRIORITY_BULK)
+            in_flight.add(future)
+            future.add_done_callback(on_done)
+        after_id = batch[-1][0]
+    if in_flight:
+        await asyncio.wait(list(in_flight))
+    logging.info("Рассылка завершена: %s", results)
+    return results
+
+
+class DailyJob(BackgroundTask):
+    """Ежедневная задача в заданное время (HH:MM, местное время сервера).
+
+    Запуск за день захватывается через общее состояние, поэтому при нескольких
+    процессах бота задача выполняется один раз.
+    """
+
+    def __init__(self, state_backend, at, callback, name):
+        self.state_backend = state_backend
+        self.at = datetime.time.fromisoformat(at) if at else None
+        self.callback = callback
+        self.name = name
+        self.task_name = name
+
+    def _next_run(self, now):
+        run_at = datetime.datetime.combine(now.date(), self.at)
+        return run_at if run_at > now else run_at + datetime.timedelta(days=1)
+
+    async def _run(self):
+        while True:
+            run_at = self._next_run(datetime.datetime.now())
+            await asyncio.sleep((run_at - datetime.datetime.now()).total_seconds())
+            try:
+                if await self.state_backend.incr(f"{self.name}:{run_at.date().isoformat()}") != 1:
+                    logging.info("Задача %s за %s уже выполняется в другом процессе", self.name, run_at.date())
+                    continue
+                logging.info("Запуск задачи %s", self.name)
+                await self.callback()
+            except Exception as e:
+                logging.error("Ошибка при выполнении задачи %s: %s", self.name, e)
+
+    def _enabled(self):
+        return self.at is not None
+
+    async def start(self):
+        if await super().start():
+            logging.info("Задача %s запланирована на %s", self.name, self.at)
@@ -0,0 +1,75 @@
+import asyncio
+import functools
+import logging
+import sqlite3
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import config
+
+# Пути к базам данных можно переопределить в config.py
+USERS_DB = getattr(config, 'USERS_DB', 'users.db')
+QUESTIONS_DB = getattr(config, 'QUESTIONS_DB', 'questions.db')
+# Размер кэша подготовленных выражений на одно соединение
+STATEMENT_CACHE_SIZE = 256
+
+PRAGMAS = (
+    'PRAGMA journal_mode=WAL',
+    'PRAGMA synchronous=NORMAL',
+    'PRAGMA temp_store=MEMORY',
+    'PRAGMA cache_size=-16000',
+    'PRAGMA mmap_size=67108864',
+    'PRAGMA busy_timeout=5000',
+)
+
+# Вся работа с SQLite идёт в одном выделенном потоке: соединения и состояние в памяти
+# используются последовательно, а цикл событий бота не блокируется
+_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='db')
+_connections = {}
+_connections_lock = threading.Lock()
+
+
+def _open_connection(path):
+    conn = sqlite3.connect(path, check_same_thread=False, cached_statements=STATEMENT_CACHE_SIZE)
+    for pragma in PRAGMAS:
+        conn.execute(pragma)
+    logging.info("Открыто соединение с базой данных %s", path)
+    return conn
+
+
+# Долгоживущее соединение с базой; одинаковые строки SQL переиспользуют подготовленные выражения
+def get_connection(path):
+    conn = _connections.get(path)
+    if conn is None:
+        with _connections_lock:
+            conn = _connections.get(path)
+            if conn is None:
+                conn = _open_connection(path)
+                _connections[path] = conn
+    return conn
+
+
+def get_users_connection():
+    return get_connection(USERS_DB)
+
+
+def get_questions_connection():
+    return get_connection(QUESTIONS_DB)
+
+
+# Выполнение синхронной функции работы с базой в потоке базы данных
+async def run_db(func, *args, **kwargs):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_executor, functools.partial(func, *args, **kwargs))
+
+
+def close_connections():
+    with _connections_lock:
+        for path, conn in _connections.items():
+            conn.close()
+            logging.info("Закрыто соединение с базой данных %s", path)
+        _connections.clear()
+
+
+async def shutdown_db():
+    await run_db(close_connections)
+    _executor.shutdown(wait=True)
@@ -0,0 +1,225 @@
+import asyncio
+import logging
+import time
+import config
+from config import SYSTEM_PROMPT
+from llm_client import LLM_FALLBACK_MODEL, CircuitOpenError, ResilientLLM, get_async_client
+from database import run_db
+from grading_cache import grading_cache
+from metrics import CallbackGauge, Counter, Histogram, timed
+from middlewares import openai_limiter
+from pre_grader import pre_grader
+from reference_answers import reference_answers
+
+# Параметры проверки ответов можно переопределить в config.py
+GRADING_MODEL = getattr(config, 'GRADING_MODEL', "gpt-4o")
+GRADING_CONCURRENCY = getattr(config, 'GRADING_CONCURRENCY', 50)
+GRADING_TIMEOUT = getattr(config, 'GRADING_TIMEOUT', 30)
+# Потоковая проверка: вердикт показывается по первому предложению, объяснение дописывается по мере генерации
+GRADING_STREAMING = getattr(config, 'GRADING_STREAMING', True)
+# Для вопросов с эталонным ответом (reference_answers.py) хватает короткого сравнения и модели поменьше
+REFERENCE_GRADING_MODEL = getattr(config, 'REFERENCE_GRADING_MODEL', "gpt-4o-mini")
+REFERENCE_GRADING_PROMPT = getattr(config, 'REFERENCE_GRADING_PROMPT', (
+    "Сравни ответ кандидата с эталоном и ключевыми пунктами. Начни с 'Правильно.' или 'Неправильно.', "
+    "затем в 1-2 предложениях объясни, что упущено или неверно."
+))
+
+OPENAI_GRADING_SECONDS = Histogram('bot_openai_grading_seconds', 'Время проверки ответа в OpenAI')
+GRADING_RESULTS = Counter('bot_grading_results_total', 'Проверенные ответы по источнику вердикта', ('source',))
+GRADING_PROMPTS = Counter('bot_grading_prompts_total', 'Запросы к OpenAI по виду промпта', ('prompt',))
+CallbackGauge('bot_grading_cache_hit_ratio', 'Доля попаданий в кэш проверок',
+              lambda: grading_cache.stats()['hit_rate'])
+CallbackGauge('bot_grading_cache_saved_seconds', 'Оценка времени, сэкономленного кэшем проверок',
+              lambda: grading_cache.saved_seconds)
+
+# Повторы, хеджирование, предохранитель и резервная модель для запросов проверки
+chat_llm = ResilientLLM('chat', fallback_model=LLM_FALLBACK_MODEL)
+
+# Ограничение числа одновременных запросов к OpenAI
+_semaphore = None
+# Скользящая средняя длительности запроса к OpenAI, нужна для оценки экономии кэша
+_average_latency = GRADING_TIMEOUT / 10
+
+
+def _get_semaphore():
+    global _semaphore
+    if _semaphore is None:
+        _semaphore = asyncio.Semaphore(GRADING_CONCURRENCY)
+    return _semaphore
+
+
+# reference - (эталонный ответ, ключевые пункты) или None для полной проверки с SYSTEM_PROMPT
+def build_grading_messages(question, user_answer, reference=None):
+    if reference is None:
+        return [
+            {"role": "system", "content": SYSTEM_PROMPT},
+            {"role": "user", "content": f"Вопрос: {question}"},
+            {"role": "user", "content": f"Ответ: {user_answer}. Это ответ правильный?"}
+        ]
+    answer, key_points = reference
+    points = ''.join(f"\n- {point}" for point in key_points)
+    return [
+        {"role": "system", "content": REFERENCE_GRADING_PROMPT},
+        {"role": "user", "content": f"Вопрос: {question}\nЭталон: {answer}\nКлючевые пункты:{points}\n"
+                                    f"Ответ кандидата: {user_answer}"}
+    ]
+
+
+def grading_model(reference=None):
+    return GRADING_MODEL if reference is None else REFERENCE_GRADING_MODEL
+
+
+# Учёт отправленного на проверку запроса по виду промпта
+def count_grading_prompt(reference=None):
+    GRADING_PROMPTS.labels('full' if reference is None else 'reference').inc()
+
+
+# Разделяем ответ модели на вердикт и объяснение
+def parse_verdict(gpt_answer_content):
+    parts = gpt_answer_content.strip().split('.', 1)
+    correctness = parts[0].strip()
+    explanation = parts[1].strip() if len(parts) > 1 else ""
+    return correctness, explanation
+
+
+# Асинхронная проверка ответа: не блокирует цикл событий бота.
+# OpenAIThrottledError из ограничителя пробрасывается: ответ не проверен, и вопрос нужно вернуть пользователю
+@timed(OPENAI_GRADING_SECONDS)
+async def check_answer_async(question, user_answer, reference=None, user_id=None):
+    messages = build_grading_messages(question, user_answer, reference)
+    await openai_limiter.acquire(user_id)
+    try:
+        async with _get_semaphore():
+            count_grading_prompt(reference)
+            completion = await chat_llm.call(
+                lambda model, timeout: get_async_client().chat.completions.create(
+                    model=model, messages=messages, timeout=timeout),
+                grading_model(reference), GRADING_TIMEOUT)
+        correctness, explanation = parse_verdict(completion.choices[0].message.content)
+        logging.info("OpenAI response: %s", correctness)
+        return correctness, explanation
+    except asyncio.TimeoutError:
+        logging.error("Превышено время ожидания ответа OpenAI (%s с)", GRADING_TIMEOUT)
+        return "Ошибка", "Ошибка при обращении к API"
+    except CircuitOpenError as e:
+        logging.error("Проверка ответа недоступна: %s", e)
+        return "Ошибка", "Ошибка при обращении к API"
+    except Exception as e:
+        logging.error("Error checking answer with OpenAI: %s", e)
+        return "Ошибка", "Ошибка при обращении к API"
+
+
+# Потоковая проверка ответа: on_progress(correctness, explanation) вызывается, как только
+# пришло первое предложение с вердиктом, и дальше на каждом новом фрагменте объяснения.
+# Возвращает (correctness, explanation, complete); complete=False - поток оборвался после вердикта
+@timed(OPENAI_GRADING_SECONDS)
+async def stream_answer_async(question, user_answer, on_progress, reference=None, user_id=None):
+    content = ""
+    messages = build_grading_messages(question, user_answer, reference)
+    await openai_limiter.acquire(user_id)
+    deadline = time.monotonic() + GRADING_TIMEOUT
+    try:
+        async with _get_semaphore():
+            count_grading_prompt(reference)
+            # Повторы и хеджирование касаются открытия потока; обрыв посреди потока обрабатывается ниже
+            stream = await chat_llm.call(
+                lambda model, timeout: get_async_client().chat.completions.create(
+                    model=model, messages=messages, timeout=timeout, stream=True),
+                grading_model(reference), GRADING_TIMEOUT)
+            try:
+                chunks = aiter(stream)
+                while True:
+                    try:
+                        chunk = await asyncio.wait_for(anext(chunks), timeout=deadline - time.monotonic())
+                    except StopAsyncIteration:
+                        break
+                    delta = chunk.choices[0].delta.content if chunk.choices else None
+                    if not delta:
+                        continue
+                    content += delta
+                    if '.' in content:
+                        await on_progress(*parse_verdict(content))
+            finally:
+                await stream.close()
+        correctness, explanation = parse_verdict(content)
+        logging.info("OpenAI response: %s", correctness)
+        return correctness, explanation, True
+    except Exception as e:
+        if isinstance(e, asyncio.TimeoutError):
+            logging.error("Превышено время ожидания ответа OpenAI (%s с)", GRADING_TIMEOUT)
+        else:
+            logging.error("Error checking answer with OpenAI: %s", e)
+        if '.' in content:
+            # Вердикт уже получен и показан: оставляем его, но в кэш неполный ответ не попадёт
+            return (*parse_verdict(content), False)
+        return "Ошибка", "Ошибка при обращении к API", False
+
+
+async def _get_cached_verdict(question_id, user_answer):
+    cached = grading_cache.get_from_memory(question_id, user_answer)
+    if cached is None:
+        cached = await run_db(grading_cache.get_from_disk, question_id, user_answer)
+        if cached is not None:
+            grading_cache.remember(question_id, user_answer, *cached)
+    if cached is not None:
+        GRADING_RESULTS.labels('cache').inc()
+        grading_cache.record_saved(_average_latency)
+        logging.info("Вердикт для вопроса %s взят из кэша", question_id)
+    return cached
+
+
+# Уверенный локальный вердикт в рабочем режиме заменяет запрос к OpenAI, в теневом - только запоминается
+def _pre_grade(question_id, question, user_answer):
+    verdict = pre_grader.check(question_id, question, user_answer)
+    if verdict is not None and pre_grader.enforcing:
+        GRADING_RESULTS.labels('pre_grader').inc()
+        logging.info("Вердикт для вопроса %s вынесен предпроверкой (%s)", question_id, verdict[2])
+    return verdict
+
+
+async def _store_verdict(question_id, user_answer, correctness, explanation, started, complete=True,
+                         pre_verdict=None):
+    global _average_latency
+    if pre_verdict is not None and correctness != "Ошибка":
+        pre_grader.compare(pre_verdict, correctness)
+    _average_latency = 0.9 * _average_latency + 0.1 * (time.monotonic() - started)
+    GRADING_RESULTS.labels('error' if correctness == "Ошибка" else 'openai').inc()
+    if correctness != "Ошибка" and complete:
+        grading_cache.remember(question_id, user_answer, correctness, explanation)
+        await run_db(grading_cache.store, question_id, user_answer, correctness, explanation)
+
+
+# Проверка ответа с учётом кэша: повторные ответы на тот же вопрос не уходят в OpenAI
+async def grade_answer(question_id, question, user_answer, user_id=None):
+    cached = await _get_cached_verdict(question_id, user_answer)
+    if cached is not None:
+        return cached
+
+    pre_verdict = _pre_grade(question_id, question, user_answer)
+    if pre_verdict is not None and pre_grader.enforcing:
+        return pre_verdict[:2]
+
+    started = time.monotonic()
+    correctness, explanation = await check_answer_async(question, user_answer, reference_answers.get(question_id),
+                                                        user_id)
+    await _store_verdict(question_id, user_answer, correctness, explanation, started, pre_verdict=pre_verdict)
+    return correctness, explanation
+
+
+# То же с потоковой выдачей; вердикт из кэша передаётся в on_progress сразу целиком
+async def grade_answer_streaming(question_id, question, user_answer, on_progress, user_id=None):
+    cached = await _get_cached_verdict(question_id, user_answer)
+    if cached is not None:
+        await on_progress(*cached)
+        return cached
+
+    pre_verdict = _pre_grade(question_id, question, user_answer)
+    if pre_verdict is not None and pre_grader.enforcing:
+        await on_progress(*pre_verdict[:2])
+        return pre_verdict[:2]
+
+    started = time.monotonic()
+    correctness, explanation, complete = await stream_answer_async(question, user_answer, on_progress,
+                                                                   reference_answers.get(question_id), user_id)
+    await _store_verdict(question_id, user_answer, correctness, explanation, started, complete, pre_verdict)
+    return correctness, explanation
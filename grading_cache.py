@@ -0,0 +1,149 @@
+import hashlib
+import logging
+import re
+import time
+from collections import OrderedDict
+import config
+from database import get_connection
+
+# Параметры кэша проверок можно переопределить в config.py
+GRADING_CACHE_DB = getattr(config, 'GRADING_CACHE_DB', 'grading_cache.db')
+GRADING_CACHE_MEMORY_SIZE = getattr(config, 'GRADING_CACHE_MEMORY_SIZE', 10000)
+GRADING_CACHE_MAX_ROWS = getattr(config, 'GRADING_CACHE_MAX_ROWS', 200000)
+GRADING_CACHE_TTL = getattr(config, 'GRADING_CACHE_TTL', 30 * 24 * 3600)
+# Как часто (в записях) чистить устаревшие и лишние строки
+GRADING_CACHE_PRUNE_EVERY = 500
+
+_non_word_re = re.compile(r'[^\w]+')
+
+
+# Нормализация ответа: регистр, ё/е, пунктуация и лишние пробелы не влияют на ключ
+def normalize_answer(user_answer):
+    text = user_answer.lower().replace('ё', 'е')
+    return ' '.join(_non_word_re.sub(' ', text).split())
+
+
+def answer_fingerprint(user_answer):
+    return hashlib.blake2b(normalize_answer(user_answer).encode('utf-8'), digest_size=16).hexdigest()
+
+
+class GradingCache:
+    """Двухуровневый кэш вердиктов: LRU в памяти и SQLite на диске."""
+
+    def __init__(self, db_path=GRADING_CACHE_DB, memory_size=GRADING_CACHE_MEMORY_SIZE,
+                 max_rows=GRADING_CACHE_MAX_ROWS, ttl=GRADING_CACHE_TTL):
+        self.db_path = db_path
+        self.memory_size = memory_size
+        self.max_rows = max_rows
+        self.ttl = ttl
+        self._memory = OrderedDict()
+        self._conn = None
+        self._puts_since_prune = 0
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.stores = 0
+        self.saved_seconds = 0.0
+
+    def _connect(self):
+        if self._conn is None:
+            self._conn = get_connection(self.db_path)
+            self._conn.execute('''CREATE TABLE IF NOT EXISTS grading_cache (
+                                    question_id INTEGER,
+                                    fingerprint TEXT,
+                                    correctness TEXT,
+                                    explanation TEXT,
+                                    created_at REAL,
+                                    PRIMARY KEY (question_id, fingerprint))''')
+            self._conn.execute('CREATE INDEX IF NOT EXISTS idx_grading_cache_created_at '
+                               'ON grading_cache (created_at)')
+            self._conn.commit()
+        return self._conn
+
+    def _remember(self, key, verdict):
+        self._memory[key] = verdict
+        self._memory.move_to_end(key)
+        if len(self._memory) > self.memory_size:
+            self._memory.popitem(last=False)
+
+    # Поиск в памяти: выполняется прямо в цикле событий
+    def get_from_memory(self, question_id, user_answer):
+        key = (question_id, answer_fingerprint(user_answer))
+        verdict = self._memory.get(key)
+        if verdict is not None:
+            self._memory.move_to_end(key)
+            self.memory_hits += 1
+        return verdict
+
+    # Поиск на диске: выполняется в потоке базы данных, память не изменяет
+    def get_from_disk(self, question_id, user_answer):
+        row = self._connect().execute(
+            'SELECT correctness, explanation FROM grading_cache '
+            'WHERE question_id = ? AND fingerprint = ? AND created_at > ?',
+            (question_id, answer_fingerprint(user_answer), time.time() - self.ttl)).fetchone()
+        if row:
+            self.disk_hits += 1
+            return row[0], row[1]
+        self.misses += 1
+        return None
+
+    def remember(self, question_id, user_answer, correctness, explanation):
+        self._remember((question_id, answer_fingerprint(user_answer)), (correctness, explanation))
+
+    def store(self, question_id, user_answer, correctness, explanation):
+        conn = self._connect()
+        with conn:
+            conn.execute('INSERT OR REPLACE INTO grading_cache '
+                         '(question_id, fingerprint, correctness, explanation, created_at) VALUES (?, ?, ?, ?, ?)',
+                         (question_id, answer_fingerprint(user_answer), correctness, explanation, time.time()))
+        self.stores += 1
+        self._puts_since_prune += 1
+        if self._puts_since_prune >= GRADING_CACHE_PRUNE_EVERY:
+            self.prune()
+
+    def get(self, question_id, user_answer):
+        verdict = self.get_from_memory(question_id, user_answer)
+        if verdict is None:
+            verdict = self.get_from_disk(question_id, user_answer)
+            if verdict is not None:
+                self.remember(question_id, user_answer, *verdict)
+        return verdict
+
+    def put(self, question_id, user_answer, correctness, explanation):
+        self.remember(question_id, user_answer, correctness, explanation)
+        self.store(question_id, user_answer, correctness, explanation)
+
+    # Удаление устаревших записей и самых старых записей сверх лимита
+    def prune(self):
+        self._puts_since_prune = 0
+        conn = self._connect()
+        with conn:
+            conn.execute('DELETE FROM grading_cache WHERE created_at <= ?', (time.time() - self.ttl,))
+            conn.execute('''DELETE FROM grading_cache WHERE rowid IN (
+                                SELECT rowid FROM grading_cache ORDER BY created_at DESC LIMIT -1 OFFSET ?)''',
+                         (self.max_rows,))
+
+    # Учёт сэкономленного времени: попадание в кэш экономит один запрос к API
+    def record_saved(self, seconds):
+        self.saved_seconds += seconds
+
+    def stats(self):
+        hits = self.memory_hits + self.disk_hits
+        lookups = hits + self.misses
+        return {
+            'memory_hits': self.memory_hits,
+            'disk_hits': self.disk_hits,
+            'misses': self.misses,
+            'stores': self.stores,
+            'hit_rate': hits / lookups if lookups else 0.0,
+            'saved_api_calls': hits,
+            'saved_seconds': self.saved_seconds,
+        }
+
+    # Соединение общее и закрывается модулем database
+    def close(self):
+        logging.info("Статистика кэша проверок: %s", self.stats())
+        self._conn = None
+
+
+grading_cache = GradingCache()
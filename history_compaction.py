@@ -0,0 +1,106 @@
+import argparse
+import asyncio
+import logging
+import sqlite3
+import time
+import config
+from background import BackgroundTask
+from database import USERS_DB, get_users_connection, run_db
+from metrics import Counter, Histogram, timed
+from migrations import migrate
+
+# Сколько дней хранятся отдельные попытки в answered_questions; итоги по ним остаются в question_history
+HISTORY_RETENTION_DAYS = getattr(config, 'HISTORY_RETENTION_DAYS', 30)
+# Как часто бот удаляет старые попытки, в секундах; None - сжатие только вручную
+HISTORY_COMPACTION_INTERVAL = getattr(config, 'HISTORY_COMPACTION_INTERVAL', 6 * 3600)
+# Строк за одну транзакцию: поток базы данных не занят надолго и успевает обслуживать бота
+HISTORY_COMPACTION_BATCH = 5000
+
+COMPACTED_ANSWERS = Counter('bot_compacted_answers_total', 'Старые попытки, удалённые из answered_questions')
+COMPACTION_SECONDS = Histogram('bot_history_compaction_seconds', 'Время одной пачки сжатия истории ответов')
+
+
+# Удаление одной пачки попыток старше cutoff; возвращает число удалённых строк
+@timed(COMPACTION_SECONDS)
+def compact_batch(conn, cutoff, batch_size=HISTORY_COMPACTION_BATCH):
+    with conn:
+        deleted = conn.execute('''DELETE FROM answered_questions WHERE id IN
+                                  (SELECT id FROM answered_questions WHERE answered_at < ? LIMIT ?)''',
+                               (cutoff, batch_size)).rowcount
+    COMPACTED_ANSWERS.inc(deleted)
+    return deleted
+
+
+def compact_history(conn, retention_days=HISTORY_RETENTION_DAYS, batch_size=HISTORY_COMPACTION_BATCH):
+    cutoff = time.time() - retention_days * 24 * 3600
+    total = 0
+    while True:
+        deleted = compact_batch(conn, cutoff, batch_size)
+        total += deleted
+        if deleted < batch_size:
+            break
+    # Обновляем статистику планировщика запросов после массового удаления
+    conn.execute('PRAGMA optimize')
+    return total
+
+
+class HistoryCompactor(BackgroundTask):
+    """Периодически удаляет из answered_questions попытки старше HISTORY_RETENTION_DAYS.
+
+    Каждая пачка выполняется отдельным заданием в потоке базы данных, между пачками
+    успевают пройти запросы обработчиков бота.
+    """
+
+    task_name = "history_compactor"
+
+    def __init__(self, interval=HISTORY_COMPACTION_INTERVAL, retention_days=HISTORY_RETENTION_DAYS,
+                 batch_size=HISTORY_COMPACTION_BATCH):
+        self.interval = interval
+        self.retention_days = retention_days
+        self.batch_size = batch_size
+
+    async def compact(self):
+        cutoff = time.time() - self.retention_days * 24 * 3600
+        total = 0
+        while True:
+            deleted = await run_db(compact_batch, get_users_connection(), cutoff, self.batch_size)
+            total += deleted
+            if deleted < self.batch_size:
+                break
+        if total:
+            await run_db(get_users_connection().execute, 'PRAGMA optimize')
+            logging.info("Удалено старых попыток из истории ответов: %s", total)
+        return total
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.compact()
+            except Exception as e:
+                logging.error("Ошибка при сжатии истории ответов: %s", e)
+
+    def _enabled(self):
+        return self.interval is not None
+
+
+history_compactor = HistoryCompactor()
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description="Сжатие истории ответов в users.db")
+    parser.add_argument('--database', default=USERS_DB, help="путь к базе пользователей")
+    parser.add_argument('--retention-days', type=float, default=HISTORY_RETENTION_DAYS,
+                        help="сколько дней хранить отдельные попытки")
+    parser.add_argument('--vacuum', action='store_true',
+                        help="после сжатия вернуть освободившееся место системе (блокирует базу)")
+    args = parser.parse_args()
+    conn = sqlite3.connect(args.database, timeout=30)
+    conn.execute('PRAGMA journal_mode=WAL')
+    print(f"Версия схемы: {migrate(conn)}")
+    print(f"Удалено попыток: {compact_history(conn, args.retention_days)}")
+    if args.vacuum:
+        conn.execute('VACUUM')
+        print("База перепакована")
+    conn.close()
@@ -1,24 +1,16 @@
 import sqlite3
 import logging
+from migrations import migrate
 
 # Настройка логирования
 logging.basicConfig(level=logging.INFO)
 
-def create_user_table():
+# Схема users.db описана в migrations.py: новая база создаётся, существующая обновляется до последней версии
+def migrate_users_db():
     conn = sqlite3.connect('users.db')
-    c = conn.cursor()
-    c.execute('''CREATE TABLE IF NOT EXISTS users
-                 (id INTEGER PRIMARY KEY, telegram_id INTEGER UNIQUE, correct_answers INTEGER, total_answers INTEGER)''')
-    conn.commit()
-    conn.close()
-
-def create_answered_questions_table():
-    conn = sqlite3.connect('users.db')
-    c = conn.cursor()
-    c.execute('''CREATE TABLE IF NOT EXISTS answered_questions
-                 (id INTEGER PRIMARY KEY, telegram_id INTEGER, question_id INTEGER, correct BOOLEAN)''')
-    conn.commit()
+    version = migrate(conn)
     conn.close()
+    return version
 
 def create_questions_table():
     conn = sqlite3.connect('questions.db')
@@ -49,20 +41,16 @@ def check_table_exists(database, table_name):
     return table_exists is not None
 
 if __name__ == '__main__':
-    create_user_table()
-    create_answered_questions_table()
+    print(f"Версия схемы users.db: {migrate_users_db()}")
     create_questions_table()
     insert_sample_questions()
 
-    if check_table_exists('users.db', 'users'):
-        print("Таблица 'users' успешно создана.")
-    else:
-        print("Ошибка создания таблицы 'users'.")
-
-    if check_table_exists('users.db', 'answered_questions'):
-        print("Таблица 'answered_questions' успешно создана.")
-    else:
-        print("Ошибка создания таблицы 'answered_questions'.")
+    for table_name in ('users', 'answered_questions', 'question_history', 'review_schedule', 'user_category_stats',
+                       'pending_questions', 'shared_state'):
+        if check_table_exists('users.db', table_name):
+            print(f"Таблица '{table_name}' успешно создана.")
+        else:
+            print(f"Ошибка создания таблицы '{table_name}'.")
 
     if check_table_exists('questions.db', 'questions'):
         print("Таблица 'questions' успешно создана.")
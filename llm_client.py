@@ -0,0 +1,327 @@
+import asyncio
+import collections
+import logging
+import random
+import time
+import httpx
+import openai
+from openai import AsyncOpenAI
+import config
+from config import OPENAI_API_KEY
+from metrics import CallbackGauge, Counter
+
+# Параметры клиента можно переопределить в config.py
+OPENAI_BASE_URL = getattr(config, 'OPENAI_BASE_URL', "https://api.proxyapi.ru/openai/v1")
+OPENAI_MAX_CONNECTIONS = getattr(config, 'OPENAI_MAX_CONNECTIONS', 100)
+OPENAI_MAX_KEEPALIVE_CONNECTIONS = getattr(config, 'OPENAI_MAX_KEEPALIVE_CONNECTIONS', 20)
+OPENAI_KEEPALIVE_EXPIRY = getattr(config, 'OPENAI_KEEPALIVE_EXPIRY', 60)
+OPENAI_TIMEOUT = getattr(config, 'OPENAI_TIMEOUT', 30)
+# Повторы, хеджирование и предохранитель для запросов к OpenAI
+LLM_MAX_RETRIES = getattr(config, 'LLM_MAX_RETRIES', 2)
+LLM_BACKOFF_BASE = getattr(config, 'LLM_BACKOFF_BASE', 0.5)
+LLM_BACKOFF_MAX = getattr(config, 'LLM_BACKOFF_MAX', 4.0)
+# Второй запрос отправляется, если первый идёт дольше p95 (но не раньше LLM_HEDGE_MIN_DELAY секунд)
+LLM_HEDGE_QUANTILE = getattr(config, 'LLM_HEDGE_QUANTILE', 0.95)
+LLM_HEDGE_MIN_DELAY = getattr(config, 'LLM_HEDGE_MIN_DELAY', 1.0)
+LLM_HEDGE_MIN_SAMPLES = 20
+LLM_BREAKER_FAILURES = getattr(config, 'LLM_BREAKER_FAILURES', 5)
+LLM_BREAKER_RESET = getattr(config, 'LLM_BREAKER_RESET', 30)
+# Более дешёвая модель, на которую переключаемся, когда основная недоступна; None - без замены
+LLM_FALLBACK_MODEL = getattr(config, 'LLM_FALLBACK_MODEL', "gpt-4o-mini")
+# Предельная длительность одной попытки: медленный прокси не должен съедать весь дедлайн вызова
+LLM_ATTEMPT_TIMEOUT = getattr(config, 'LLM_ATTEMPT_TIMEOUT', 10)
+# Доля дедлайна вызова, которая остаётся резервной модели
+LLM_FALLBACK_BUDGET = getattr(config, 'LLM_FALLBACK_BUDGET', 0.3)
+# Попытки, на которые остаётся меньше этого времени, не начинаются
+LLM_MIN_ATTEMPT_SECONDS = getattr(config, 'LLM_MIN_ATTEMPT_SECONDS', 1.0)
+
+# Ошибки, после которых запрос имеет смысл повторить
+RETRYABLE_ERRORS = (openai.APIConnectionError, openai.RateLimitError, openai.InternalServerError,
+                    asyncio.TimeoutError, TimeoutError)
+
+LLM_REQUESTS = Counter('bot_llm_requests_total', 'Запросы к OpenAI по результату', ('endpoint', 'model', 'outcome'))
+LLM_RETRIES = Counter('bot_llm_retries_total', 'Повторные запросы к OpenAI после ошибки', ('endpoint',))
+LLM_HEDGES = Counter('bot_llm_hedges_total', 'Хеджирующие запросы к OpenAI: отправленные и выигравшие',
+                     ('endpoint', 'result'))
+LLM_FALLBACKS = Counter('bot_llm_fallbacks_total', 'Переключения на резервную модель', ('endpoint',))
+LLM_BREAKER_TRIPS = Counter('bot_llm_breaker_trips_total', 'Размыкания предохранителя', ('endpoint', 'model'))
+
+# Общий долгоживущий клиент: одно пулированное HTTP-соединение на весь процесс
+_async_client = None
+
+
+def get_async_client():
+    global _async_client
+    if _async_client is None:
+        http_client = httpx.AsyncClient(
+            limits=httpx.Limits(max_connections=OPENAI_MAX_CONNECTIONS,
+                                max_keepalive_connections=OPENAI_MAX_KEEPALIVE_CONNECTIONS,
+                                keepalive_expiry=OPENAI_KEEPALIVE_EXPIRY),
+            timeout=OPENAI_TIMEOUT)
+        # Повторы выполняет ResilientLLM, собственные повторы клиента отключены
+        _async_client = AsyncOpenAI(api_key=OPENAI_API_KEY, base_url=OPENAI_BASE_URL, timeout=OPENAI_TIMEOUT,
+                                    http_client=http_client, max_retries=0)
+        logging.info("Создан общий клиент OpenAI для %s", OPENAI_BASE_URL)
+    return _async_client
+
+
+async def close_async_client():
+    global _async_client
+    if _async_client is not None:
+        await _async_client.close()
+        _async_client = None
+        logging.info("Общий клиент OpenAI закрыт")
+
+
+class CircuitOpenError(Exception):
+    pass
+
+
+class CircuitBreaker:
+    """Предохранитель: после серии ошибок запросы на время отклоняются сразу, без ожидания таймаута.
+
+    Через reset_timeout секунд пропускается один пробный запрос: его успех замыкает предохранитель,
+    ошибка - снова размыкает.
+    """
+
+    def __init__(self, endpoint, model, failure_threshold=LLM_BREAKER_FAILURES, reset_timeout=LLM_BREAKER_RESET):
+        self.endpoint = endpoint
+        self.model = model
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self._probing = False
+
+    @property
+    def is_open(self):
+        return self.opened_at is not None
+
+    def allow(self):
+        if self.opened_at is None:
+            return True
+        if time.monotonic() - self.opened_at >= self.reset_timeout and not self._probing:
+            self._probing = True
+            return True
+        return False
+
+    def record_success(self):
+        if self.opened_at is not None:
+            logging.info("Предохранитель %s/%s замкнут", self.endpoint, self.model)
+        self.failures = 0
+        self.opened_at = None
+        self._probing = False
+
+    def record_failure(self):
+        self.failures += 1
+        if self._probing or (self.opened_at is None and self.failures >= self.failure_threshold):
+            self.opened_at = time.monotonic()
+            self._probing = False
+            LLM_BREAKER_TRIPS.labels(self.endpoint, self.model).inc()
+            logging.warning("Предохранитель %s/%s разомкнут после %s ошибок", self.endpoint, self.model, self.failures)
+
+    # Пробный запрос отменён, не дойдя до результата: следующий запрос сможет стать пробным
+    def release(self):
+        self._probing = False
+
+
+class LatencyTracker:
+    """Скользящее окно длительностей успешных запросов для оценки квантилей."""
+
+    def __init__(self, size=200):
+        self._samples = collections.deque(maxlen=size)
+
+    def observe(self, seconds):
+        self._samples.append(seconds)
+
+    def quantile(self, fraction):
+        if len(self._samples) < LLM_HEDGE_MIN_SAMPLES:
+            return None
+        ordered = sorted(self._samples)
+        return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+_breakers = []
+CallbackGauge('bot_llm_breakers_open', 'Число разомкнутых предохранителей OpenAI',
+              lambda: sum(breaker.is_open for breaker in _breakers))
+
+
+def _discard(result):
+    # Проигравший хедж-запрос мог успеть вернуть поток: закрываем его, чтобы освободить соединение
+    close = getattr(result, 'close', None)
+    if close is not None:
+        closing = close()
+        if asyncio.iscoroutine(closing):
+            asyncio.ensure_future(closing)
+
+
+class ResilientLLM:
+    """Общий для проверки ответов и распознавания речи слой надёжности запросов к OpenAI.
+
+    request(model, timeout) - функция, создающая корутину запроса. Вызов укладывается в общий
+    дедлайн: повторы с экспоненциальной задержкой и джиттером, хедж-запрос при превышении p95,
+    предохранитель на каждую модель и переход на резервную модель, если основная недоступна.
+    Каждая попытка ограничена LLM_ATTEMPT_TIMEOUT, а LLM_FALLBACK_BUDGET дедлайна достаётся
+    резервной модели; если на неё не осталось времени, она не вызывается и её предохранитель не страдает.
+    """
+
+    def __init__(self, endpoint, fallback_model=None, max_retries=LLM_MAX_RETRIES, hedge=True):
+        self.endpoint = endpoint
+        self.fallback_model = fallback_model
+        self.max_retries = max_retries
+        self.hedge = hedge
+        self.latency = LatencyTracker()
+        self._breakers = {}
+
+    def breaker(self, model):
+        breaker = self._breakers.get(model)
+        if breaker is None:
+            breaker = self._breakers[model] = CircuitBreaker(self.endpoint, model)
+            _breakers.append(breaker)
+        return breaker
+
+    def _models(self, model):
+        if self.fallback_model and self.fallback_model != model:
+            return model, self.fallback_model
+        return (model,)
+
+    def _backoff(self, attempt):
+        return random.uniform(0, min(LLM_BACKOFF_MAX, LLM_BACKOFF_BASE * 2 ** attempt))
+
+    # Дедлайн модели с номером index: основной модели - общий дедлайн за вычетом резерва для следующей
+    def _model_deadline(self, models, index, deadline, timeout):
+        return deadline if index == len(models) - 1 else deadline - timeout * LLM_FALLBACK_BUDGET
+
+    def _no_time_left(self, index, deadline):
+        if index and deadline - time.monotonic() < LLM_MIN_ATTEMPT_SECONDS:
+            logging.warning("На запрос %s к резервной модели не осталось времени", self.endpoint)
+            return True
+        return False
+
+    def _hedge_delay(self):
+        if not self.hedge:
+            return None
+        quantile = self.latency.quantile(LLM_HEDGE_QUANTILE)
+        return None if quantile is None else max(quantile, LLM_HEDGE_MIN_DELAY)
+
+    async def call(self, request, model, timeout):
+        deadline = time.monotonic() + timeout
+        error = None
+        models = self._models(model)
+        for index, current_model in enumerate(models):
+            if self._no_time_left(index, deadline):
+                break
+            breaker = self.breaker(current_model)
+            if not breaker.allow():
+                error = CircuitOpenError(f"{self.endpoint}/{current_model}: предохранитель разомкнут")
+                continue
+            if index:
+                LLM_FALLBACKS.labels(self.endpoint).inc()
+                logging.warning("Запрос %s переключён на резервную модель %s", self.endpoint, current_model)
+            try:
+                return await self._call_with_retries(request, current_model,
+                                                     self._model_deadline(models, index, deadline, timeout), breaker)
+            except RETRYABLE_ERRORS as e:
+                error = e
+        raise error
+
+    async def _call_with_retries(self, request, model, deadline, breaker):
+        attempt = 0
+        while True:
+            try:
+                result = await self._hedged(request, model, min(deadline, time.monotonic() + LLM_ATTEMPT_TIMEOUT))
+            except RETRYABLE_ERRORS as e:
+                outcome = 'timeout' if isinstance(e, (asyncio.TimeoutError, TimeoutError, openai.APITimeoutError)) \
+                    else 'error'
+                LLM_REQUESTS.labels(self.endpoint, model, outcome).inc()
+                breaker.record_failure()
+                delay = self._backoff(attempt)
+                if (attempt >= self.max_retries or breaker.is_open
+                        or time.monotonic() + delay + LLM_MIN_ATTEMPT_SECONDS > deadline):
+                    raise
+                attempt += 1
+                LLM_RETRIES.labels(self.endpoint).inc()
+                logging.warning("Ошибка запроса %s (%s), повтор %s через %.2f с", self.endpoint, e, attempt, delay)
+                await asyncio.sleep(delay)
+                continue
+            except BaseException:
+                breaker.release()
+                raise
+            LLM_REQUESTS.labels(self.endpoint, model, 'success').inc()
+            breaker.record_success()
+            return result
+
+    async def _hedged(self, request, model, deadline):
+        started = time.monotonic()
+        primary = asyncio.ensure_future(request(model, max(0.0, deadline - started)))
+        pending = {primary}
+        error = None
+        try:
+            hedge_delay = self._hedge_delay()
+            if hedge_delay is not None and started + hedge_delay < deadline:
+                done, pending = await asyncio.wait(pending, timeout=hedge_delay)
+                if not done:
+                    LLM_HEDGES.labels(self.endpoint, 'launched').inc()
+                    pending.add(asyncio.ensure_future(request(model, max(0.0, deadline - time.monotonic()))))
+                else:
+                    pending = done
+            while pending:
+                done, pending = await asyncio.wait(pending, timeout=max(0.0, deadline - time.monotonic()),
+                                                   return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    raise asyncio.TimeoutError()
+                winner = None
+                for task in done:
+                    if task.exception() is not None:
+                        error = task.exception()
+                    elif winner is None:
+                        winner = task
+                    else:
+                        _discard(task.result())
+                if winner is not None:
+                    if winner is not primary:
+                        LLM_HEDGES.labels(self.endpoint, 'won').inc()
+                    self.latency.observe(time.monotonic() - started)
+                    return winner.result()
+            raise error
+        finally:
+            for task in pending:
+                task.cancel()
+
+    # Синхронный вариант для кода вне цикла событий: повторы, предохранитель и резервная модель без хеджирования
+    def call_sync(self, request, model, timeout):
+        deadline = time.monotonic() + timeout
+        error = None
+        models = self._models(model)
+        for index, current_model in enumerate(models):
+            if self._no_time_left(index, deadline):
+                break
+            model_deadline = self._model_deadline(models, index, deadline, timeout)
+            breaker = self.breaker(current_model)
+            if not breaker.allow():
+                error = CircuitOpenError(f"{self.endpoint}/{current_model}: предохранитель разомкнут")
+                continue
+            if index:
+                LLM_FALLBACKS.labels(self.endpoint).inc()
+            for attempt in range(self.max_retries + 1):
+                try:
+                    result = request(current_model,
+                                     max(0.0, min(LLM_ATTEMPT_TIMEOUT, model_deadline - time.monotonic())))
+                except RETRYABLE_ERRORS as e:
+                    LLM_REQUESTS.labels(self.endpoint, current_model, 'error').inc()
+                    breaker.record_failure()
+                    error = e
+                    delay = self._backoff(attempt)
+                    if breaker.is_open or time.monotonic() + delay + LLM_MIN_ATTEMPT_SECONDS > model_deadline:
+                        break
+                    if attempt < self.max_retries:
+                        LLM_RETRIES.labels(self.endpoint).inc()
+                        time.sleep(delay)
+                    continue
+                except BaseException:
+                    breaker.release()
+                    raise
+                LLM_REQUESTS.labels(self.endpoint, current_model, 'success').inc()
+                breaker.record_success()
+                return result
+        raise error
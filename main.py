@@ -1,31 +1,88 @@
-import logging
 import asyncio
-import os
-import ffmpeg
+import logging
+import multiprocessing
+import socket
+import time
+import uuid
+from aiohttp import web
 from aiogram import Bot, Dispatcher, Router, types
-from aiogram.filters import Command
+from aiogram.exceptions import TelegramAPIError, TelegramRetryAfter
+from aiogram.filters import Command, CommandObject
+from aiogram.methods import SendMessage
 from aiogram.types import Message, CallbackQuery
-from aiogram.fsm.storage.memory import MemoryStorage
-from backend import register_user, get_random_question, update_user_stats, check_answer_with_openai, \
-    calculate_user_stats
-from config import API_TOKEN, ANSWER_TIMEOUT, OPENAI_API_KEY
-from openai import OpenAI
-import json
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
+import config
+import metrics
+from answer_writer import answer_writer
+from backend import register_user, get_random_question, get_user_stats_report, forget_user_state, \
+    apply_users_migrations
+from broadcast import DailyJob, broadcast
+from database import run_db, shutdown_db
+from grading import GRADING_STREAMING, grade_answer, grade_answer_streaming
+from grading_cache import grading_cache
+from history_compaction import history_compactor
+from llm_client import close_async_client
+from metrics import Counter, Histogram, start_metrics_server, stop_metrics_server
+from middlewares import GLOBAL_THROTTLED_TEXT, CoalescingMiddleware, OpenAIThrottledError, UserLockMiddleware, \
+    openai_limiter
+from outbound import SEND_GLOBAL_BURST, SEND_GLOBAL_RATE, SEND_MAX_RETRIES, PRIORITY_NOTICE, OutboundQueue
+from pre_grader import pre_grader
+from question_sampler import question_sampler
+from reference_answers import reference_answers
+from shared_state import create_state_backend, SharedStorage, ExpirySweeper
+from spaced_repetition import SCHEDULING_MODE
+from timeouts import TimeoutScheduler
+from voice import transcribe_voice, shutdown_transcoder
+from config import API_TOKEN, ANSWER_TIMEOUT
 import re
 
+# Режим вебхука включается заданием WEBHOOK_URL (публичный адрес бота без пути)
+WEBHOOK_URL = getattr(config, 'WEBHOOK_URL', None)
+WEBHOOK_PATH = getattr(config, 'WEBHOOK_PATH', '/webhook')
+WEBHOOK_HOST = getattr(config, 'WEBHOOK_HOST', '0.0.0.0')
+WEBHOOK_PORT = getattr(config, 'WEBHOOK_PORT', 8080)
+WEBHOOK_SECRET = getattr(config, 'WEBHOOK_SECRET', None)
+# Число процессов, принимающих вебхуки на одном порту
+WEBHOOK_WORKERS = getattr(config, 'WEBHOOK_WORKERS', 1)
+# Минимальный интервал между правками сообщения с объяснением при потоковой проверке, в секундах
+GRADING_EDIT_INTERVAL = getattr(config, 'GRADING_EDIT_INTERVAL', 1.5)
+# Пользователи, которым доступна команда /broadcast
+ADMIN_IDS = getattr(config, 'ADMIN_IDS', ())
+# Время ежедневной рассылки вопроса дня (HH:MM, местное время сервера); None - рассылка выключена
+QUESTION_OF_THE_DAY_TIME = getattr(config, 'QUESTION_OF_THE_DAY_TIME', None)
+
 # Настройка логирования
 logging.basicConfig(level=logging.INFO)
 
 # Инициализация бота, диспетчера и маршрутизатора
 bot = Bot(token=API_TOKEN)
-storage = MemoryStorage()
+# Выданные вопросы и состояние FSM хранятся вне процесса: ответ может прийти в любой процесс бота
+state_backend = create_state_backend()
+storage = SharedStorage(state_backend)
 dp = Dispatcher(storage=storage)
 router = Router()
 dp.include_router(router)
 
-# Глобальный словарь для хранения данных о вопросах пользователя
-bot_data = {}
-tasks = {}
+# Повторные нажатия схлопываются, а ответы одного пользователя проверяются по очереди;
+# поведение задаётся флагами обработчиков. Частота запросов к OpenAI ограничивается openai_limiter
+coalescing_middleware = CoalescingMiddleware()
+user_lock_middleware = UserLockMiddleware()
+for observer in (router.message, router.callback_query):
+    observer.middleware(coalescing_middleware)
+    observer.middleware(user_lock_middleware)
+
+# Все сообщения пользователям идут через общую очередь с учётом ограничений Telegram;
+# общий лимит бота делится между процессами, принимающими вебхуки
+outbound = OutboundQueue(bot, global_rate=SEND_GLOBAL_RATE / WEBHOOK_WORKERS,
+                         global_burst=max(1, SEND_GLOBAL_BURST // WEBHOOK_WORKERS))
+# Запущенные командой /broadcast рассылки, отменяются при остановке бота
+broadcast_tasks = set()
+
+# Версии данных пользователей, по которым процесс понимает, что его кэш в памяти устарел
+user_versions = {}
+
+ANSWER_TIMEOUTS = Counter('bot_answer_timeouts_total', 'Вопросы, время на ответ по которым истекло')
+VERDICT_SHOWN_SECONDS = Histogram('bot_verdict_shown_seconds', 'Время от начала проверки ответа до показа вердикта')
 
 
 # Функция для экранирования специальных символов в MarkdownV2
@@ -43,172 +100,456 @@ def main_menu():
     return markup
 
 
+# При нескольких процессах ответ пользователя мог быть учтён в другом процессе:
+# тогда состояние пользователя в памяти сбрасывается и читается из базы заново
+async def sync_user_state(user_id):
+    if WEBHOOK_WORKERS < 2:
+        return
+    version = await state_backend.get(f"user_version:{user_id}")
+    if user_versions.get(user_id) != version:
+        await run_db(forget_user_state, user_id)
+        user_versions[user_id] = version
+
+
+# Версия меняется после записи пачки ответов, а не на каждый ответ: другие процессы узнают о нём
+# с задержкой не больше ANSWER_FLUSH_INTERVAL_MS, зато запись по-прежнему идёт пачками
+async def bump_user_versions(user_ids):
+    if WEBHOOK_WORKERS < 2:
+        return
+    for user_id in user_ids:
+        user_versions[user_id] = str(await state_backend.incr(f"user_version:{user_id}"))
+
+
+answer_writer.on_flush = bump_user_versions
+
+
+# Экранируем специальные символы и форматируем ответ без использования блоков кода
+def format_verdict(correctness, explanation):
+    formatted = f"*{escape_markdown_v2(correctness)}*"
+    if explanation:
+        formatted += f"\n\n{escape_markdown_v2(explanation)}"
+    return formatted
+
+
+class ProgressiveReply:
+    """Ответ с вердиктом, который отправляется сразу и дописывается правками по мере генерации.
+
+    Правки идут не чаще раза в GRADING_EDIT_INTERVAL секунд, чтобы не упираться в ограничения
+    Telegram на редактирование сообщений; финальная правка отправляется всегда.
+    """
+
+    def __init__(self, message, interval=GRADING_EDIT_INTERVAL):
+        self.message = message
+        self.chat_id = message.chat.id
+        self.interval = interval
+        self._sent = None
+        self._text = None
+        self._last_edit = 0.0
+        self._started = time.monotonic()
+
+    async def update(self, correctness, explanation, final=False):
+        text = format_verdict(correctness, explanation)
+        if text == self._text:
+            return
+        if self._sent is not None and not final and time.monotonic() - self._last_edit < self.interval:
+            return
+        try:
+            if self._sent is None:
+                self._sent = await outbound.send(self.chat_id, self.message.answer(text, parse_mode='MarkdownV2'))
+                VERDICT_SHOWN_SECONDS.observe(time.monotonic() - self._started)
+            else:
+                # Промежуточную правку после RetryAfter можно пропустить, финальную очередь повторит после паузы
+                await outbound.send(self.chat_id, self._sent.edit_text(text, parse_mode='MarkdownV2'),
+                                    max_retries=SEND_MAX_RETRIES if final else 0)
+        except TelegramRetryAfter as e:
+            if final:
+                logging.error("Не удалось отправить вердикт из-за ограничений Telegram: %s", e)
+            return
+        except TelegramAPIError as e:
+            logging.error("Ошибка при отправке ответа с вердиктом: %s", e)
+            return
+        self._text = text
+        self._last_edit = time.monotonic()
+
+    async def finish(self, correctness, explanation):
+        await self.update(correctness, explanation, final=True)
+
+
+# Формирование сообщения со статистикой и слабыми темами пользователя
+async def build_stats_message(user_id):
+    await sync_user_state(user_id)
+    total_answers, correct_percentage, weak_categories = await run_db(get_user_stats_report, user_id)
+    response_message = (f"Ваша статистика:\nВсего ответов: {total_answers}"
+                        f"\nПроцент правильных ответов: {correct_percentage:.2f}%")
+    if weak_categories:
+        response_message += "\n\nСлабые темы:"
+        for category, correct_answers, category_total in weak_categories:
+            response_message += (f"\n{category}: {correct_answers}/{category_total} "
+                                 f"({correct_answers / category_total * 100:.0f}%)")
+    return escape_markdown_v2(response_message)
+
+
 @router.message(Command("menu"))
 async def show_menu(message: types.Message):
-    logging.info(f"Показ меню для пользователя с telegram_id: {message.from_user.id}")
-    await message.answer("Выберите действие:", reply_markup=main_menu(), parse_mode='MarkdownV2')
+    logging.info("Показ меню для пользователя с telegram_id: %s", message.from_user.id)
+    await outbound.send(message.chat.id, message.answer("Выберите действие:", reply_markup=main_menu(),
+                                                        parse_mode='MarkdownV2'))
 
 
-@router.callback_query(lambda c: c.data == "get_question")
+@router.callback_query(lambda c: c.data == "get_question", flags={'coalesce': 'question'})
 async def handle_get_question(callback_query: CallbackQuery):
     telegram_id = callback_query.from_user.id
-    logging.info(f"Получение вопроса для пользователя с telegram_id (callback_query): {telegram_id}")
+    logging.info("Получение вопроса для пользователя с telegram_id (callback_query): %s", telegram_id)
     await cmd_question(callback_query.message, telegram_id)
 
 
-@router.callback_query(lambda c: c.data == "check_stats")
+@router.callback_query(lambda c: c.data == "check_stats", flags={'coalesce': 'stats'})
 async def handle_check_stats(callback_query: CallbackQuery):
     telegram_id = callback_query.from_user.id
-    logging.info(f"Проверка статистики для пользователя с telegram_id: {telegram_id}")
-    total_answers, correct_percentage = calculate_user_stats(telegram_id)
-    response_message = (f"Ваша статистика:\nВсего ответов: {total_answers}"
-                        f"\nПроцент правильных ответов: {correct_percentage:.2f}%")
-    response_message = escape_markdown_v2(response_message)
-    await bot.send_message(telegram_id, response_message, parse_mode='MarkdownV2')
+    logging.info("Проверка статистики для пользователя с telegram_id: %s", telegram_id)
+    response_message = await build_stats_message(telegram_id)
+    await outbound.send(telegram_id, SendMessage(chat_id=telegram_id, text=response_message, parse_mode='MarkdownV2'))
     await callback_query.answer()
 
 
-async def stop_receiving_answers(user_id):
-    if user_id in bot_data:
-        del bot_data[user_id]
-        logging.info(f"Остановка получения ответов для пользователя с telegram_id: {user_id}")
+# Таймер относится к конкретному вопросу: устаревший токен не завершает более новый вопрос
+async def stop_receiving_answers(user_id, token=None):
+    question = await state_backend.claim_question(user_id, token)
+    if question:
+        timeout_scheduler.cancel(question[2])
+        ANSWER_TIMEOUTS.inc()
+        logging.info("Остановка получения ответов для пользователя с telegram_id: %s", user_id)
         try:
-            await bot.send_message(user_id, "Время на ответ истекло. Введите /question, чтобы получить новый вопрос.",
-                                   parse_mode='MarkdownV2')
+            # Таймеры часто истекают пачками: уведомления уступают очередь ответам пользователям
+            text = escape_markdown_v2("Время на ответ истекло. Введите /question, чтобы получить новый вопрос.")
+            await outbound.send(user_id, SendMessage(chat_id=user_id, text=text, parse_mode='MarkdownV2'),
+                                PRIORITY_NOTICE)
         except Exception as e:
-            logging.error(f"Ошибка при отправке сообщения об истечении времени для пользователя {user_id}: {e}")
+            logging.error("Ошибка при отправке сообщения об истечении времени для пользователя %s: %s",
+                          user_id, e)
 
 
 @router.message(Command("start"))
 async def cmd_start(message: Message):
     user_id = message.from_user.id
-    logging.info(f"Регистрация пользователя с telegram_id: {user_id}")
-    register_user(user_id)
+    logging.info("Регистрация пользователя с telegram_id: %s", user_id)
+    await run_db(register_user, user_id)
     welcome_message = ("Привет! Я помогу тебе подготовиться к собеседованию по Python. "
                        "Вы успешно зарегистрированы! Готов начать?")
     welcome_message = escape_markdown_v2(welcome_message)
-    await message.answer(welcome_message, reply_markup=main_menu(), parse_mode='MarkdownV2')
+    await outbound.send(message.chat.id, message.answer(welcome_message, reply_markup=main_menu(),
+                                                        parse_mode='MarkdownV2'))
 
 
-@router.message(Command("question"))
+@router.message(Command("question"), flags={'coalesce': 'question'})
 async def cmd_question(message: Message, user_id: int = None):
     if user_id is None:
         user_id = message.from_user.id
-    logging.info(f"Начало выполнения cmd_question для пользователя с telegram_id: {user_id}")
-    question = get_random_question(user_id)
+    logging.info("Начало выполнения cmd_question для пользователя с telegram_id: %s", user_id)
+    await sync_user_state(user_id)
+    question = await run_db(get_random_question, user_id)
     if question:
-        question_id, question_text, category = question
-        bot_data[user_id] = (question_id, question_text)
-        response_message = (
-            f"Вопрос: {question_text}\n"
-            f"Категория: {category}\n"
-            "У вас 2 минуты на ответ."
-        )
-        await message.answer(response_message)
-        if not message.from_user.is_bot:
-            logging.info(f"Установка таймера для пользователя с telegram_id: {user_id}")
-            task = asyncio.create_task(timer_task(user_id), name=f"timer_{user_id}")
-            tasks[user_id] = task
+        await issue_question(message, user_id, question)
     else:
-        logging.error(f"Не удалось получить вопрос для пользователя с telegram_id: {user_id}")
+        logging.error("Не удалось получить вопрос для пользователя с telegram_id: %s", user_id)
+        # В случайном режиме вопросов нет, только если все уже решены: ожидание не поможет
+        if SCHEDULING_MODE == 'spaced':
+            text = "Вопросов для повторения пока нет. Попробуйте позже."
+        else:
+            text = "Вы ответили на все вопросы!"
+        await outbound.send(message.chat.id, message.answer(text))
+
+
+# Выдача вопроса пользователю: сохранение в общем состоянии, отправка и таймер на ответ
+async def issue_question(message: Message, user_id: int, question):
+    question_id, question_text, category = question
+    # Новый вопрос заменяет предыдущий вместе с его таймером
+    previous_question = await state_backend.get_question(user_id)
+    if previous_question:
+        timeout_scheduler.cancel(previous_question[2])
+    token = uuid.uuid4().hex
+    deadline = None if message.from_user.is_bot else time.time() + ANSWER_TIMEOUT
+    # Вопрос сохраняется до отправки, чтобы ответ мог принять любой процесс бота
+    await state_backend.save_question(user_id, question_id, question_text, token, deadline)
+    response_message = (
+        f"Вопрос: {question_text}\n"
+        f"Категория: {category}\n"
+        "У вас 2 минуты на ответ."
+    )
+    await outbound.send(message.chat.id, message.answer(response_message))
+    if deadline is not None:
+        logging.info("Установка таймера для пользователя с telegram_id: %s", user_id)
+        timeout_scheduler.schedule(token, deadline, user_id)
+
+
+async def on_answer_timeout(token, user_id):
+    logging.info("Таймер истек для пользователя %s", user_id)
+    await stop_receiving_answers(user_id, token)
+
+
+timeout_scheduler = TimeoutScheduler(on_answer_timeout)
+expiry_sweeper = ExpirySweeper(state_backend, on_answer_timeout)
+
+
+# Восстановление таймеров выданных вопросов после перезапуска
+async def restore_pending_questions():
+    pending_questions = await state_backend.load_questions()
+    for user_id, question_id, question_text, token, deadline in pending_questions:
+        if deadline is not None:
+            timeout_scheduler.schedule(token, deadline, user_id)
+    logging.info("Восстановлено вопросов, ожидающих ответа: %s", len(pending_questions))
+
+
+@router.message(lambda message: message.voice is not None, flags={'serialize': True})
+async def handle_voice(message: Message):
+    user_id = message.from_user.id
+    logging.info("Получено голосовое сообщение от пользователя %s", user_id)
+    # Без активного вопроса распознавать нечего
+    if await state_backend.get_question(user_id) is None:
+        logging.warning("Нет данных о вопросе для пользователя с telegram_id: %s", user_id)
+        return
+    throttled = openai_limiter.check(user_id)
+    if throttled is not None:
+        await outbound.send(message.chat.id, message.answer(throttled))
+        return
 
+    try:
+        user_answer = await transcribe_voice(bot, message.voice, user_id)
+    except OpenAIThrottledError as e:
+        logging.warning("Распознавание голосового сообщения отложено: %s", e)
+        await outbound.send(message.chat.id, message.answer(GLOBAL_THROTTLED_TEXT))
+        return
+    except Exception as e:
+        logging.error("Произошла ошибка при обработке аудио: %s", e)
+        user_answer = None
 
-async def timer_task(user_id):
-    logging.info(f"Таймер запущен для пользователя {user_id}")
-    await asyncio.sleep(ANSWER_TIMEOUT)
-    logging.info(f"Таймер истек для пользователя {user_id}")
-    await stop_receiving_answers(user_id)
-    tasks.pop(user_id, None)
+    if user_answer:
+        # Лимит проверен до распознавания, и токен пользователя за этот ответ уже потрачен
+        await handle_answer(message, user_answer, charged=True)
+    else:
+        text = escape_markdown_v2("Произошла ошибка при распознавании аудио. Пожалуйста, попробуйте еще раз.")
+        await outbound.send(message.chat.id, message.answer(text, parse_mode='MarkdownV2'))
 
 
-@router.message(lambda message: message.voice is not None)
-async def handle_voice(message: Message):
+@router.message(Command("stats"), flags={'coalesce': 'stats'})
+async def cmd_stats(message: Message):
     user_id = message.from_user.id
-    logging.info(f"Получено голосовое сообщение от пользователя {user_id}")
-    file_info = await bot.get_file(message.voice.file_id)
-    file_path = file_info.file_path
-    voice_file = f"voice_{user_id}.ogg"
-    await bot.download_file(file_path, voice_file)
-
-    # Преобразование аудио в формат, поддерживаемый API
-    wav_file = f"voice_{user_id}.wav"
-    ffmpeg.input(voice_file).output(wav_file).run(overwrite_output=True)
+    logging.info("Проверка статистики для пользователя с telegram_id: %s", user_id)
+    response_message = await build_stats_message(user_id)
+    await outbound.send(message.chat.id, message.answer(response_message, parse_mode='MarkdownV2'))
 
-    client = OpenAI(api_key=OPENAI_API_KEY, base_url="https://api.proxyapi.ru/openai/v1", timeout=ANSWER_TIMEOUT)
 
-    # Отправка файла на сервер OpenAI для транскрипции
+# Задача рассылки никто не ожидает, поэтому ошибки логируются здесь и сообщаются администратору
+async def run_broadcast(admin_id, text):
     try:
-        with open(wav_file, 'rb') as audio_file:
-            response = client.audio.transcriptions.create(
-                model="whisper-1",
-                file=audio_file
-            )
-
-        if response:
-            response_data = response.json()
-            logging.info(f"Response data: {response_data}")  # Печать полного ответа для отладки
-
-            # Убедимся, что response_data является словарем, а не строкой
-            if isinstance(response_data, str):
-                response_data = json.loads(response_data)
-
-            if isinstance(response_data, dict) and 'text' in response_data:
-                user_answer = response_data['text']
-                await handle_answer(message, user_answer)
-            else:
-                logging.error(f"Некорректный формат данных: {response_data}")
-                await message.answer("Произошла ошибка при распознавании аудио. Пожалуйста, попробуйте еще раз.",
-                                     parse_mode='MarkdownV2')
-        else:
-            logging.error(f"Ошибка транскрипции: {response}")
-            await message.answer("Произошла ошибка при распознавании аудио. Пожалуйста, попробуйте еще раз.",
-                                 parse_mode='MarkdownV2')
+        results = await broadcast(outbound, lambda telegram_id: SendMessage(chat_id=telegram_id, text=text))
+        report = (f"Рассылка завершена. Доставлено: {results['ok']}, заблокировали бота: {results['blocked']}, "
+                  f"ошибок: {results['error']}")
+    except Exception as e:
+        logging.error("Ошибка при выполнении рассылки: %s", e)
+        report = f"Рассылка прервана из-за ошибки: {e}"
+    try:
+        await outbound.send(admin_id, SendMessage(chat_id=admin_id, text=report), PRIORITY_NOTICE)
     except Exception as e:
-        logging.error(f"Произошла ошибка при обработке аудио: {e}")
-        await message.answer("Произошла ошибка при распознавании аудио. Пожалуйста, попробуйте еще раз.",
-                             parse_mode='MarkdownV2')
-    finally:
-        os.remove(voice_file)
-        os.remove(wav_file)
+        logging.error("Не удалось отправить администратору %s отчёт о рассылке: %s", admin_id, e)
 
 
-@router.message(Command("stats"))
-async def cmd_stats(message: Message):
+@router.message(Command("broadcast"))
+async def cmd_broadcast(message: Message, command: CommandObject):
     user_id = message.from_user.id
-    logging.info(f"Проверка статистики для пользователя с telegram_id: {user_id}")
-    total_answers, correct_percentage = calculate_user_stats(user_id)
-    response_message = (f"Ваша статистика:\nВсего ответов: {total_answers}"
-                        f"\nПроцент правильных ответов: {correct_percentage:.2f}%")
-    response_message = escape_markdown_v2(response_message)
-    await message.answer(response_message, parse_mode='MarkdownV2')
+    if user_id not in ADMIN_IDS:
+        logging.warning("Пользователь %s без прав пытался запустить рассылку", user_id)
+        return
+    if not command.args:
+        await outbound.send(message.chat.id, message.answer("Использование: /broadcast <текст сообщения>"))
+        return
+    logging.info("Пользователь %s запустил рассылку", user_id)
+    task = asyncio.create_task(run_broadcast(user_id, command.args), name="broadcast")
+    broadcast_tasks.add(task)
+    task.add_done_callback(broadcast_tasks.discard)
+    await outbound.send(message.chat.id, message.answer("Рассылка запущена."))
+
+
+async def send_question_of_the_day():
+    question = await run_db(question_sampler.random_question)
+    if question is None:
+        logging.error("Не удалось выбрать вопрос дня")
+        return
+    question_id, question_text, category = question
+    markup = types.InlineKeyboardMarkup(inline_keyboard=[[
+        types.InlineKeyboardButton(text="Ответить", callback_data=f"qotd:{question_id}")]])
+    text = f"Вопрос дня: {question_text}\nКатегория: {category}"
+    await broadcast(outbound, lambda telegram_id: SendMessage(chat_id=telegram_id, text=text, reply_markup=markup))
+
+
+daily_question = DailyJob(state_backend, QUESTION_OF_THE_DAY_TIME, send_question_of_the_day, "question_of_the_day")
+
+
+# Кнопка под вопросом дня выдаёт этот вопрос как обычный, с таймером на ответ
+@router.callback_query(lambda c: (c.data or "").startswith("qotd:"), flags={'coalesce': 'question'})
+async def handle_question_of_the_day(callback_query: CallbackQuery):
+    telegram_id = callback_query.from_user.id
+    question = await run_db(question_sampler.get_question, int(callback_query.data.split(':', 1)[1]))
+    await callback_query.answer()
+    if question is None:
+        logging.warning("Вопрос дня %s больше не существует", callback_query.data)
+        return
+    logging.info("Пользователь с telegram_id %s отвечает на вопрос дня", telegram_id)
+    await issue_question(callback_query.message, telegram_id, question)
+
+
+async def stop_broadcasts():
+    for task in list(broadcast_tasks):
+        task.cancel()
+    await asyncio.gather(*broadcast_tasks, return_exceptions=True)
 
 
-@router.message(lambda message: message.text is not None)
+@router.message(lambda message: message.text is not None, flags={'serialize': True})
 async def handle_text_message(message: Message):
     await handle_answer(message, message.text)
 
 
-async def handle_answer(message: types.Message, user_answer: str):
-    user_id = message.from_user.id
-    logging.info(f"Обработка ответа для пользователя с telegram_id: {user_id}")
-    if user_id in bot_data:
-        question_id, question_text = bot_data[user_id]
-        logging.info(f"Вопрос ID: {question_id}, Текст вопроса: {question_text}, Ответ пользователя: {user_answer}")
+async def record_answer(user_id, question_id, correctness):
+    await sync_user_state(user_id)
+    await answer_writer.record(user_id, question_id, correctness.lower() == "правильно")
+
 
-        correctness, explanation = check_answer_with_openai(question_text, user_answer)
-        logging.info(f"Проверка ответа с OpenAI: корректность - {correctness}, объяснение - {explanation}")
+# Вопрос, изъятый для проверки, возвращается пользователю вместе с таймером, если его не сменил более новый
+async def return_question(user_id, question_id, question_text, token, deadline):
+    if await state_backend.get_question(user_id) is not None:
+        return
+    await state_backend.save_question(user_id, question_id, question_text, token, deadline)
+    if deadline is not None:
+        timeout_scheduler.schedule(token, deadline, user_id)
 
-        # Экранируем специальные символы и форматируем ответ без использования блоков кода
-        formatted_explanation = f"*{escape_markdown_v2(correctness)}*\n\n{escape_markdown_v2(explanation)}"
-        await message.answer(formatted_explanation, parse_mode='MarkdownV2')
 
-        update_user_stats(user_id, question_id, correctness.lower() == "правильно")
-        del bot_data[user_id]
-        logging.info(f"Данные о вопросе удалены для пользователя с telegram_id: {user_id}")
+# charged=True - ответ уже прошёл проверку лимита и потратил токен пользователя (распознавание голоса)
+async def handle_answer(message: types.Message, user_answer: str, charged=False):
+    user_id = message.from_user.id
+    logging.info("Обработка ответа для пользователя с telegram_id: %s", user_id)
+    # При исчерпанном лимите запросов к OpenAI вопрос остаётся за пользователем;
+    # сообщения без активного вопроса по-прежнему игнорируются без ответа
+    throttled = None if charged else openai_limiter.check(user_id)
+    if throttled is not None:
+        if await state_backend.get_question(user_id) is not None:
+            await outbound.send(message.chat.id, message.answer(throttled))
+        else:
+            logging.warning("Нет данных о вопросе для пользователя с telegram_id: %s", user_id)
+        return
+    # Забираем вопрос сразу, чтобы повторное сообщение или таймер не обработали его во время проверки
+    question = await state_backend.claim_question(user_id)
+    if question:
+        question_id, question_text, token, deadline = question
+        timeout_scheduler.cancel(token)
+        logging.debug("Вопрос ID: %s, Текст вопроса: %s, Ответ пользователя: %s",
+                      question_id, question_text, user_answer)
+
+        reply = ProgressiveReply(message)
+        recording = None
+
+        # Вердикт известен по первому предложению: запись ответа начинается, пока дописывается объяснение
+        async def on_progress(correctness, explanation):
+            nonlocal recording
+            if recording is None and correctness != "Ошибка":
+                recording = asyncio.create_task(record_answer(user_id, question_id, correctness))
+            await reply.update(correctness, explanation)
+
+        # Токен пользователя за голосовой ответ потрачен при распознавании, проверка занимает только общий лимит
+        limiter_user_id = None if charged else user_id
+        try:
+            if GRADING_STREAMING:
+                correctness, explanation = await grade_answer_streaming(question_id, question_text, user_answer,
+                                                                        on_progress, limiter_user_id)
+            else:
+                correctness, explanation = await grade_answer(question_id, question_text, user_answer,
+                                                              limiter_user_id)
+        except OpenAIThrottledError as e:
+            # Ответ не проверялся: не засчитываем его и оставляем вопрос открытым
+            logging.warning("Проверка ответа пользователя %s отложена: %s", user_id, e)
+            await return_question(user_id, question_id, question_text, token, deadline)
+            await outbound.send(message.chat.id, message.answer(GLOBAL_THROTTLED_TEXT))
+            return
+        logging.debug("Проверка ответа с OpenAI: корректность - %s, объяснение - %s", correctness, explanation)
+        await reply.finish(correctness, explanation)
+
+        # Сбой проверки не считается ответом: иначе он попал бы в ошибки пользователя и статистику
+        if recording is None and correctness != "Ошибка":
+            recording = record_answer(user_id, question_id, correctness)
+        if recording is not None:
+            await recording
+        logging.info("Данные о вопросе удалены для пользователя с telegram_id: %s", user_id)
     else:
-        logging.warning(f"Нет данных о вопросе для пользователя с telegram_id: {user_id}")
+        logging.warning("Нет данных о вопросе для пользователя с telegram_id: %s", user_id)
+
+
+dp.startup.register(apply_users_migrations)
+dp.startup.register(outbound.start)
+dp.startup.register(restore_pending_questions)
+dp.startup.register(timeout_scheduler.start)
+dp.startup.register(expiry_sweeper.start)
+dp.startup.register(answer_writer.start)
+dp.startup.register(history_compactor.start)
+dp.startup.register(daily_question.start)
+dp.startup.register(reference_answers.start)
+dp.startup.register(pre_grader.start)
+dp.startup.register(start_metrics_server)
+dp.shutdown.register(stop_metrics_server)
+dp.shutdown.register(expiry_sweeper.stop)
+dp.shutdown.register(daily_question.stop)
+dp.shutdown.register(stop_broadcasts)
+dp.shutdown.register(timeout_scheduler.stop)
+dp.shutdown.register(outbound.stop)
+dp.shutdown.register(history_compactor.stop)
+dp.shutdown.register(answer_writer.stop)
+dp.shutdown.register(state_backend.close)
+dp.shutdown.register(close_async_client)
+dp.shutdown.register(shutdown_transcoder)
+dp.shutdown.register(grading_cache.close)
+dp.shutdown.register(shutdown_db)
+
+
+async def set_webhook():
+    await bot.set_webhook(WEBHOOK_URL + WEBHOOK_PATH, secret_token=WEBHOOK_SECRET)
+    logging.info("Установлен вебхук %s%s", WEBHOOK_URL, WEBHOOK_PATH)
+
+
+# Один процесс-обработчик вебхуков на общем слушающем сокете
+def serve_webhook(sock, worker_index=0):
+    if worker_index == 0:
+        dp.startup.register(set_webhook)
+    if metrics.METRICS_PORT is not None:
+        # У каждого процесса свои метрики, поэтому и свой порт
+        metrics.METRICS_PORT += worker_index
+    app = web.Application()
+    SimpleRequestHandler(dispatcher=dp, bot=bot, secret_token=WEBHOOK_SECRET).register(app, path=WEBHOOK_PATH)
+    setup_application(app, dp, bot=bot)
+    logging.info("Процесс %s принимает вебхуки на %s:%s", worker_index, WEBHOOK_HOST, WEBHOOK_PORT)
+    web.run_app(app, sock=sock, print=None)
+
+
+# Сокет открывается до запуска процессов и наследуется ими, ядро распределяет соединения между процессами
+def run_webhook():
+    sock = socket.create_server((WEBHOOK_HOST, WEBHOOK_PORT), backlog=1024)
+    if WEBHOOK_WORKERS < 2:
+        serve_webhook(sock)
+        return
+    context = multiprocessing.get_context('fork')
+    workers = [context.Process(target=serve_webhook, args=(sock, worker_index), name=f"webhook-{worker_index}")
+               for worker_index in range(WEBHOOK_WORKERS)]
+    for worker in workers:
+        worker.start()
+    try:
+        for worker in workers:
+            worker.join()
+    except KeyboardInterrupt:
+        for worker in workers:
+            worker.terminate()
+            worker.join()
 
 
 if __name__ == '__main__':
-    logging.info(f"ID бота: {bot.id}")
-    dp.run_polling(bot)  # Укажите объект bot при вызове метода run_polling
+    logging.info("ID бота: %s", bot.id)
+    if WEBHOOK_URL:
+        run_webhook()
+    else:
+        dp.run_polling(bot)  # Укажите объект bot при вызове метода run_polling
@@ -0,0 +1,261 @@
+import asyncio
+import collections
+import functools
+import logging
+import sys
+import threading
+import time
+from aiohttp import web
+import config
+
+# Порт HTTP-эндпоинта с метриками; None - эндпоинт не запускается
+METRICS_PORT = getattr(config, 'METRICS_PORT', None)
+METRICS_HOST = getattr(config, 'METRICS_HOST', '127.0.0.1')
+# Интервал сэмплирующего профилировщика, в секундах
+PROFILER_INTERVAL = getattr(config, 'PROFILER_INTERVAL', 0.005)
+
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+_registry = []
+_lock = threading.Lock()
+
+
+def _format_labels(labelnames, labelvalues, extra=None):
+    pairs = list(zip(labelnames, labelvalues))
+    if extra:
+        pairs.append(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{value}"' for name, value in pairs) + '}'
+
+
+class _Metric:
+    kind = ''
+    has_children = True
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._children = {}
+        with _lock:
+            _registry.append(self)
+        # Метрики без меток видны в выводе сразу, с нулевым значением
+        if self.has_children and not self.labelnames:
+            self.labels()
+
+    def labels(self, *labelvalues):
+        child = self._children.get(labelvalues)
+        if child is None:
+            with _lock:
+                child = self._children.setdefault(labelvalues, self._new_child())
+        return child
+
+    def _default(self):
+        return self.labels()
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        for labelvalues, child in list(self._children.items()):
+            lines.extend(self._render_child(labelvalues, child))
+        return lines
+
+
+class _CounterChild:
+    __slots__ = ('value',)
+
+    def __init__(self):
+        self.value = 0.0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+
+class Counter(_Metric):
+    kind = 'counter'
+
+    def _new_child(self):
+        return _CounterChild()
+
+    def inc(self, amount=1):
+        self._default().inc(amount)
+
+    def _render_child(self, labelvalues, child):
+        return [f"{self.name}{_format_labels(self.labelnames, labelvalues)} {child.value}"]
+
+
+class _HistogramChild:
+    __slots__ = ('buckets', 'counts', 'total', 'count')
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.total = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        for index, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[index] += 1
+                break
+        self.total += value
+        self.count += 1
+
+
+class Histogram(_Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        super().__init__(name, documentation, labelnames)
+
+    def _new_child(self):
+        return _HistogramChild(self.buckets)
+
+    def observe(self, value):
+        self._default().observe(value)
+
+    def _render_child(self, labelvalues, child):
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets, child.counts):
+            cumulative += count
+            labels = _format_labels(self.labelnames, labelvalues, ('le', bound))
+            lines.append(f"{self.name}_bucket{labels} {cumulative}")
+        labels = _format_labels(self.labelnames, labelvalues, ('le', '+Inf'))
+        lines.append(f"{self.name}_bucket{labels} {child.count}")
+        labels = _format_labels(self.labelnames, labelvalues)
+        lines.append(f"{self.name}_sum{labels} {child.total}")
+        lines.append(f"{self.name}_count{labels} {child.count}")
+        return lines
+
+
+class CallbackGauge(_Metric):
+    """Значение вычисляется при каждом снятии метрик, например из счётчиков кэша."""
+
+    kind = 'gauge'
+    has_children = False
+
+    def __init__(self, name, documentation, callback):
+        self.callback = callback
+        super().__init__(name, documentation)
+
+    def render(self):
+        try:
+            value = self.callback()
+        except Exception as e:
+            logging.error("Ошибка при вычислении метрики %s: %s", self.name, e)
+            return []
+        return [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} gauge", f"{self.name} {value}"]
+
+
+# Замер длительности синхронной или асинхронной функции
+def timed(histogram):
+    def decorator(func):
+        if asyncio.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                started = time.perf_counter()
+                try:
+                    return await func(*args, **kwargs)
+                finally:
+                    histogram.observe(time.perf_counter() - started)
+            return async_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                histogram.observe(time.perf_counter() - started)
+        return wrapper
+    return decorator
+
+
+def render_prometheus():
+    lines = []
+    for metric in list(_registry):
+        lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
+
+
+class SamplingProfiler:
+    """Сэмплирующий профилировщик: периодически снимает стек выбранного потока.
+
+    Результат - свёрнутые стеки ("a;b;c число"), которые понимают flamegraph.pl и speedscope.
+    """
+
+    def __init__(self, interval=PROFILER_INTERVAL, thread_id=None):
+        self.interval = interval
+        self.thread_id = thread_id if thread_id is not None else threading.main_thread().ident
+        self.samples = collections.Counter()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _sample(self):
+        frame = sys._current_frames().get(self.thread_id)
+        stack = []
+        while frame is not None:
+            code = frame.f_code
+            stack.append(f"{code.co_filename.rsplit('/', 1)[-1]}:{code.co_name}")
+            frame = frame.f_back
+        if stack:
+            self.samples[';'.join(reversed(stack))] += 1
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self._sample()
+
+    def start(self):
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name='sampling-profiler', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def collapsed(self):
+        return '\n'.join(f"{stack} {count}" for stack, count in self.samples.most_common()) + '\n'
+
+
+_runner = None
+
+
+async def _handle_metrics(request):
+    return web.Response(text=render_prometheus(), content_type='text/plain', charset='utf-8')
+
+
+# Профилирование цикла событий по запросу: /debug/profile?seconds=10
+async def _handle_profile(request):
+    seconds = min(float(request.query.get('seconds', 10)), 300)
+    profiler = SamplingProfiler(thread_id=threading.get_ident())
+    profiler.start()
+    try:
+        await asyncio.sleep(seconds)
+    finally:
+        profiler.stop()
+    return web.Response(text=profiler.collapsed(), content_type='text/plain', charset='utf-8')
+
+
+async def start_metrics_server():
+    global _runner
+    if METRICS_PORT is None or _runner is not None:
+        return
+    app = web.Application()
+    app.router.add_get('/metrics', _handle_metrics)
+    app.router.add_get('/debug/profile', _handle_profile)
+    _runner = web.AppRunner(app, access_log=None)
+    await _runner.setup()
+    await web.TCPSite(_runner, METRICS_HOST, METRICS_PORT).start()
+    logging.info("Метрики доступны на http://%s:%s/metrics", METRICS_HOST, METRICS_PORT)
+
+
+async def stop_metrics_server():
+    global _runner
+    if _runner is not None:
+        await _runner.cleanup()
+        _runner = None
@@ -0,0 +1,172 @@
+import asyncio
+import logging
+import math
+import time
+from aiogram import BaseMiddleware
+from aiogram.dispatcher.flags import get_flag
+from aiogram.types import CallbackQuery
+import config
+from metrics import Counter
+
+# Ограничения на число ответов, уходящих на проверку в OpenAI
+OPENAI_USER_RATE_PER_MINUTE = getattr(config, 'OPENAI_USER_RATE_PER_MINUTE', 6)
+OPENAI_USER_BURST = getattr(config, 'OPENAI_USER_BURST', 3)
+OPENAI_GLOBAL_RATE_PER_MINUTE = getattr(config, 'OPENAI_GLOBAL_RATE_PER_MINUTE', 600)
+OPENAI_GLOBAL_BURST = getattr(config, 'OPENAI_GLOBAL_BURST', 50)
+# Сколько ответ может ждать свободного места в общем лимите, прежде чем пользователь получит отказ
+OPENAI_GLOBAL_MAX_WAIT = getattr(config, 'OPENAI_GLOBAL_MAX_WAIT', 10)
+# Общий лимит делится между процессами, принимающими вебхуки
+WEBHOOK_WORKERS = getattr(config, 'WEBHOOK_WORKERS', 1)
+# Число корзин пользователей, после которого простаивающие корзины удаляются
+USER_BUCKETS_PRUNE_SIZE = 10000
+# Ответ пользователю, когда исчерпан общий лимит запросов к OpenAI
+GLOBAL_THROTTLED_TEXT = "Сейчас слишком много ответов на проверке. Попробуйте отправить ответ ещё раз."
+
+THROTTLED_UPDATES = Counter('bot_throttled_updates_total', 'Обновления, отброшенные или отложенные ограничителями',
+                            ('reason',))
+
+
+class TokenBucket:
+    """Корзина токенов: capacity - допустимый всплеск, rate - пополнение в секунду."""
+
+    __slots__ = ('capacity', 'rate', 'tokens', 'updated')
+
+    def __init__(self, capacity, rate):
+        self.capacity = capacity
+        self.rate = rate
+        self.tokens = float(capacity)
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def try_acquire(self):
+        self._refill()
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
+
+    # Через сколько секунд появится следующий токен
+    def wait_time(self):
+        self._refill()
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    @property
+    def full(self):
+        self._refill()
+        return self.tokens >= self.capacity
+
+
+class CoalescingMiddleware(BaseMiddleware):
+    """Схлопывает повторные запросы пользователя, пока первый ещё обрабатывается.
+
+    Действует на обработчики с флагом coalesce; значение флага - ключ действия, поэтому
+    /question и кнопка "Получить вопрос" считаются одним и тем же действием.
+    """
+
+    def __init__(self):
+        self._in_flight = set()
+
+    async def __call__(self, handler, event, data):
+        action = get_flag(data, 'coalesce')
+        if action is None:
+            return await handler(event, data)
+        key = (event.from_user.id, action)
+        if key in self._in_flight:
+            THROTTLED_UPDATES.labels('coalesced').inc()
+            logging.info("Повторный запрос %s от пользователя %s отброшен", action, key[0])
+            if isinstance(event, CallbackQuery):
+                await event.answer()
+            return None
+        self._in_flight.add(key)
+        try:
+            return await handler(event, data)
+        finally:
+            self._in_flight.discard(key)
+
+
+class UserLockMiddleware(BaseMiddleware):
+    """Обработчики с флагом serialize выполняются для одного пользователя строго по очереди."""
+
+    def __init__(self):
+        # telegram_id -> [блокировка, число ожидающих и выполняющихся обработчиков]
+        self._locks = {}
+
+    async def __call__(self, handler, event, data):
+        if not get_flag(data, 'serialize'):
+            return await handler(event, data)
+        user_id = event.from_user.id
+        entry = self._locks.setdefault(user_id, [asyncio.Lock(), 0])
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                return await handler(event, data)
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self._locks[user_id]
+
+
+class OpenAIThrottledError(Exception):
+    pass
+
+
+class OpenAIRateLimiter:
+    """Ограничение частоты запросов к OpenAI: по пользователю и общее для всех процессов бота.
+
+    Токены расходуются непосредственно перед запросом к OpenAI, поэтому сообщения без активного
+    вопроса, вердикты из кэша и предпроверки лимит не тратят. Общий лимит делится между процессами,
+    принимающими вебхуки; при его исчерпании запрос ждёт своей очереди до OPENAI_GLOBAL_MAX_WAIT секунд.
+    """
+
+    def __init__(self, user_rate_per_minute=OPENAI_USER_RATE_PER_MINUTE, user_burst=OPENAI_USER_BURST,
+                 global_rate_per_minute=OPENAI_GLOBAL_RATE_PER_MINUTE, global_burst=OPENAI_GLOBAL_BURST,
+                 global_max_wait=OPENAI_GLOBAL_MAX_WAIT, workers=WEBHOOK_WORKERS):
+        self.user_rate = user_rate_per_minute / 60
+        self.user_burst = user_burst
+        self.global_bucket = TokenBucket(max(1, global_burst // workers), global_rate_per_minute / 60 / workers)
+        self.global_max_wait = global_max_wait
+        self._user_buckets = {}
+
+    def _user_bucket(self, user_id):
+        bucket = self._user_buckets.get(user_id)
+        if bucket is None:
+            if len(self._user_buckets) >= USER_BUCKETS_PRUNE_SIZE:
+                # Полные корзины ничем не отличаются от новых, их можно удалить
+                self._user_buckets = {key: value for key, value in self._user_buckets.items() if not value.full}
+            bucket = self._user_buckets[user_id] = TokenBucket(self.user_burst, self.user_rate)
+        return bucket
+
+    # Текст отказа, если ответ пользователя сейчас нельзя отправить на проверку, иначе None; токены не расходуются
+    def check(self, user_id):
+        wait_time = self._user_bucket(user_id).wait_time()
+        if wait_time > 0:
+            THROTTLED_UPDATES.labels('user_rate').inc()
+            logging.info("Пользователь %s превысил лимит ответов", user_id)
+            return f"Слишком много ответов подряд. Попробуйте через {math.ceil(wait_time)} с."
+        if self.global_bucket.wait_time() > self.global_max_wait:
+            THROTTLED_UPDATES.labels('global_rate').inc()
+            logging.warning("Превышен общий лимит запросов к OpenAI, ответ пользователя %s отклонён", user_id)
+            return GLOBAL_THROTTLED_TEXT
+        return None
+
+    # Вызывается перед каждым запросом к OpenAI; user_id=None - запрос не от имени пользователя
+    async def acquire(self, user_id=None):
+        if user_id is not None:
+            # Ответ уже прошёл check: гонка двух запросов пользователя не повод отказывать
+            self._user_bucket(user_id).try_acquire()
+        waited = 0.0
+        while not self.global_bucket.try_acquire():
+            delay = self.global_bucket.wait_time()
+            if waited + delay > self.global_max_wait:
+                THROTTLED_UPDATES.labels('global_rate').inc()
+                raise OpenAIThrottledError("превышен общий лимит запросов к OpenAI")
+            THROTTLED_UPDATES.labels('global_wait').inc()
+            await asyncio.sleep(delay)
+            waited += delay
+
+
+openai_limiter = OpenAIRateLimiter()
@@ -0,0 +1,98 @@
+import logging
+import sqlite3
+
+# Схема users.db задаётся только здесь. Номер применённой миграции хранится в PRAGMA user_version,
+# каждая миграция выполняется в своей транзакции вместе с увеличением номера
+
+
+def _create_base_schema(conn):
+    conn.execute('''CREATE TABLE IF NOT EXISTS users
+                    (id INTEGER PRIMARY KEY, telegram_id INTEGER UNIQUE, correct_answers INTEGER,
+                     total_answers INTEGER)''')
+    conn.execute('''CREATE TABLE IF NOT EXISTS answered_questions
+                    (id INTEGER PRIMARY KEY, telegram_id INTEGER, question_id INTEGER, correct BOOLEAN)''')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_answered_questions_telegram_id ON answered_questions (telegram_id)')
+    conn.execute('''CREATE TABLE IF NOT EXISTS review_schedule
+                    (telegram_id INTEGER, question_id INTEGER, box INTEGER, due_at REAL,
+                     PRIMARY KEY (telegram_id, question_id))''')
+    conn.execute('''CREATE TABLE IF NOT EXISTS user_category_stats
+                    (telegram_id INTEGER, category TEXT, correct_answers INTEGER, total_answers INTEGER,
+                     PRIMARY KEY (telegram_id, category)) WITHOUT ROWID''')
+    conn.execute('''CREATE TABLE IF NOT EXISTS pending_questions
+                    (telegram_id INTEGER PRIMARY KEY, question_id INTEGER, question_text TEXT, token TEXT,
+                     deadline REAL)''')
+    # Общие для процессов бота пары ключ-значение: состояние FSM и версии данных пользователей
+    conn.execute('''CREATE TABLE IF NOT EXISTS shared_state
+                    (key TEXT PRIMARY KEY, value TEXT) WITHOUT ROWID''')
+
+
+# Поиск просроченных вопросов идёт по deadline. По answered_questions с question_history (v3)
+# по пользователю больше не ищут, поэтому индекс по telegram_id только замедлял бы запись
+def _add_deadline_index(conn):
+    conn.execute('DROP INDEX IF EXISTS idx_answered_questions_telegram_id')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_pending_questions_deadline ON pending_questions (deadline)')
+
+
+# Свёртка сырых попыток в question_history за один проход: последняя попытка пары
+# пользователь-вопрос определяется оконной функцией, без подзапроса на каждую пару
+def rollup_answered_questions(conn):
+    conn.execute('''INSERT OR REPLACE INTO question_history
+                     (telegram_id, question_id, attempts, correct_attempts, last_correct, last_answered_at)
+                     SELECT telegram_id, question_id, COUNT(*), SUM(correct),
+                            MAX(CASE WHEN position = 1 THEN correct END), MAX(answered_at)
+                     FROM (SELECT telegram_id, question_id, correct, answered_at,
+                                  ROW_NUMBER() OVER (PARTITION BY telegram_id, question_id ORDER BY id DESC)
+                                      AS position
+                           FROM answered_questions)
+                     GROUP BY telegram_id, question_id''')
+
+
+# Компактная история: одна строка на пару пользователь-вопрос вместо строки на каждую попытку.
+# answered_questions остаётся журналом последних попыток, старые попытки удаляет history_compaction.py
+def _create_question_history(conn):
+    conn.execute('''CREATE TABLE IF NOT EXISTS question_history
+                    (telegram_id INTEGER, question_id INTEGER, attempts INTEGER, correct_attempts INTEGER,
+                     last_correct BOOLEAN, last_answered_at REAL,
+                     PRIMARY KEY (telegram_id, question_id)) WITHOUT ROWID''')
+    conn.execute('ALTER TABLE answered_questions ADD COLUMN answered_at REAL')
+    # Время прежних попыток неизвестно: они считаются старыми и удаляются при первом сжатии
+    conn.execute('UPDATE answered_questions SET answered_at = 0')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_answered_questions_answered_at ON answered_questions (answered_at)')
+    rollup_answered_questions(conn)
+
+
+MIGRATIONS = (
+    (1, "базовая схема", _create_base_schema),
+    (2, "индекс по дедлайну вопросов", _add_deadline_index),
+    (3, "компактная история ответов", _create_question_history),
+)
+SCHEMA_VERSION = MIGRATIONS[-1][0]
+
+
+def get_schema_version(conn):
+    return conn.execute('PRAGMA user_version').fetchone()[0]
+
+
+# Применение недостающих миграций; возвращает номер версии схемы после миграции.
+# BEGIN IMMEDIATE не даёт двум процессам бота применить одну миграцию дважды
+def migrate(conn):
+    version = get_schema_version(conn)
+    for target, description, apply in MIGRATIONS:
+        if target <= version:
+            continue
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            version = get_schema_version(conn)
+            if target > version:
+                apply(conn)
+                conn.execute(f'PRAGMA user_version = {target}')
+                version = target
+                logging.info("Применена миграция users.db %s: %s", target, description)
+            conn.commit()
+        except sqlite3.Error:
+            conn.rollback()
+            logging.error("Ошибка при применении миграции users.db %s", target)
+            raise
+    if version > SCHEMA_VERSION:
+        logging.warning("Версия схемы users.db (%s) новее известной боту (%s)", version, SCHEMA_VERSION)
+    return version
@@ -0,0 +1,261 @@
+import asyncio
+import heapq
+import itertools
+import logging
+import time
+from aiogram.exceptions import TelegramRetryAfter
+import config
+from background import BackgroundTask
+from metrics import CallbackGauge, Counter, Histogram
+from middlewares import TokenBucket
+
+# Ограничения Telegram: около 30 сообщений в секунду на бота и около одного в секунду на чат
+SEND_GLOBAL_RATE = getattr(config, 'SEND_GLOBAL_RATE', 25)
+SEND_GLOBAL_BURST = getattr(config, 'SEND_GLOBAL_BURST', 5)
+SEND_CHAT_RATE = getattr(config, 'SEND_CHAT_RATE', 1)
+SEND_CHAT_BURST = getattr(config, 'SEND_CHAT_BURST', 3)
+# Одновременных запросов к Bot API из очереди
+SEND_CONCURRENCY = getattr(config, 'SEND_CONCURRENCY', 20)
+# Сколько раз повторять отправку после RetryAfter
+SEND_MAX_RETRIES = getattr(config, 'SEND_MAX_RETRIES', 3)
+# Сколько массовых сообщений может ждать в очереди: рассылка не набирает в память всех пользователей сразу
+SEND_BULK_QUEUE_LIMIT = getattr(config, 'SEND_BULK_QUEUE_LIMIT', 500)
+# Число чатов, после которого простаивающие чаты удаляются из очереди
+CHATS_PRUNE_SIZE = 10000
+
+# Приоритеты: меньше - важнее. Ответы пользователю идут раньше уведомлений, уведомления - раньше рассылок
+PRIORITY_INTERACTIVE = 0
+PRIORITY_NOTICE = 1
+PRIORITY_BULK = 2
+PRIORITY_NAMES = {PRIORITY_INTERACTIVE: 'interactive', PRIORITY_NOTICE: 'notice', PRIORITY_BULK: 'bulk'}
+
+OUTBOUND_SENT = Counter('bot_outbound_sent_total', 'Запросы к Bot API из очереди отправки по приоритету и результату',
+                        ('priority', 'result'))
+OUTBOUND_RETRIES = Counter('bot_outbound_retries_total', 'Повторы отправки после RetryAfter', ('priority',))
+OUTBOUND_WAIT_SECONDS = Histogram('bot_outbound_wait_seconds', 'Время ожидания сообщения в очереди отправки',
+                                  ('priority',))
+
+
+class _Chat:
+    """Очередь сообщений одного чата: куча (priority, seq, элемент) и своя корзина токенов."""
+
+    __slots__ = ('chat_id', 'items', 'bucket', 'busy', 'paused_until')
+
+    def __init__(self, chat_id, rate, burst):
+        self.chat_id = chat_id
+        self.items = []
+        self.bucket = TokenBucket(burst, rate)
+        self.busy = False
+        self.paused_until = 0.0
+
+    @property
+    def idle(self):
+        return not self.items and not self.busy and self.bucket.full and self.paused_until <= time.monotonic()
+
+
+class _Send:
+    __slots__ = ('method', 'future', 'priority', 'seq', 'retries_left', 'queued_at')
+
+    def __init__(self, method, future, priority, seq, retries_left):
+        self.method = method
+        self.future = future
+        self.priority = priority
+        self.seq = seq
+        self.retries_left = retries_left
+        self.queued_at = time.monotonic()
+
+
+class OutboundQueue(BackgroundTask):
+    """Общая очередь исходящих запросов к Bot API.
+
+    Отправка идёт с темпом не выше SEND_GLOBAL_RATE в секунду на бота и SEND_CHAT_RATE на чат
+    (с допустимым всплеском SEND_CHAT_BURST); из готовых к отправке чатов первым обслуживается
+    сообщение с наивысшим приоритетом.
+    После RetryAfter чат ставится на паузу, массовые сообщения приостанавливаются для всех чатов,
+    а сообщение повторяется до SEND_MAX_RETRIES раз. Порядок сообщений одного приоритета
+    в пределах чата сохраняется.
+    """
+
+    task_name = "outbound_queue"
+
+    def __init__(self, bot, global_rate=SEND_GLOBAL_RATE, global_burst=SEND_GLOBAL_BURST, chat_rate=SEND_CHAT_RATE,
+                 chat_burst=SEND_CHAT_BURST, concurrency=SEND_CONCURRENCY, bulk_limit=SEND_BULK_QUEUE_LIMIT):
+        self.bot = bot
+        self.global_bucket = TokenBucket(global_burst, global_rate)
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.concurrency = concurrency
+        self.bulk_limit = bulk_limit
+        self._chats = {}
+        # (priority, seq, chat_id) чатов, у которых есть сообщения; устаревшие записи пропускаются
+        self._ready = []
+        # (время готовности, seq, chat_id) чатов, исчерпавших свой лимит или стоящих на паузе
+        self._delayed = []
+        self._seq = itertools.count()
+        self._pending = 0
+        self._bulk_paused_until = 0.0
+        self._wakeup = None
+        self._slots = None
+        self._bulk_slots = None
+        # Выполняющиеся отправки: ссылки не дают сборщику мусора удалить задачу посреди запроса
+        self._sending = set()
+        CallbackGauge('bot_outbound_queue_size', 'Сообщения в очереди отправки', lambda: self._pending)
+
+    def _push_ready(self, chat):
+        if chat.items and not chat.busy:
+            priority, seq, _ = chat.items[0]
+            heapq.heappush(self._ready, (priority, seq, chat.chat_id))
+
+    def _prune_chats(self):
+        self._chats = {chat_id: chat for chat_id, chat in self._chats.items() if not chat.idle}
+
+    def _get_chat(self, chat_id):
+        chat = self._chats.get(chat_id)
+        if chat is None:
+            if len(self._chats) >= CHATS_PRUNE_SIZE:
+                self._prune_chats()
+            chat = self._chats[chat_id] = _Chat(chat_id, self.chat_rate, self.chat_burst)
+        return chat
+
+    # Постановка в очередь; для массовых сообщений ждёт свободного места, возвращает future с результатом
+    async def submit(self, chat_id, method, priority=PRIORITY_INTERACTIVE, max_retries=SEND_MAX_RETRIES):
+        future = asyncio.get_running_loop().create_future()
+        if not self.running:
+            # Очередь не запущена (например, во время остановки бота): отправляем напрямую
+            future.set_result(await self.bot(method))
+            return future
+        if priority == PRIORITY_BULK:
+            await self._bulk_slots.acquire()
+            future.add_done_callback(lambda _: self._bulk_slots.release())
+        chat = self._get_chat(chat_id)
+        item = _Send(method, future, priority, next(self._seq), max_retries)
+        heapq.heappush(chat.items, (priority, item.seq, item))
+        self._pending += 1
+        self._push_ready(chat)
+        self._wakeup.set()
+        return future
+
+    # Отправка с ожиданием результата; method - объект метода aiogram, например message.answer(...)
+    async def send(self, chat_id, method, priority=PRIORITY_INTERACTIVE, max_retries=SEND_MAX_RETRIES):
+        return await (await self.submit(chat_id, method, priority, max_retries))
+
+    def _promote_delayed(self, now):
+        while self._delayed and self._delayed[0][0] <= now:
+            _, _, chat_id = heapq.heappop(self._delayed)
+            chat = self._chats.get(chat_id)
+            if chat is not None:
+                self._push_ready(chat)
+
+    # Через сколько секунд чат сможет отправить сообщение с данным приоритетом
+    def _chat_delay(self, chat, priority, now):
+        delay = max(chat.bucket.wait_time(), chat.paused_until - now)
+        if priority == PRIORITY_BULK:
+            delay = max(delay, self._bulk_paused_until - now)
+        return delay
+
+    async def _run(self):
+        while True:
+            now = time.monotonic()
+            self._promote_delayed(now)
+            if not self._ready:
+                timeout = self._delayed[0][0] - now if self._delayed else None
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=timeout)
+                except asyncio.TimeoutError:
+                    pass
+                self._wakeup.clear()
+                continue
+
+            priority, seq, chat_id = heapq.heappop(self._ready)
+            chat = self._chats.get(chat_id)
+            if chat is None or chat.busy or not chat.items or chat.items[0][:2] != (priority, seq):
+                continue
+            delay = self._chat_delay(chat, priority, now)
+            if delay > 0:
+                heapq.heappush(self._delayed, (now + delay, next(self._seq), chat_id))
+                continue
+            if not self.global_bucket.try_acquire():
+                # Общий лимит исчерпан: ждём токен и заново выбираем самое важное сообщение
+                heapq.heappush(self._ready, (priority, seq, chat_id))
+                await asyncio.sleep(self.global_bucket.wait_time())
+                continue
+            await self._slots.acquire()
+            chat.bucket.try_acquire()
+            chat.busy = True
+            _, _, item = heapq.heappop(chat.items)
+            task = asyncio.create_task(self._send(chat, item))
+            self._sending.add(task)
+            task.add_done_callback(self._sending.discard)
+
+    async def _send(self, chat, item):
+        label = PRIORITY_NAMES[item.priority]
+        OUTBOUND_WAIT_SECONDS.labels(label).observe(time.monotonic() - item.queued_at)
+        requeue = False
+        try:
+            if item.future.done():
+                # Отправитель отменил ожидание, сообщение больше не нужно
+                return
+            result = await self.bot(item.method)
+        except TelegramRetryAfter as e:
+            now = time.monotonic()
+            chat.paused_until = now + e.retry_after
+            self._bulk_paused_until = max(self._bulk_paused_until, now + e.retry_after)
+            logging.warning("Telegram попросил подождать %s с перед отправкой в чат %s", e.retry_after, chat.chat_id)
+            if item.retries_left > 0 and not item.future.done():
+                OUTBOUND_RETRIES.labels(label).inc()
+                item.retries_left -= 1
+                requeue = True
+            else:
+                OUTBOUND_SENT.labels(label, 'retry_after').inc()
+                if not item.future.done():
+                    item.future.set_exception(e)
+        except Exception as e:
+            OUTBOUND_SENT.labels(label, 'error').inc()
+            if not item.future.done():
+                item.future.set_exception(e)
+        else:
+            OUTBOUND_SENT.labels(label, 'ok').inc()
+            if not item.future.done():
+                item.future.set_result(result)
+        finally:
+            if requeue:
+                # Прежний seq возвращает сообщение на его место в очереди чата
+                heapq.heappush(chat.items, (item.priority, item.seq, item))
+            else:
+                self._pending -= 1
+            chat.busy = False
+            self._slots.release()
+            self._push_ready(chat)
+            self._wakeup.set()
+
+    def _prepare(self):
+        self._wakeup = asyncio.Event()
+        self._slots = asyncio.Semaphore(self.concurrency)
+        self._bulk_slots = asyncio.Semaphore(self.bulk_limit)
+
+    async def start(self):
+        if await super().start():
+            logging.info("Запущена очередь отправки сообщений")
+
+    async def stop(self):
+        await super().stop()
+        # Дожидаемся начатых отправок; сообщения, отложенные после RetryAfter, вернутся в очереди чатов
+        await asyncio.gather(*self._sending, return_exceptions=True)
+        # Ответы пользователям отправляем напрямую, чтобы не потерять их; массовые сообщения отменяются
+        left = sorted((entry for chat in self._chats.values() for entry in chat.items), key=lambda entry: entry[:2])
+        for chat in self._chats.values():
+            chat.items.clear()
+        sent = 0
+        for priority, _, item in left:
+            if item.future.done():
+                continue
+            if priority == PRIORITY_BULK:
+                item.future.cancel()
+                continue
+            try:
+                item.future.set_result(await self.bot(item.method))
+                sent += 1
+            except Exception as e:
+                item.future.set_exception(e)
+        self._pending = 0
+        logging.info("Очередь отправки остановлена, при завершении отправлено напрямую: %s", sent)
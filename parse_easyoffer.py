@@ -1,13 +1,43 @@
-import requests
-from bs4 import BeautifulSoup
+import argparse
+import os
 import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+import requests
+from bs4 import BeautifulSoup, SoupStrainer
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from question_hash import question_hash
+
+URL = "https://easyoffer.ru/rating/python_developer?page="
+PAGES = range(1, 12)
+FETCH_WORKERS = 4
+
+# lxml заметно быстрее встроенного парсера, но необязателен
+try:
+    import lxml  # noqa: F401
+    HTML_PARSER = 'lxml'
+except ImportError:
+    HTML_PARSER = 'html.parser'
+
+
+# Одна сессия с пулом соединений и повторами на все страницы
+def create_session(workers=FETCH_WORKERS):
+    session = requests.Session()
+    retries = Retry(total=3, backoff_factor=0.5, status_forcelist=(429, 500, 502, 503, 504))
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=workers, max_retries=retries)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
 
-def get_html(url):
-    response = requests.get(url)
+
+def get_html(url, session=None):
+    response = (session or requests).get(url, timeout=30)
+    response.raise_for_status()
     return response.text
 
+
 def read_table(html):
-    soup = BeautifulSoup(html, 'html.parser')
+    soup = BeautifulSoup(html, HTML_PARSER, parse_only=SoupStrainer('tr'))
     questions = []
     question_rows = soup.find_all('tr')
     for row in question_rows:
@@ -17,34 +47,105 @@ def read_table(html):
             category_element = row.find_all('td')[2]
             category_text = category_element.text.strip()
             questions.append((question_text, category_text))
-            print(f"Question: {question_text}, Category: {category_text}")
         except Exception as e:
             print(f"Ошибка при парсинге строки: {e}")
 
     return questions
 
-def parsing_easyoffer():
-    url = "https://easyoffer.ru/rating/python_developer?page="
-    parsed_data = []
 
-    for page in range(1, 12):
-        url_page = url + str(page).strip()
+def fixture_path(fixtures_dir, page):
+    return os.path.join(fixtures_dir, f"page_{page}.html")
+
+
+# Загрузка страниц параллельно; при fixtures_dir страницы читаются из сохранённых HTML-файлов
+def fetch_pages(pages=PAGES, fixtures_dir=None, save_fixtures_dir=None, workers=FETCH_WORKERS):
+    if fixtures_dir:
+        pages_html = {}
+        for page in pages:
+            with open(fixture_path(fixtures_dir, page), encoding='utf-8') as f:
+                pages_html[page] = f.read()
+        return pages_html
+
+    session = create_session(workers)
+
+    def load(page):
+        url_page = URL + str(page)
         print(f"Loading page: {url_page}")
-        html = get_html(url_page)
-        cur_page = read_table(html)
-        parsed_data.extend(cur_page)
+        return page, get_html(url_page, session)
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        pages_html = dict(executor.map(load, pages))
+    session.close()
+
+    if save_fixtures_dir:
+        os.makedirs(save_fixtures_dir, exist_ok=True)
+        for page, html in pages_html.items():
+            with open(fixture_path(save_fixtures_dir, page), 'w', encoding='utf-8') as f:
+                f.write(html)
+    return pages_html
+
+
+def parsing_easyoffer(fixtures_dir=None, save_fixtures_dir=None, database='questions.db'):
+    pages_html = fetch_pages(fixtures_dir=fixtures_dir, save_fixtures_dir=save_fixtures_dir)
+    parsed_data = []
+    # Порядок страниц сохраняется, чтобы новые вопросы получали id в порядке рейтинга
+    for page in sorted(pages_html):
+        parsed_data.extend(read_table(pages_html[page]))
+    print(f"Разобрано вопросов: {len(parsed_data)}")
 
-    create_database(parsed_data)
+    create_database(parsed_data, database)
 
-def create_database(questions):
-    conn = sqlite3.connect('questions.db')
+
+def ensure_questions_schema(conn):
     c = conn.cursor()
-    c.execute('DROP TABLE IF EXISTS questions')  # Удаление существующей таблицы
-    c.execute('''CREATE TABLE questions
+    c.execute('''CREATE TABLE IF NOT EXISTS questions
                  (id INTEGER PRIMARY KEY, question TEXT, category TEXT)''')
-    c.executemany('INSERT INTO questions (question, category) VALUES (?, ?)', questions)
-    conn.commit()
+    columns = [row[1] for row in c.execute('PRAGMA table_info(questions)')]
+    if 'content_hash' not in columns:
+        c.execute('ALTER TABLE questions ADD COLUMN content_hash TEXT')
+    missing = c.execute('SELECT id, question FROM questions WHERE content_hash IS NULL').fetchall()
+    c.executemany('UPDATE questions SET content_hash = ? WHERE id = ?',
+                  [(question_hash(question), question_id) for question_id, question in missing])
+    c.execute('CREATE INDEX IF NOT EXISTS idx_questions_content_hash ON questions (content_hash)')
+
+
+# Обновление корпуса без пересоздания таблицы: id существующих вопросов не меняются,
+# затрагиваются только новые вопросы и вопросы со сменившейся категорией
+def create_database(questions, database='questions.db'):
+    conn = sqlite3.connect(database, timeout=30)
+    # WAL: бот продолжает читать вопросы, пока идёт короткая транзакция обновления
+    conn.execute('PRAGMA journal_mode=WAL')
+    with conn:
+        ensure_questions_schema(conn)
+        existing = {}
+        for question_id, category, content_hash in conn.execute(
+                'SELECT id, category, content_hash FROM questions ORDER BY id'):
+            existing.setdefault(content_hash, (question_id, category))
+
+        inserts = []
+        updates = []
+        seen = set()
+        for question, category in questions:
+            content_hash = question_hash(question)
+            if content_hash in seen:
+                continue
+            seen.add(content_hash)
+            if content_hash not in existing:
+                inserts.append((question, category, content_hash))
+            elif existing[content_hash][1] != category:
+                updates.append((category, existing[content_hash][0]))
+
+        conn.executemany('INSERT INTO questions (question, category, content_hash) VALUES (?, ?, ?)', inserts)
+        conn.executemany('UPDATE questions SET category = ? WHERE id = ?', updates)
     conn.close()
+    print(f"Новых вопросов: {len(inserts)}, обновлено категорий: {len(updates)}, "
+          f"без изменений: {len(seen) - len(inserts) - len(updates)}")
+
 
 if __name__ == "__main__":
-    parsing_easyoffer()
+    parser = argparse.ArgumentParser(description="Загрузка вопросов с easyoffer.ru в questions.db")
+    parser.add_argument('--fixtures', help="каталог с сохранёнными страницами page_N.html (без сети)")
+    parser.add_argument('--save-fixtures', help="сохранить загруженные страницы в каталог")
+    parser.add_argument('--database', default='questions.db', help="путь к базе вопросов")
+    args = parser.parse_args()
+    parsing_easyoffer(fixtures_dir=args.fixtures, save_fixtures_dir=args.save_fixtures, database=args.database)
@@ -0,0 +1,143 @@
+import logging
+import math
+from collections import Counter as TermCounter
+import config
+from database import QUESTIONS_DB, get_connection, run_db
+from grading_cache import normalize_answer
+from metrics import Counter, Histogram, timed
+from reference_answers import reference_answers
+
+# 'off' - выключена, 'shadow' - только сравнивается с OpenAI, 'on' - уверенные вердикты заменяют запрос к OpenAI
+PRE_GRADER_MODE = getattr(config, 'PRE_GRADER_MODE', 'shadow')
+# Минимальная уверенность, при которой локальный вердикт считается окончательным
+PRE_GRADER_THRESHOLD = getattr(config, 'PRE_GRADER_THRESHOLD', 0.9)
+# Слова обрезаются до префикса: грубая замена стемминга для русских окончаний
+STEM_LENGTH = 5
+# Ответы длиннее этого числа слов могут быть признаны не относящимися к теме
+OFF_TOPIC_MIN_WORDS = 5
+
+NON_ANSWERS = {
+    "не знаю", "я не знаю", "незнаю", "не помню", "без понятия", "понятия не имею", "хз", "пас",
+    "пропустить", "пропуск", "нет ответа", "dont know", "don t know", "i don t know", "idk", "skip", "pass",
+}
+
+PRE_GRADER_SECONDS = Histogram('bot_pre_grader_seconds', 'Время локальной предпроверки ответа')
+PRE_GRADER_VERDICTS = Counter('bot_pre_grader_verdicts_total', 'Уверенные вердикты локальной предпроверки', ('rule',))
+PRE_GRADER_AGREEMENT = Counter('bot_pre_grader_agreement_total',
+                               'Сравнение уверенных вердиктов предпроверки с вердиктами OpenAI', ('rule', 'result'))
+
+
+def tokenize(text):
+    return [word[:STEM_LENGTH] for word in normalize_answer(text).split()]
+
+
+def _normalize_vector(vector):
+    norm = math.sqrt(sum(weight * weight for weight in vector.values()))
+    return {term: weight / norm for term, weight in vector.items()} if norm else {}
+
+
+class PreGrader:
+    """Быстрая локальная предпроверка ответа до обращения к OpenAI.
+
+    Индекс TF-IDF строится по корпусу вопросов и эталонным ответам (таблица reference_answers,
+    если она есть). Предпроверка отсекает пустые ответы, отказы вроде "не знаю" и повтор вопроса,
+    а при наличии эталона - ответы не по теме и ответы, почти совпадающие с эталоном.
+    Неуверенные случаи (confidence ниже порога) уходят в OpenAI.
+    """
+
+    def __init__(self, questions_db=QUESTIONS_DB, mode=PRE_GRADER_MODE, threshold=PRE_GRADER_THRESHOLD):
+        self.questions_db = questions_db
+        self.mode = mode
+        self.threshold = threshold
+        self._idf = {}
+        self._default_idf = 1.0
+        self._references = {}
+        self._loaded = False
+
+    def load(self):
+        conn = get_connection(self.questions_db)
+        questions = conn.execute('SELECT id, question FROM questions').fetchall()
+        reference_answers.ensure_loaded()
+        references = {question_id: answer for question_id, (answer, _) in reference_answers.items()}
+
+        documents = [set(tokenize(question)) | set(tokenize(references.get(question_id, "")))
+                     for question_id, question in questions]
+        document_frequency = TermCounter(term for document in documents for term in document)
+        total = len(documents)
+        self._idf = {term: math.log((total + 1) / (frequency + 1)) + 1
+                     for term, frequency in document_frequency.items()}
+        self._default_idf = math.log(total + 1) + 1
+        question_texts = dict(questions)
+        self._references = {question_id: (answer, self._vector(tokenize(answer)),
+                                          self._vector(tokenize(question_texts.get(question_id, "") + " " + answer)))
+                            for question_id, answer in references.items()}
+        self._loaded = True
+        logging.info("Индекс предпроверки построен: %s вопросов, %s эталонных ответов", total, len(references))
+
+    async def start(self):
+        if self.mode != 'off' and not self._loaded:
+            await run_db(self.load)
+
+    def _vector(self, tokens):
+        counts = TermCounter(tokens)
+        return _normalize_vector({term: count * self._idf.get(term, self._default_idf)
+                                  for term, count in counts.items()})
+
+    # Лучший кандидат на вердикт: (correctness, explanation, rule, confidence)
+    def evaluate(self, question_id, question, user_answer):
+        tokens = tokenize(user_answer)
+        if not tokens:
+            return "Неправильно", "Ответ не содержит слов. Попробуйте ответить развёрнуто.", 'empty', 1.0
+        if ' '.join(normalize_answer(user_answer).split()) in NON_ANSWERS:
+            return ("Неправильно", "Ответ не дан. Попробуйте сформулировать, что вы знаете по теме вопроса.",
+                    'non_answer', 0.95)
+
+        answer_terms = set(tokens)
+        question_terms = set(tokenize(question))
+        if question_terms and answer_terms <= question_terms:
+            # Ответ целиком состоит из слов вопроса: чем больше значимых (редких) слов вопроса
+            # он повторяет, тем увереннее вердикт
+            confidence = (sum(self._idf.get(term, self._default_idf) for term in answer_terms)
+                          / sum(self._idf.get(term, self._default_idf) for term in question_terms))
+            return "Неправильно", "Ответ повторяет вопрос и не раскрывает тему.", 'copy', confidence
+
+        reference = self._references.get(question_id)
+        if reference is None:
+            return None
+        reference_answer, reference_vector, topic_vector = reference
+        answer_vector = self._vector(tokens)
+        similarity = sum(weight * reference_vector.get(term, 0.0) for term, weight in answer_vector.items())
+        if similarity >= 0.5:
+            return "Правильно", f"Ответ совпадает с эталонным: {reference_answer}", 'reference', similarity
+        if len(tokens) >= OFF_TOPIC_MIN_WORDS:
+            # Перефразированный верный ответ может не совпасть с эталоном по словам,
+            # поэтому даже ответ без общих слов с вопросом и эталоном получает уверенность не выше 0.9
+            topic_similarity = sum(weight * topic_vector.get(term, 0.0) for term, weight in answer_vector.items())
+            return "Неправильно", "Ответ не относится к теме вопроса.", 'off_topic', 0.9 * (1 - topic_similarity)
+        return None
+
+    # Уверенный вердикт (correctness, explanation, rule) или None, если ответ нужно проверить в OpenAI
+    @timed(PRE_GRADER_SECONDS)
+    def check(self, question_id, question, user_answer):
+        if self.mode == 'off' or not self._loaded:
+            return None
+        candidate = self.evaluate(question_id, question, user_answer)
+        if candidate is None or candidate[3] < self.threshold:
+            return None
+        PRE_GRADER_VERDICTS.labels(candidate[2]).inc()
+        return candidate[:3]
+
+    # Теневой режим: насколько уверенные локальные вердикты совпадают с вердиктами OpenAI
+    def compare(self, verdict, correctness):
+        correctness, rule = correctness.lower(), verdict[2]
+        result = 'agree' if verdict[0].lower() == correctness else 'disagree'
+        PRE_GRADER_AGREEMENT.labels(rule, result).inc()
+        if result == 'disagree':
+            logging.info("Предпроверка (%s) разошлась с OpenAI: %s против %s", rule, verdict[0], correctness)
+
+    @property
+    def enforcing(self):
+        return self.mode == 'on'
+
+
+pre_grader = PreGrader()
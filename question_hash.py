@@ -0,0 +1,7 @@
+import hashlib
+
+
+# Ключ вопроса - хеш нормализованного текста: от него не зависят регистр и пробелы
+def question_hash(question):
+    normalized = ' '.join(question.lower().split())
+    return hashlib.sha1(normalized.encode('utf-8')).hexdigest()
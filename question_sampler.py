@@ -0,0 +1,189 @@
+import logging
+import random
+import sqlite3
+import time
+from array import array
+import config
+from database import USERS_DB, QUESTIONS_DB, get_connection
+
+# Вероятность выбора вопроса, на который был дан неправильный ответ
+RETRY_PROBABILITY = 0.3
+# Сколько случайных попыток делаем до перехода к полному перебору нерешённых вопросов
+MAX_SAMPLE_ATTEMPTS = 16
+# Как часто проверяем, не обновил ли parse_easyoffer.py базу вопросов, в секундах
+QUESTIONS_REFRESH_INTERVAL = getattr(config, 'QUESTIONS_REFRESH_INTERVAL', 60)
+
+
+class _UserState:
+    """Решённые вопросы пользователя (битовая маска по позициям) и вопросы с ошибками."""
+
+    __slots__ = ('solved', 'solved_count', 'failed', 'failed_positions')
+
+    def __init__(self, size):
+        self.solved = bytearray((size + 7) // 8)
+        self.solved_count = 0
+        self.failed = []
+        self.failed_positions = set()
+
+    def is_solved(self, position):
+        return self.solved[position >> 3] & (1 << (position & 7))
+
+    def mark_solved(self, position):
+        if not self.is_solved(position):
+            self.solved[position >> 3] |= 1 << (position & 7)
+            self.solved_count += 1
+
+    def mark_failed(self, position):
+        if position not in self.failed_positions:
+            self.failed_positions.add(position)
+            self.failed.append(position)
+
+    # Новые вопросы добавляются в конец, поэтому достаточно дорастить битовую маску
+    def grow(self, size):
+        self.solved.extend(bytes((size + 7) // 8 - len(self.solved)))
+
+
+class QuestionSampler:
+    """Выбор следующего вопроса в памяти, без ORDER BY RANDOM() и NOT IN на каждом запросе."""
+
+    def __init__(self, questions_db=QUESTIONS_DB, users_db=USERS_DB, retry_probability=RETRY_PROBABILITY):
+        self.questions_db = questions_db
+        self.users_db = users_db
+        self.retry_probability = retry_probability
+        self._ids = array('l')
+        self._rows = []
+        self._positions = {}
+        self._users = {}
+        self._loaded = False
+        self._data_version = None
+        self._next_refresh = 0.0
+
+    # Загрузка вопросов в компактный массив
+    def load(self):
+        c = get_connection(self.questions_db).cursor()
+        c.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='questions'")
+        if c.fetchone() is None:
+            logging.error("Таблица 'questions' не существует в базе данных.")
+            raise sqlite3.OperationalError("no such table: questions")
+        self._data_version = c.execute('PRAGMA data_version').fetchone()[0]
+        c.execute('SELECT id, question, category FROM questions ORDER BY id')
+        rows = c.fetchall()
+        old_ids = self._ids
+        ids = array('l', (row[0] for row in rows))
+        self._ids = ids
+        self._rows = rows
+        self._positions = {question_id: position for position, question_id in enumerate(ids)}
+        if ids[:len(old_ids)] == old_ids:
+            # Вопросы только добавились: позиции прежние, состояние пользователей сохраняется
+            for state in self._users.values():
+                state.grow(len(ids))
+        else:
+            # Позиции вопросов изменились, состояние пользователей будет загружено заново
+            self._users = {}
+        self._loaded = True
+        logging.info("Загружено вопросов: %s", len(ids))
+
+    # Перезагрузка вопросов, если база изменилась из другого соединения (например, парсером)
+    def refresh_if_changed(self):
+        now = time.monotonic()
+        if now < self._next_refresh:
+            return False
+        self._next_refresh = now + QUESTIONS_REFRESH_INTERVAL
+        data_version = get_connection(self.questions_db).execute('PRAGMA data_version').fetchone()[0]
+        if data_version == self._data_version:
+            return False
+        logging.info("База вопросов изменилась, перезагружаем вопросы")
+        self.load()
+        return True
+
+    def _ensure_loaded(self):
+        if not self._loaded:
+            self.load()
+            self._next_refresh = time.monotonic() + QUESTIONS_REFRESH_INTERVAL
+        else:
+            self.refresh_if_changed()
+
+    # История пользователя читается из question_history по ключу: одна строка на вопрос, а не на попытку
+    def _get_user(self, telegram_id):
+        state = self._users.get(telegram_id)
+        if state is None:
+            state = _UserState(len(self._ids))
+            rows = get_connection(self.users_db).execute(
+                'SELECT question_id, attempts, correct_attempts FROM question_history WHERE telegram_id = ?',
+                (telegram_id,)).fetchall()
+            for question_id, attempts, correct_attempts in rows:
+                position = self._positions.get(question_id)
+                if position is None:
+                    continue
+                if correct_attempts:
+                    state.mark_solved(position)
+                if attempts > correct_attempts:
+                    state.mark_failed(position)
+            self._users[telegram_id] = state
+        return state
+
+    def forget_user(self, telegram_id):
+        self._users.pop(telegram_id, None)
+
+    def _pick_unsolved(self, state, exclude=None):
+        size = len(self._ids)
+        if state.solved_count >= size:
+            return None
+        for _ in range(MAX_SAMPLE_ATTEMPTS):
+            position = random.randrange(size)
+            if not state.is_solved(position) and (exclude is None or self._ids[position] not in exclude):
+                return position
+        # Почти все вопросы решены: выбираем из явного списка оставшихся
+        unsolved = [position for position in range(size)
+                    if not state.is_solved(position) and (exclude is None or self._ids[position] not in exclude)]
+        return random.choice(unsolved) if unsolved else None
+
+    def get_question(self, question_id):
+        self._ensure_loaded()
+        position = self._positions.get(question_id)
+        return self._rows[position] if position is not None else None
+
+    # Случайный вопрос без учёта истории пользователя, например для вопроса дня
+    def random_question(self):
+        self._ensure_loaded()
+        return random.choice(self._rows) if self._rows else None
+
+    # Новый (ещё не решённый) вопрос, минуя повтор ошибок; exclude - id, которые выбирать нельзя
+    def pick_new(self, telegram_id, exclude=None):
+        self._ensure_loaded()
+        position = self._pick_unsolved(self._get_user(telegram_id), exclude)
+        return self._rows[position] if position is not None else None
+
+    def pick(self, telegram_id):
+        self._ensure_loaded()
+        state = self._get_user(telegram_id)
+
+        if state.failed and random.random() < self.retry_probability:
+            logging.debug("Попытка выбрать вопрос с неправильным ответом")
+            question = self._rows[random.choice(state.failed)]
+            logging.debug("Выбран вопрос с неправильным ответом: %s", question)
+            return question
+
+        logging.debug("Попытка выбрать новый вопрос")
+        position = self._pick_unsolved(state)
+        if position is None:
+            logging.info("Не удалось выбрать новый вопрос")
+            return None
+        question = self._rows[position]
+        logging.debug("Выбран новый вопрос: %s", question)
+        return question
+
+    # Обновление состояния пользователя сразу после ответа, ещё до записи в базу
+    def record_answer(self, telegram_id, question_id, correct):
+        self._ensure_loaded()
+        position = self._positions.get(question_id)
+        if position is None:
+            return
+        state = self._get_user(telegram_id)
+        if correct:
+            state.mark_solved(position)
+        else:
+            state.mark_failed(position)
+
+
+question_sampler = QuestionSampler()
@@ -0,0 +1,178 @@
+import argparse
+import asyncio
+import json
+import logging
+import sqlite3
+import time
+from openai import AsyncOpenAI
+import config
+from config import OPENAI_API_KEY
+from database import QUESTIONS_DB, get_connection, run_db
+from llm_client import get_async_client
+from question_hash import question_hash
+
+# Модель и параметры пакетной генерации эталонных ответов
+REFERENCE_MODEL = getattr(config, 'REFERENCE_MODEL', "gpt-4o")
+REFERENCE_CONCURRENCY = getattr(config, 'REFERENCE_CONCURRENCY', 4)
+REFERENCE_REQUESTS_PER_MINUTE = getattr(config, 'REFERENCE_REQUESTS_PER_MINUTE', 60)
+REFERENCE_PROMPT = getattr(config, 'REFERENCE_PROMPT', (
+    "Ты проводишь собеседования Python-разработчиков. Для заданного вопроса дай краткий эталонный ответ "
+    "в 2-4 предложениях и от 3 до 5 ключевых пунктов, которые должен упомянуть кандидат. "
+    "Ответь JSON-объектом вида {\"answer\": \"...\", \"key_points\": [\"...\"]}."
+))
+
+
+def create_reference_answers_table(conn):
+    conn.execute('''CREATE TABLE IF NOT EXISTS reference_answers
+                    (question_id INTEGER PRIMARY KEY, answer TEXT, key_points TEXT, model TEXT,
+                     question_hash TEXT, created_at REAL)''')
+
+
+class ReferenceAnswers:
+    """Эталонные ответы и ключевые пункты из таблицы reference_answers в памяти процесса."""
+
+    def __init__(self, questions_db=QUESTIONS_DB):
+        self.questions_db = questions_db
+        self._answers = {}
+        self._loaded = False
+
+    def load(self):
+        conn = get_connection(self.questions_db)
+        self._answers = {}
+        if conn.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='reference_answers'").fetchone():
+            for question_id, answer, key_points in conn.execute(
+                    'SELECT question_id, answer, key_points FROM reference_answers'):
+                self._answers[question_id] = (answer, key_points.split('\n') if key_points else [])
+        self._loaded = True
+        logging.info("Загружено эталонных ответов: %s", len(self._answers))
+
+    def ensure_loaded(self):
+        if not self._loaded:
+            self.load()
+
+    async def start(self):
+        await run_db(self.ensure_loaded)
+
+    # (answer, key_points) или None, если эталон для вопроса ещё не построен
+    def get(self, question_id):
+        return self._answers.get(question_id)
+
+    def items(self):
+        return self._answers.items()
+
+
+reference_answers = ReferenceAnswers()
+
+
+def parse_reference(content):
+    try:
+        data = json.loads(content)
+        key_points = [str(point).strip() for point in data.get('key_points', []) if str(point).strip()]
+        return str(data['answer']).strip(), key_points
+    except (ValueError, KeyError, AttributeError):
+        # Модель ответила не JSON: сохраняем текст целиком как эталон без ключевых пунктов
+        return content.strip(), []
+
+
+class RateLimiter:
+    """Равномерное распределение запросов: не больше requests_per_minute стартов в минуту."""
+
+    def __init__(self, requests_per_minute):
+        self.interval = 60 / requests_per_minute if requests_per_minute else 0.0
+        self._next_start = 0.0
+        self._lock = asyncio.Lock()
+
+    async def wait(self):
+        async with self._lock:
+            now = time.monotonic()
+            delay = self._next_start - now
+            self._next_start = max(now, self._next_start) + self.interval
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+
+async def generate_reference(client, model, question):
+    completion = await client.chat.completions.create(
+        model=model,
+        messages=[
+            {"role": "system", "content": REFERENCE_PROMPT},
+            {"role": "user", "content": f"Вопрос: {question}"}
+        ],
+        response_format={"type": "json_object"}
+    )
+    return parse_reference(completion.choices[0].message.content)
+
+
+# Вопросы без эталона или с изменившимся с момента генерации текстом
+def pending_questions(conn, force=False):
+    existing = {} if force else dict(conn.execute('SELECT question_id, question_hash FROM reference_answers'))
+    return [(question_id, question) for question_id, question in
+            conn.execute('SELECT id, question FROM questions ORDER BY id')
+            if existing.get(question_id) != question_hash(question)]
+
+
+# Пакетная генерация: каждый эталон сохраняется сразу, поэтому прерванный запуск продолжается с того же места
+async def build_reference_answers(database=QUESTIONS_DB, model=REFERENCE_MODEL, concurrency=REFERENCE_CONCURRENCY,
+                                  requests_per_minute=REFERENCE_REQUESTS_PER_MINUTE, limit=None, force=False,
+                                  client=None):
+    conn = sqlite3.connect(database, timeout=30)
+    conn.execute('PRAGMA journal_mode=WAL')
+    with conn:
+        create_reference_answers_table(conn)
+    todo = pending_questions(conn, force)
+    if limit is not None:
+        todo = todo[:limit]
+    print(f"Вопросов без эталонного ответа: {len(todo)}")
+
+    client = client or get_async_client()
+    limiter = RateLimiter(requests_per_minute)
+    semaphore = asyncio.Semaphore(concurrency)
+    done = failed = 0
+
+    async def process(question_id, question):
+        nonlocal done, failed
+        async with semaphore:
+            await limiter.wait()
+            try:
+                answer, key_points = await generate_reference(client, model, question)
+            except Exception as e:
+                failed += 1
+                logging.error("Ошибка при генерации эталона для вопроса %s: %s", question_id, e)
+                return
+        with conn:
+            conn.execute('INSERT OR REPLACE INTO reference_answers '
+                         '(question_id, answer, key_points, model, question_hash, created_at) '
+                         'VALUES (?, ?, ?, ?, ?, ?)',
+                         (question_id, answer, '\n'.join(key_points), model, question_hash(question), time.time()))
+        done += 1
+        if done % 50 == 0:
+            print(f"Готово: {done}/{len(todo)}")
+
+    await asyncio.gather(*(process(question_id, question) for question_id, question in todo))
+    conn.close()
+    print(f"Сохранено эталонов: {done}, ошибок: {failed}")
+    return done, failed
+
+
+async def main(args):
+    client = None
+    if args.base_url:
+        client = AsyncOpenAI(api_key=OPENAI_API_KEY, base_url=args.base_url)
+    try:
+        await build_reference_answers(args.database, args.model, args.concurrency, args.rpm, args.limit,
+                                      args.force, client)
+    finally:
+        await (client.close() if client else get_async_client().close())
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description="Генерация эталонных ответов для вопросов из questions.db")
+    parser.add_argument('--database', default=QUESTIONS_DB, help="путь к базе вопросов")
+    parser.add_argument('--model', default=REFERENCE_MODEL, help="модель для генерации эталонов")
+    parser.add_argument('--concurrency', type=int, default=REFERENCE_CONCURRENCY, help="одновременных запросов")
+    parser.add_argument('--rpm', type=float, default=REFERENCE_REQUESTS_PER_MINUTE, help="запросов в минуту")
+    parser.add_argument('--limit', type=int, help="обработать не больше указанного числа вопросов")
+    parser.add_argument('--force', action='store_true', help="пересоздать все эталоны")
+    parser.add_argument('--base-url', help="адрес OpenAI-совместимого API, например локальной заглушки")
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,293 @@
+import asyncio
+import json
+import logging
+import time
+from urllib.parse import urlparse
+from aiogram.fsm.storage.base import BaseStorage
+import config
+from background import BackgroundTask
+from backend import save_pending_question, get_pending_question, claim_pending_question, load_pending_questions, \
+    load_expired_pending_questions, get_shared_value, set_shared_value, delete_shared_value, increment_shared_value
+from database import run_db
+
+# Где хранится общее для процессов бота состояние: 'sqlite' (users.db) или 'redis'
+STATE_BACKEND = getattr(config, 'STATE_BACKEND', 'sqlite')
+REDIS_URL = getattr(config, 'REDIS_URL', 'redis://127.0.0.1:6379/0')
+# Как часто процесс ищет просроченные вопросы, таймеры которых жили в другом (упавшем) процессе
+STATE_SWEEP_INTERVAL = getattr(config, 'STATE_SWEEP_INTERVAL', 30)
+# Время жизни выданного вопроса без дедлайна в Redis, в секундах
+REDIS_QUESTION_TTL = 7 * 24 * 3600
+
+
+class SQLiteStateBackend:
+    """Общее состояние в users.db: подходит для нескольких процессов на одной машине."""
+
+    async def save_question(self, telegram_id, question_id, question_text, token, deadline):
+        await run_db(save_pending_question, telegram_id, question_id, question_text, token, deadline)
+
+    # (question_id, question_text, token) или None
+    async def get_question(self, telegram_id):
+        return await run_db(get_pending_question, telegram_id)
+
+    # Изъятие вопроса: (question_id, question_text, token, deadline) или None;
+    # с token - только если вопрос не был заменён более новым
+    async def claim_question(self, telegram_id, token=None):
+        return await run_db(claim_pending_question, telegram_id, token)
+
+    # [(telegram_id, question_id, question_text, token, deadline)]
+    async def load_questions(self):
+        return await run_db(load_pending_questions)
+
+    # [(telegram_id, token)] с истёкшим дедлайном
+    async def expired_questions(self, now):
+        return await run_db(load_expired_pending_questions, now)
+
+    async def get(self, key):
+        return await run_db(get_shared_value, key)
+
+    async def set(self, key, value):
+        await run_db(set_shared_value, key, value)
+
+    async def delete(self, key):
+        await run_db(delete_shared_value, key)
+
+    async def incr(self, key):
+        return await run_db(increment_shared_value, key)
+
+    async def close(self):
+        pass
+
+
+class RedisError(Exception):
+    pass
+
+
+class RedisClient:
+    """Минимальный асинхронный клиент протокола RESP: одно соединение, команды по очереди."""
+
+    def __init__(self, url=REDIS_URL):
+        self.url = urlparse(url)
+        self._reader = None
+        self._writer = None
+        self._lock = asyncio.Lock()
+
+    async def _connect(self):
+        self._reader, self._writer = await asyncio.open_connection(self.url.hostname or '127.0.0.1',
+                                                                   self.url.port or 6379)
+        if self.url.password:
+            await self._command('AUTH', self.url.password)
+        database = self.url.path.lstrip('/')
+        if database:
+            await self._command('SELECT', database)
+        logging.info("Подключено к Redis %s:%s", self.url.hostname, self.url.port)
+
+    @staticmethod
+    def _encode(args):
+        parts = [b'*%d\r\n' % len(args)]
+        for arg in args:
+            if not isinstance(arg, bytes):
+                arg = str(arg).encode('utf-8')
+            parts.append(b'$%d\r\n%s\r\n' % (len(arg), arg))
+        return b''.join(parts)
+
+    async def _read_reply(self):
+        line = await self._reader.readline()
+        if not line:
+            raise ConnectionError("Соединение с Redis закрыто")
+        prefix, payload = line[:1], line[1:-2]
+        if prefix == b'+':
+            return payload.decode('utf-8')
+        if prefix == b'-':
+            raise RedisError(payload.decode('utf-8'))
+        if prefix == b':':
+            return int(payload)
+        if prefix == b'$':
+            length = int(payload)
+            if length < 0:
+                return None
+            data = await self._reader.readexactly(length + 2)
+            return data[:-2].decode('utf-8')
+        if prefix == b'*':
+            length = int(payload)
+            if length < 0:
+                return None
+            return [await self._read_reply() for _ in range(length)]
+        raise RedisError(f"Неизвестный ответ Redis: {line!r}")
+
+    async def _command(self, *args):
+        self._writer.write(self._encode(args))
+        await self._writer.drain()
+        return await self._read_reply()
+
+    async def execute(self, *args):
+        async with self._lock:
+            try:
+                if self._writer is None:
+                    await self._connect()
+                return await self._command(*args)
+            except BaseException:
+                # Обрыв соединения, ошибка или отмена задачи между отправкой команды и чтением ответа:
+                # непрочитанный ответ остался бы в сокете и достался следующей команде, поэтому
+                # соединение закрывается, а при следующей команде подключимся заново
+                if self._writer is not None:
+                    self._writer.close()
+                    self._writer = None
+                raise
+
+    async def close(self):
+        if self._writer is not None:
+            self._writer.close()
+            await self._writer.wait_closed()
+            self._writer = None
+
+
+class RedisStateBackend:
+    """Общее состояние в Redis: для процессов бота на разных машинах.
+
+    pending:<telegram_id> указывает на токен текущего вопроса, сам вопрос лежит в question:<token>,
+    дедлайны - в сортированном множестве question_deadlines. Вопрос изымается через GETDEL,
+    поэтому ответ и истечение таймера в разных процессах не обрабатывают его дважды.
+    """
+
+    def __init__(self, url=REDIS_URL):
+        self.client = RedisClient(url)
+
+    async def save_question(self, telegram_id, question_id, question_text, token, deadline):
+        ttl = REDIS_QUESTION_TTL if deadline is None else max(1, int(deadline - time.time())) + REDIS_QUESTION_TTL
+        value = json.dumps([telegram_id, question_id, question_text, token, deadline], ensure_ascii=False)
+        await self.client.execute('SET', f"question:{token}", value, 'EX', ttl)
+        previous_token = await self.client.execute('SET', f"pending:{telegram_id}", token, 'EX', ttl, 'GET')
+        if previous_token and previous_token != token:
+            await self._drop(previous_token)
+        if deadline is not None:
+            await self.client.execute('ZADD', 'question_deadlines', deadline, token)
+
+    async def _drop(self, token):
+        await self.client.execute('DEL', f"question:{token}")
+        await self.client.execute('ZREM', 'question_deadlines', token)
+
+    async def get_question(self, telegram_id):
+        token = await self.client.execute('GET', f"pending:{telegram_id}")
+        if token is None:
+            return None
+        value = await self.client.execute('GET', f"question:{token}")
+        if value is None:
+            return None
+        _, question_id, question_text, token, _ = json.loads(value)
+        return question_id, question_text, token
+
+    async def claim_question(self, telegram_id, token=None):
+        if token is None:
+            token = await self.client.execute('GET', f"pending:{telegram_id}")
+            if token is None:
+                return None
+        value = await self.client.execute('GETDEL', f"question:{token}")
+        if value is None:
+            return None
+        await self.client.execute('ZREM', 'question_deadlines', token)
+        _, question_id, question_text, token, deadline = json.loads(value)
+        return question_id, question_text, token, deadline
+
+    async def _load(self, tokens):
+        if not tokens:
+            return []
+        values = await self.client.execute('MGET', *(f"question:{token}" for token in tokens))
+        return [json.loads(value) for value in values if value is not None]
+
+    async def load_questions(self):
+        tokens = await self.client.execute('ZRANGEBYSCORE', 'question_deadlines', '-inf', '+inf')
+        return [tuple(question) for question in await self._load(tokens)]
+
+    async def expired_questions(self, now):
+        tokens = await self.client.execute('ZRANGEBYSCORE', 'question_deadlines', '-inf', now)
+        questions = await self._load(tokens)
+        # Вопросы, уже изъятые другим процессом, убираем из множества дедлайнов
+        alive = {question[3] for question in questions}
+        for token in tokens:
+            if token not in alive:
+                await self.client.execute('ZREM', 'question_deadlines', token)
+        return [(question[0], question[3]) for question in questions]
+
+    async def get(self, key):
+        return await self.client.execute('GET', key)
+
+    async def set(self, key, value):
+        await self.client.execute('SET', key, value)
+
+    async def delete(self, key):
+        await self.client.execute('DEL', key)
+
+    async def incr(self, key):
+        return await self.client.execute('INCR', key)
+
+    async def close(self):
+        await self.client.close()
+
+
+def create_state_backend(name=STATE_BACKEND):
+    if name == 'redis':
+        return RedisStateBackend()
+    if name == 'sqlite':
+        return SQLiteStateBackend()
+    raise ValueError(f"Неизвестное хранилище состояния: {name}")
+
+
+class SharedStorage(BaseStorage):
+    """Хранилище FSM aiogram поверх общего состояния: видно всем процессам бота."""
+
+    def __init__(self, backend):
+        self.backend = backend
+
+    @staticmethod
+    def _key(key, part):
+        return (f"fsm:{key.bot_id}:{key.chat_id}:{key.user_id}:{key.thread_id or ''}:"
+                f"{key.business_connection_id or ''}:{key.destiny}:{part}")
+
+    async def set_state(self, key, state=None):
+        state = state.state if hasattr(state, 'state') else state
+        if state is None:
+            await self.backend.delete(self._key(key, 'state'))
+        else:
+            await self.backend.set(self._key(key, 'state'), state)
+
+    async def get_state(self, key):
+        return await self.backend.get(self._key(key, 'state'))
+
+    async def set_data(self, key, data):
+        if data:
+            await self.backend.set(self._key(key, 'data'), json.dumps(data, ensure_ascii=False))
+        else:
+            await self.backend.delete(self._key(key, 'data'))
+
+    async def get_data(self, key):
+        value = await self.backend.get(self._key(key, 'data'))
+        return json.loads(value) if value else {}
+
+    async def close(self):
+        await self.backend.close()
+
+
+class ExpirySweeper(BackgroundTask):
+    """Периодически завершает просроченные вопросы, чьи таймеры остались в другом процессе."""
+
+    task_name = "expiry_sweeper"
+
+    def __init__(self, backend, callback, interval=STATE_SWEEP_INTERVAL):
+        self.backend = backend
+        self.callback = callback
+        self.interval = interval
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                expired = await self.backend.expired_questions(time.time())
+            except Exception as e:
+                logging.error("Ошибка при поиске просроченных вопросов: %s", e)
+                continue
+            for telegram_id, token in expired:
+                # Ошибка по одному вопросу не должна останавливать поиск просроченных вопросов
+                try:
+                    await self.callback(token, telegram_id)
+                except Exception:
+                    logging.exception("Ошибка при завершении просроченного вопроса %s", token)
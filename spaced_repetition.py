@@ -0,0 +1,112 @@
+import heapq
+import logging
+import time
+import config
+from database import USERS_DB, get_connection
+from question_sampler import question_sampler
+
+# Режим выбора вопросов: 'random' (повтор ошибок с вероятностью 30%) или 'spaced' (интервальные повторения)
+SCHEDULING_MODE = getattr(config, 'SCHEDULING_MODE', 'random')
+# Интервалы повторения для коробок Лейтнера, в секундах
+LEITNER_INTERVALS = getattr(config, 'LEITNER_INTERVALS', (10 * 60, 24 * 3600, 3 * 24 * 3600, 7 * 24 * 3600,
+                                                          21 * 24 * 3600))
+# Коробка, после которой вопрос считается выученным и больше не повторяется
+GRADUATED_BOX = len(LEITNER_INTERVALS)
+
+
+class _ReviewQueue:
+    """Очередь повторений пользователя: куча (due_at, question_id) с ленивым удалением устаревших записей."""
+
+    __slots__ = ('heap', 'entries')
+
+    def __init__(self):
+        self.heap = []
+        self.entries = {}
+
+    def set(self, question_id, box, due_at):
+        self.entries[question_id] = (box, due_at)
+        if due_at is not None:
+            heapq.heappush(self.heap, (due_at, question_id))
+
+    # Ближайшее повторение (due_at, question_id) или None, если повторять нечего
+    def peek(self):
+        heap = self.heap
+        while heap:
+            due_at, question_id = heap[0]
+            entry = self.entries.get(question_id)
+            if entry is None or entry[1] != due_at:
+                heapq.heappop(heap)
+                continue
+            return due_at, question_id
+        return None
+
+    def peek_due(self, now):
+        top = self.peek()
+        return top[1] if top is not None and top[0] <= now else None
+
+
+class ReviewScheduler:
+    """Интервальные повторения по системе Лейтнера поверх таблицы review_schedule."""
+
+    def __init__(self, users_db=USERS_DB, intervals=LEITNER_INTERVALS):
+        self.users_db = users_db
+        self.intervals = intervals
+        self._queues = {}
+
+    # Загрузка расписания пользователя; вопросы с ошибками из прошлой истории попадают в первую коробку
+    def _get_queue(self, telegram_id):
+        queue = self._queues.get(telegram_id)
+        if queue is None:
+            queue = _ReviewQueue()
+            with get_connection(self.users_db) as conn:
+                conn.execute('''INSERT OR IGNORE INTO review_schedule (telegram_id, question_id, box, due_at)
+                                SELECT telegram_id, question_id, 0, ? FROM question_history
+                                WHERE telegram_id = ? AND attempts > correct_attempts''', (time.time(), telegram_id))
+                rows = conn.execute('SELECT question_id, box, due_at FROM review_schedule WHERE telegram_id = ?',
+                                    (telegram_id,)).fetchall()
+            for question_id, box, due_at in rows:
+                queue.set(question_id, box, due_at)
+            self._queues[telegram_id] = queue
+        return queue
+
+    def forget_user(self, telegram_id):
+        self._queues.pop(telegram_id, None)
+
+    def next_question(self, telegram_id):
+        queue = self._get_queue(telegram_id)
+        question_id = queue.peek_due(time.time())
+        if question_id is not None:
+            question = question_sampler.get_question(question_id)
+            if question:
+                logging.debug("Выбран вопрос для повторения: %s", question)
+                return question
+            # Вопрос удалён из базы: убираем его из очереди
+            queue.entries.pop(question_id, None)
+
+        logging.debug("Попытка выбрать новый вопрос")
+        question = question_sampler.pick_new(telegram_id, exclude=queue.entries)
+        if question:
+            logging.debug("Выбран новый вопрос: %s", question)
+            return question
+
+        # Новых вопросов не осталось: повторяем досрочно тот, срок которого наступит раньше всех
+        while (top := queue.peek()) is not None:
+            question = question_sampler.get_question(top[1])
+            if question:
+                logging.debug("Новых вопросов нет, досрочное повторение: %s", question)
+                return question
+            queue.entries.pop(top[1], None)
+        logging.info("Не удалось выбрать новый вопрос")
+        return None
+
+    # Перенос вопроса в следующую коробку (или в первую при ошибке); возвращает строку для review_schedule
+    def record_answer(self, telegram_id, question_id, correct):
+        queue = self._get_queue(telegram_id)
+        box = queue.entries.get(question_id, (0, None))[0]
+        box = min(box + 1, GRADUATED_BOX) if correct else 0
+        due_at = time.time() + self.intervals[box] if box < GRADUATED_BOX else None
+        queue.set(question_id, box, due_at)
+        return telegram_id, question_id, box, due_at
+
+
+review_scheduler = ReviewScheduler()
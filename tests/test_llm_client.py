@@ -0,0 +1,137 @@
+"""Проверка слоя надёжности запросов к OpenAI (llm_client.py) на заглушке с внедрением сбоев.
+
+Запуск из корня репозитория:
+    python -m unittest discover tests
+"""
+import asyncio
+import os
+import random
+import sys
+import time
+import types
+import unittest
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+sys.path.insert(0, os.path.join(REPO_DIR, 'benchmarks'))
+
+# config.py с ключами в репозитории нет: короткие интервалы, чтобы цикл предохранителя проходил за доли секунды
+config = types.ModuleType('config')
+config.OPENAI_API_KEY = "sk-test"
+config.LLM_BREAKER_FAILURES = 3
+config.LLM_BREAKER_RESET = 0.3
+config.LLM_BACKOFF_BASE = 0.01
+config.LLM_BACKOFF_MAX = 0.02
+config.LLM_HEDGE_MIN_DELAY = 0.05
+config.LLM_ATTEMPT_TIMEOUT = 5
+config.LLM_MIN_ATTEMPT_SECONDS = 0.05
+sys.modules['config'] = config
+
+from openai import AsyncOpenAI  # noqa: E402
+from llm_client import CircuitOpenError, ResilientLLM, RETRYABLE_ERRORS  # noqa: E402
+from stubs import StubOpenAI  # noqa: E402
+
+PRIMARY_MODEL = "primary-model"
+FALLBACK_MODEL = "fallback-model"
+TIMEOUT = 5
+
+
+class ResilientLLMTest(unittest.IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        random.seed(20240601)
+        self.stub = await StubOpenAI(latency=0.02, jitter=0.0, slow_latency=3.0).start()
+        self.client = AsyncOpenAI(api_key="sk-test", base_url=f"{self.stub.url}/v1", max_retries=0)
+
+    async def asyncTearDown(self):
+        await self.client.close()
+        await self.stub.stop()
+
+    def request(self, model, timeout):
+        return self.client.chat.completions.create(
+            model=model, messages=[{"role": "user", "content": "Ответ: список изменяемый"}], timeout=timeout)
+
+    async def call(self, llm, timeout=TIMEOUT):
+        return await llm.call(self.request, PRIMARY_MODEL, timeout)
+
+    async def test_breaker_opens_probes_and_closes(self):
+        llm = ResilientLLM('test', max_retries=0, hedge=False)
+        breaker = llm.breaker(PRIMARY_MODEL)
+        self.stub.outage = True
+        for _ in range(config.LLM_BREAKER_FAILURES):
+            with self.assertRaises(RETRYABLE_ERRORS):
+                await self.call(llm)
+        self.assertTrue(breaker.is_open)
+
+        # Разомкнутый предохранитель отклоняет запросы, не обращаясь к API
+        requests = self.stub.requests
+        with self.assertRaises(CircuitOpenError):
+            await self.call(llm)
+        self.assertEqual(self.stub.requests, requests)
+
+        # Неудачный пробный запрос снова размыкает предохранитель
+        await asyncio.sleep(config.LLM_BREAKER_RESET)
+        opened_at = breaker.opened_at
+        with self.assertRaises(RETRYABLE_ERRORS):
+            await self.call(llm)
+        self.assertEqual(self.stub.requests, requests + 1)
+        self.assertTrue(breaker.is_open)
+        self.assertGreater(breaker.opened_at, opened_at)
+
+        # Успешный пробный запрос замыкает его
+        self.stub.outage = False
+        await asyncio.sleep(config.LLM_BREAKER_RESET)
+        await self.call(llm)
+        self.assertFalse(breaker.is_open)
+        self.assertEqual(breaker.failures, 0)
+
+    async def test_retries_recover_from_intermittent_errors(self):
+        llm = ResilientLLM('test', max_retries=6, hedge=False)
+        self.stub.error_rate = 0.3
+        for _ in range(10):
+            await self.call(llm)
+        self.assertGreater(self.stub.faults, 0)
+        self.assertFalse(llm.breaker(PRIMARY_MODEL).is_open)
+
+    async def test_fallback_model_serves_when_primary_fails(self):
+        llm = ResilientLLM('test', fallback_model=FALLBACK_MODEL, max_retries=0, hedge=False)
+        self.stub.failing_models = {PRIMARY_MODEL}
+        completion = await self.call(llm)
+        self.assertEqual(completion.model, FALLBACK_MODEL)
+        self.assertEqual(self.stub.models[PRIMARY_MODEL], 1)
+
+        # После размыкания предохранителя основной модели запросы сразу идут к резервной
+        for _ in range(config.LLM_BREAKER_FAILURES):
+            await self.call(llm)
+        self.assertTrue(llm.breaker(PRIMARY_MODEL).is_open)
+        primary_requests = self.stub.models[PRIMARY_MODEL]
+        completion = await self.call(llm)
+        self.assertEqual(completion.model, FALLBACK_MODEL)
+        self.assertEqual(self.stub.models[PRIMARY_MODEL], primary_requests)
+        self.assertFalse(llm.breaker(FALLBACK_MODEL).is_open)
+
+    async def test_fallback_skipped_without_budget(self):
+        llm = ResilientLLM('test', fallback_model=FALLBACK_MODEL, max_retries=0, hedge=False)
+        self.stub.slow_next = 1
+        with self.assertRaises(RETRYABLE_ERRORS):
+            await self.call(llm, timeout=0.15)
+        # На резервную модель времени не осталось: она не вызывалась, и её предохранитель не тронут
+        self.assertEqual(self.stub.models[FALLBACK_MODEL], 0)
+        self.assertEqual(llm.breaker(FALLBACK_MODEL).failures, 0)
+
+    async def test_hedged_request_wins_over_slow_primary(self):
+        llm = ResilientLLM('test', max_retries=0)
+        # Набираем статистику задержек, по которой выбирается момент хедж-запроса
+        for _ in range(20):
+            await self.call(llm)
+        requests = self.stub.requests
+        self.stub.slow_next = 1
+        started = time.monotonic()
+        completion = await self.call(llm)
+        self.assertLess(time.monotonic() - started, self.stub.slow_latency / 2)
+        self.assertEqual(completion.model, PRIMARY_MODEL)
+        self.assertEqual(self.stub.requests, requests + 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,85 @@
+import asyncio
+import logging
+import math
+import time
+from background import BackgroundTask
+
+# Шаг колеса и число ячеек: дедлайны округляются вверх до шага
+TIMER_TICK = 1.0
+TIMER_SLOTS = 512
+
+
+class TimeoutScheduler(BackgroundTask):
+    """Хешированное колесо таймеров: одна фоновая задача на все дедлайны.
+
+    Каждый дедлайн хранится под своим токеном в ячейке колеса, поэтому постановка,
+    отмена и перенос выполняются за O(1), а на сессию не создаётся отдельная задача.
+    По наступлении дедлайна вызывается callback(token, payload).
+    """
+
+    task_name = "timeout_scheduler"
+
+    def __init__(self, callback, tick=TIMER_TICK, slots=TIMER_SLOTS):
+        self.callback = callback
+        self.tick = tick
+        self._slots = [{} for _ in range(slots)]
+        self._entries = {}
+        self._current_tick = math.floor(time.time() / self.tick)
+        self._firing = set()
+
+    def __len__(self):
+        return len(self._entries)
+
+    # Постановка дедлайна (unix-время); повторная постановка того же токена переносит его
+    def schedule(self, token, deadline, payload=None):
+        self.cancel(token)
+        # Просроченные дедлайны (например, после перезапуска) срабатывают на ближайшем тике
+        deadline_tick = max(math.ceil(deadline / self.tick), self._current_tick + 1)
+        slot = self._slots[deadline_tick % len(self._slots)]
+        slot[token] = (deadline_tick, payload)
+        self._entries[token] = slot
+
+    def reschedule(self, token, deadline):
+        slot = self._entries.get(token)
+        if slot is None:
+            return False
+        self.schedule(token, deadline, slot[token][1])
+        return True
+
+    def cancel(self, token):
+        slot = self._entries.pop(token, None)
+        if slot is None:
+            return False
+        del slot[token]
+        return True
+
+    def _advance(self, now_tick):
+        expired = []
+        while self._current_tick < now_tick:
+            self._current_tick += 1
+            slot = self._slots[self._current_tick % len(self._slots)]
+            # В ячейке лежат и дедлайны следующих оборотов колеса, их пропускаем
+            for token, (deadline_tick, payload) in list(slot.items()):
+                if deadline_tick <= self._current_tick:
+                    del slot[token]
+                    del self._entries[token]
+                    expired.append((token, payload))
+        return expired
+
+    async def _fire(self, token, payload):
+        try:
+            await self.callback(token, payload)
+        except Exception as e:
+            logging.error("Ошибка при обработке истёкшего таймера %s: %s", token, e)
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(max(0.0, self._current_tick * self.tick + self.tick - time.time()))
+            for token, payload in self._advance(math.floor(time.time() / self.tick)):
+                task = asyncio.create_task(self._fire(token, payload))
+                self._firing.add(task)
+                task.add_done_callback(self._firing.discard)
+
+    async def start(self):
+        if await super().start():
+            logging.info("Запущен планировщик таймеров ответов")
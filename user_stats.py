@@ -0,0 +1,100 @@
+import logging
+from database import USERS_DB, get_connection
+from question_sampler import question_sampler
+
+# Категории с меньшим числом ответов не попадают в список слабых тем
+WEAK_CATEGORY_MIN_ANSWERS = 3
+WEAK_CATEGORIES_LIMIT = 3
+
+
+class _UserAggregate:
+    """Счётчики пользователя: общие и по категориям, в виде [правильных, всего]."""
+
+    __slots__ = ('correct_answers', 'total_answers', 'categories')
+
+    def __init__(self, correct_answers, total_answers):
+        self.correct_answers = correct_answers
+        self.total_answers = total_answers
+        self.categories = {}
+
+
+class UserStats:
+    """Инкрементально обновляемая статистика пользователей без подсчёта по истории ответов.
+
+    Общие счётчики берутся из users, разбивка по категориям - из user_category_stats;
+    обе таблицы читаются по ключу один раз на пользователя, дальше статистика живёт в памяти.
+    Все методы вызываются в потоке базы данных.
+    """
+
+    def __init__(self, users_db=USERS_DB):
+        self.users_db = users_db
+        self._users = {}
+
+    def _get(self, telegram_id):
+        aggregate = self._users.get(telegram_id)
+        if aggregate is None:
+            conn = get_connection(self.users_db)
+            user = conn.execute('SELECT correct_answers, total_answers FROM users WHERE telegram_id = ?',
+                                (telegram_id,)).fetchone()
+            aggregate = _UserAggregate(*(user or (0, 0)))
+            rows = conn.execute('SELECT category, correct_answers, total_answers FROM user_category_stats '
+                                'WHERE telegram_id = ?', (telegram_id,)).fetchall()
+            if not rows and aggregate.total_answers:
+                rows = self._backfill_categories(conn, telegram_id)
+            for category, correct_answers, total_answers in rows:
+                aggregate.categories[category] = [correct_answers, total_answers]
+            self._users[telegram_id] = aggregate
+        return aggregate
+
+    def forget_user(self, telegram_id):
+        self._users.pop(telegram_id, None)
+
+    # Однократное заполнение разбивки по категориям из истории ответов, накопленной до её появления
+    def _backfill_categories(self, conn, telegram_id):
+        categories = {}
+        for question_id, attempts, correct_attempts in conn.execute(
+                'SELECT question_id, attempts, correct_attempts FROM question_history WHERE telegram_id = ?',
+                (telegram_id,)):
+            category = self.category_of(question_id)
+            counters = categories.setdefault(category, [0, 0])
+            counters[0] += correct_attempts
+            counters[1] += attempts
+        rows = [(category, correct_answers, total_answers)
+                for category, (correct_answers, total_answers) in categories.items()]
+        with conn:
+            conn.executemany('INSERT OR IGNORE INTO user_category_stats '
+                             '(telegram_id, category, correct_answers, total_answers) VALUES (?, ?, ?, ?)',
+                             [(telegram_id, *row) for row in rows])
+        logging.info("Заполнена статистика по категориям для пользователя с telegram_id %s", telegram_id)
+        return rows
+
+    @staticmethod
+    def category_of(question_id):
+        question = question_sampler.get_question(question_id)
+        return question[2] if question else "Нет"
+
+    # Учёт ответа в памяти; возвращает категорию вопроса для последующей записи в базу
+    def record_answer(self, telegram_id, question_id, correct):
+        aggregate = self._get(telegram_id)
+        category = self.category_of(question_id)
+        aggregate.total_answers += 1
+        aggregate.correct_answers += int(correct)
+        counters = aggregate.categories.setdefault(category, [0, 0])
+        counters[0] += int(correct)
+        counters[1] += 1
+        return category
+
+    def get_totals(self, telegram_id):
+        aggregate = self._get(telegram_id)
+        return aggregate.total_answers, aggregate.correct_answers
+
+    # Категории с наименьшей долей правильных ответов: [(категория, правильных, всего)]
+    def get_weak_categories(self, telegram_id, limit=WEAK_CATEGORIES_LIMIT, min_answers=WEAK_CATEGORY_MIN_ANSWERS):
+        categories = [(category, correct_answers, total_answers)
+                      for category, (correct_answers, total_answers) in self._get(telegram_id).categories.items()
+                      if total_answers >= min_answers and correct_answers < total_answers]
+        categories.sort(key=lambda item: (item[1] / item[2], -item[2]))
+        return categories[:limit]
+
+
+user_stats = UserStats()
@@ -0,0 +1,80 @@
+import asyncio
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+import ffmpeg
+import config
+from llm_client import ResilientLLM, get_async_client
+from metrics import Histogram, timed
+from middlewares import openai_limiter
+
+# Параметры распознавания речи можно переопределить в config.py
+TRANSCRIPTION_MODEL = getattr(config, 'TRANSCRIPTION_MODEL', "whisper-1")
+TRANSCRIPTION_CONCURRENCY = getattr(config, 'TRANSCRIPTION_CONCURRENCY', 20)
+TRANSCODE_WORKERS = getattr(config, 'TRANSCODE_WORKERS', 4)
+# Общий дедлайн распознавания вместе с повторами
+TRANSCRIPTION_TIMEOUT = getattr(config, 'TRANSCRIPTION_TIMEOUT', 30)
+
+# Форматы, которые Whisper принимает без перекодирования (голосовые Telegram приходят в .oga)
+ACCEPTED_AUDIO_FORMATS = {'flac', 'm4a', 'mp3', 'mp4', 'mpeg', 'mpga', 'oga', 'ogg', 'wav', 'webm'}
+
+FFMPEG_TRANSCODE_SECONDS = Histogram('bot_ffmpeg_transcode_seconds', 'Время перекодирования аудио в ffmpeg')
+WHISPER_SECONDS = Histogram('bot_whisper_seconds', 'Время распознавания речи в Whisper')
+
+# ffmpeg блокирует поток, поэтому перекодирование идёт в отдельном пуле
+_transcode_executor = ThreadPoolExecutor(max_workers=TRANSCODE_WORKERS, thread_name_prefix='ffmpeg')
+_semaphore = None
+# Резервной модели для распознавания нет, остаются повторы, хеджирование и предохранитель
+transcription_llm = ResilientLLM('transcription')
+
+
+def _get_semaphore():
+    global _semaphore
+    if _semaphore is None:
+        _semaphore = asyncio.Semaphore(TRANSCRIPTION_CONCURRENCY)
+    return _semaphore
+
+
+# Перекодирование в wav через stdin/stdout ffmpeg, без временных файлов
+@timed(FFMPEG_TRANSCODE_SECONDS)
+def transcode_to_wav(audio_bytes):
+    wav_bytes, _ = (
+        ffmpeg.input('pipe:0')
+        .output('pipe:1', format='wav')
+        .run(input=audio_bytes, capture_stdout=True, capture_stderr=True)
+    )
+    return wav_bytes
+
+
+async def transcribe_audio(audio_bytes, filename, user_id=None):
+    extension = os.path.splitext(filename)[1].lstrip('.').lower()
+    if extension not in ACCEPTED_AUDIO_FORMATS:
+        loop = asyncio.get_running_loop()
+        audio_bytes = await loop.run_in_executor(_transcode_executor, transcode_to_wav, audio_bytes)
+        filename = 'voice.wav'
+
+    await openai_limiter.acquire(user_id)
+    async with _get_semaphore():
+        response = await _transcribe(audio_bytes, filename)
+    return response.text
+
+
+@timed(WHISPER_SECONDS)
+async def _transcribe(audio_bytes, filename):
+    return await transcription_llm.call(
+        lambda model, timeout: get_async_client().audio.transcriptions.create(
+            model=model, file=(filename, audio_bytes), timeout=timeout),
+        TRANSCRIPTION_MODEL, TRANSCRIPTION_TIMEOUT)
+
+
+# Загрузка голосового сообщения в память и распознавание
+async def transcribe_voice(bot, voice, user_id=None):
+    file_info = await bot.get_file(voice.file_id)
+    buffer = await bot.download_file(file_info.file_path)
+    audio_bytes = buffer.getvalue()
+    logging.info("Загружено голосовое сообщение: %s байт, %s", len(audio_bytes), file_info.file_path)
+    return await transcribe_audio(audio_bytes, os.path.basename(file_info.file_path), user_id)
+
+
+def shutdown_transcoder():
+    _transcode_executor.shutdown(wait=False)